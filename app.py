@@ -1,53 +1,365 @@
 # Importando as bibliotecas necessárias
-from flask import Flask, request, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+import atexit
+import csv
+import io
+import json
+import math
+import os
+import secrets
+import string
+import threading
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, stream_with_context
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta
+from migrations import upgrade
+from bloom import BloomFilter, CodeFilter
+from coupon_cache import CouponCache, snapshot
+from counters import (CUSTOMER_HISTORY_SQL, MemoryCounterBackend, RedisCounterBackend, Reconciler, SqlCounterBackend,
+                      add_orders, sql_customer_loader, sql_limits_loader)
+from idempotency import MAX_KEY_LENGTH, find_response, store_response
+from models import db, Coupon, Customer
+from money import to_cents, from_cents
+from rules import DISCOUNT_TYPES, Purchase, evaluator_for, parse_rules
+from sqlite_profile import configure_sqlite
+from metrics import install_metrics
+from ratelimit import RateLimiter
 
-# Criando a aplicação Flask
-app = Flask(__name__)
+# Caracteres usados na geração de códigos aleatórios
+CODE_ALPHABET = string.ascii_uppercase + string.digits
 
-# Configurando a conexão com o banco de dados SQLite
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///coupons.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+# Limite de parâmetros por consulta no SQLite
+SQLITE_MAX_VARIABLES = 900
 
+# Tamanho máximo do identificador de um cliente
+MAX_CUSTOMER_ID_LENGTH = 64
 
-# Definindo o modelo da tabela de cupons
-class Coupon(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    code = db.Column(db.String(20), unique=True, nullable=False)
-    expiration_date = db.Column(db.DateTime, nullable=False)
-    max_uses = db.Column(db.Integer, nullable=False)
-    min_value = db.Column(db.Float, nullable=False)
-    discount_type = db.Column(db.String(10), nullable=False)
-    discount_amount = db.Column(db.Float, nullable=False)
-    public = db.Column(db.Boolean, nullable=False)
-    first_purchase = db.Column(db.Boolean, nullable=False)
-    uses = db.relationship('Use', backref='coupon', lazy=True)
+# Quantidade máxima de outros cupons aplicados na mesma compra (applied_coupons do consumo)
+MAX_APPLIED_COUPONS = 10
 
-    def __repr__(self):
-        return f"<Coupon {self.code}>"
 
+# Clientes com algum pedido, carregados no filtro de clientes conhecidos
+KNOWN_CUSTOMERS_SQL = text('SELECT customer_id FROM customer WHERE orders_count > 0')
 
-# Definindo o modelo da tabela de usos dos cupons
-class Use(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    coupon_id = db.Column(db.Integer, db.ForeignKey('coupon.id'), nullable=False)
-    use_date = db.Column(db.DateTime, nullable=False)
+# Códigos dos cupons cadastrados depois de um id, carregados no filtro de códigos. Os ids só crescem
+# (a limpeza do arquivo morto mantém o cupom de maior id), então um cupom cadastrado depois dela não fica de fora
+NEW_CODES_SQL = text('SELECT id, code FROM coupon WHERE id > :last_id ORDER BY id')
 
-    def __repr__(self):
-        return f"<Use {self.coupon_id} {self.use_date}>"
+# Endpoints sujeitos ao limite de requisições por cliente
+RATE_LIMITED_ENDPOINTS = {'coupons.use_coupon', 'coupons.quote_cart'}
 
+# Rotas da API, registradas em cada aplicação criada por create_app
+bp = Blueprint('coupons', __name__)
 
-# Criando as tabelas no banco de dados
-db.create_all()
 
+# Criando a aplicação Flask com a configuração padrão, sobrescrita por `config` (por exemplo, um banco
+# SQLite em memória nos testes). Nada é feito no banco aqui: a engine é criada no primeiro acesso,
+# com a configuração desta aplicação, e o esquema é criado pelas migrações.
+def create_app(config=None):
+    app = Flask(__name__)
+
+    # Configurando a conexão com o banco de dados SQLite
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///coupons.db'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Perfil de ajustes do SQLite (WAL, busy timeout, pool de conexões), escolhido pela variável SQLITE_PROFILE
+    app.config['SQLITE_PROFILE'] = os.environ.get('SQLITE_PROFILE', 'production')
+
+    # Configurando o cache de cupons mais consultados (tamanho máximo e validade em segundos)
+    app.config['COUPON_CACHE_SIZE'] = 1024
+    app.config['COUPON_CACHE_TTL'] = 60
+    app.config['COUPON_CACHE_NEGATIVE_TTL'] = 5
+
+    # Configurando as métricas (GET /metrics) e o profiler opcional das requisições mais lentas (GET /metrics/slowest),
+    # que executa com o cProfile a fração METRICS_PROFILE_SAMPLE_RATE das requisições
+    app.config['METRICS_PROFILE_SAMPLE_RATE'] = float(os.environ.get('METRICS_PROFILE_SAMPLE_RATE', 0))
+    app.config['METRICS_PROFILE_KEEP'] = 10
+
+    # Configurando o cadastro em lote (quantidade de cupons gravados por transação)
+    app.config['BULK_BATCH_SIZE'] = 5000
+
+    # Configurando a listagem de cupons (tamanho padrão e máximo da página) e a exportação (linhas lidas por vez do cursor)
+    app.config['LIST_PAGE_SIZE'] = 100
+    app.config['LIST_MAX_PAGE_SIZE'] = 1000
+    app.config['EXPORT_BATCH_SIZE'] = 1000
+
+    # Configurando o modo opcional de commit em grupo dos consumos: os usos de várias requisições
+    # são gravados em uma única transação, de até REDEMPTION_BATCH_SIZE usos ou REDEMPTION_BATCH_DELAY segundos.
+    # REDEMPTION_DURABILITY: 'commit' responde após o commit do lote; 'reserve' responde antes (ver group_commit.py)
+    app.config['REDEMPTION_GROUP_COMMIT'] = os.environ.get('REDEMPTION_GROUP_COMMIT') == '1'
+    app.config['REDEMPTION_BATCH_SIZE'] = 256
+    app.config['REDEMPTION_BATCH_DELAY'] = 0.002
+    app.config['REDEMPTION_DURABILITY'] = os.environ.get('REDEMPTION_DURABILITY', 'commit')
+
+    # Configurando o backend dos contadores de usos (sql, memory ou redis, ver counters.py). Com memory e redis,
+    # os usos reservados são gravados na tabela Use pela reconciliação, a cada COUNTER_RECONCILE_INTERVAL segundos
+    app.config['COUNTER_BACKEND'] = os.environ.get('COUNTER_BACKEND', 'sql')
+    app.config['COUNTER_REDIS_URL'] = os.environ.get('COUNTER_REDIS_URL', 'redis://localhost:6379/0')
+    app.config['COUNTER_RECONCILE_INTERVAL'] = 1.0
+    app.config['COUNTER_RECONCILE_BATCH_SIZE'] = 1000
+
+    # Configurando o tempo (em segundos) em que a resposta de um consumo fica guardada pela Idempotency-Key
+    app.config['IDEMPOTENCY_KEY_TTL'] = 24 * 60 * 60
+    # Configurando a remoção das chaves expiradas a cada IDEMPOTENCY_PURGE_INTERVAL segundos, dentro do servidor
+    # (0 desativa), independentemente do arquivo morto
+    app.config['IDEMPOTENCY_PURGE_INTERVAL'] = float(os.environ.get('IDEMPOTENCY_PURGE_INTERVAL', 3600))
+
+    # Configurando a limpeza dos cupons expirados há mais de ARCHIVE_GRACE_DAYS dias, movidos com os seus usos
+    # para o arquivo morto a cada ARCHIVE_SWEEP_INTERVAL segundos (0 desativa a limpeza dentro da aplicação)
+    app.config['ARCHIVE_DATABASE_PATH'] = os.environ.get('ARCHIVE_DATABASE_PATH', 'coupons_archive.db')
+    app.config['ARCHIVE_GRACE_DAYS'] = 30
+    app.config['ARCHIVE_SWEEP_INTERVAL'] = float(os.environ.get('ARCHIVE_SWEEP_INTERVAL', 0))
+
+    # Configurando o filtro de Bloom opcional dos clientes com pedidos, que evita ler o histórico de clientes
+    # certamente novos (0 desativa o filtro). Válido apenas com um único processo, ver README
+    app.config['CUSTOMER_FILTER_CAPACITY'] = int(os.environ.get('CUSTOMER_FILTER_CAPACITY', 0))
+    app.config['CUSTOMER_FILTER_ERROR_RATE'] = 0.01
+
+    # Configurando o limite de requisições por cliente nos endpoints de consumo e de cotação: cada cliente recebe
+    # RATE_LIMIT_PER_SECOND fichas por segundo, acumulando até RATE_LIMIT_BURST (0 desativa o limite), e cada
+    # código não encontrado custa RATE_LIMIT_MISS_COST fichas, para frear quem tenta adivinhar códigos.
+    # O cliente é o IP, ou a chave do cabeçalho X-API-Key quando ela está em RATE_LIMIT_API_KEYS
+    app.config['RATE_LIMIT_PER_SECOND'] = float(os.environ.get('RATE_LIMIT_PER_SECOND', 0))
+    app.config['RATE_LIMIT_BURST'] = 20
+    app.config['RATE_LIMIT_MISS_COST'] = 5
+    app.config['RATE_LIMIT_MAX_KEYS'] = 100000
+    app.config['RATE_LIMIT_API_KEYS'] = {key for key in os.environ.get('RATE_LIMIT_API_KEYS', '').split(',') if key}
+
+    # Configurando o filtro de Bloom opcional dos códigos cadastrados, que recusa códigos inexistentes sem consultar
+    # o banco (0 desativa o filtro). Os cupons cadastrados por outros processos entram no filtro em até
+    # CODE_FILTER_SYNC_INTERVAL segundos, e o filtro é recriado a cada CODE_FILTER_REBUILD_INTERVAL segundos
+    app.config['CODE_FILTER_CAPACITY'] = int(os.environ.get('CODE_FILTER_CAPACITY', 0))
+    app.config['CODE_FILTER_ERROR_RATE'] = 0.001
+    app.config['CODE_FILTER_SYNC_INTERVAL'] = 1.0
+    app.config['CODE_FILTER_REBUILD_INTERVAL'] = 3600.0
+
+    # Aplicando a configuração desta instância
+    app.config.update(config or {})
+
+    # Montando as opções da engine pelo perfil e pela URI finais; opções passadas em `config` têm prioridade
+    configure_sqlite(app, app.config['SQLITE_PROFILE'])
+    if config and 'SQLALCHEMY_ENGINE_OPTIONS' in config:
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = config['SQLALCHEMY_ENGINE_OPTIONS']
+    db.init_app(app)
+
+    # Estado de cada aplicação: o cache de cupons aqui; o registro do commit em grupo e o backend
+    # dos contadores são criados no primeiro consumo (get_redemption_log e get_counter_backend)
+    app.extensions['coupon_cache'] = CouponCache(max_size=app.config['COUPON_CACHE_SIZE'],
+                                                 ttl=app.config['COUPON_CACHE_TTL'],
+                                                 negative_ttl=app.config['COUPON_CACHE_NEGATIVE_TTL'])
+
+    install_metrics(app)
+    app.register_blueprint(bp)
+    return app
+
+
+# Obtendo o cache de cupons da aplicação atual
+def get_coupon_cache():
+    return current_app.extensions['coupon_cache']
+
+
+# Iniciando a limpeza periódica dos cupons expirados em uma thread da aplicação
+def start_sweeper():
+    # Importado somente quando a limpeza é iniciada, para não pesar na importação da aplicação
+    from sweeper import Sweeper
+    sweeper = Sweeper(db.engine.url.database,
+                      current_app.config['ARCHIVE_DATABASE_PATH'],
+                      timedelta(days=current_app.config['ARCHIVE_GRACE_DAYS']),
+                      current_app.config['ARCHIVE_SWEEP_INTERVAL'])
+    sweeper.start()
+    return sweeper
+
+
+# Iniciando a remoção periódica das chaves de idempotência expiradas em uma thread da aplicação
+def start_idempotency_purger():
+    from sweeper import IdempotencyPurger
+    purger = IdempotencyPurger(db.engine.url.database, current_app.config['IDEMPOTENCY_PURGE_INTERVAL'])
+    purger.start()
+    return purger
+
+
+# Carregando do banco os atributos imutáveis de um cupom para o cache
+def load_coupon(code):
+    coupon = Coupon.query.filter_by(code=code).first()
+    return snapshot(coupon) if coupon else None
+
+
+# Evitando que dois primeiros consumos simultâneos criem dois backends ou dois registros de commit em grupo
+_extensions_lock = threading.Lock()
+
+
+# Obtendo o backend dos contadores de usos da aplicação atual, criado no primeiro consumo, e iniciando a reconciliação
+def get_counter_backend():
+    extensions = current_app.extensions
+    if 'counter_backend' in extensions:
+        return extensions['counter_backend']
+    with _extensions_lock:
+        if 'counter_backend' in extensions:
+            return extensions['counter_backend']
+        name = current_app.config['COUNTER_BACKEND']
+        if name == 'sql':
+            extensions['counter_backend'] = SqlCounterBackend(db.session)
+            return extensions['counter_backend']
+        if name == 'memory':
+            backend = MemoryCounterBackend(sql_limits_loader(db.engine), sql_customer_loader(db.engine))
+        elif name == 'redis':
+            # Dependência opcional, necessária apenas com o backend redis
+            import redis
+            backend = RedisCounterBackend(redis.Redis.from_url(current_app.config['COUNTER_REDIS_URL']),
+                                          sql_limits_loader(db.engine), sql_customer_loader(db.engine))
+        else:
+            raise ValueError(f'Backend de contadores desconhecido: {name}')
+        reconciler = Reconciler(backend, db.engine,
+                                current_app.config['COUNTER_RECONCILE_INTERVAL'],
+                                current_app.config['COUNTER_RECONCILE_BATCH_SIZE'])
+        reconciler.start()
+        # Gravando os usos ainda pendentes ao encerrar o processo
+        atexit.register(reconciler.stop)
+        extensions['counter_reconciler'] = reconciler
+        extensions['counter_backend'] = backend
+        return backend
+
+
+# Obtendo o registro de consumos com commit em grupo da aplicação atual, criado no primeiro consumo
+def get_redemption_log():
+    extensions = current_app.extensions
+    if 'redemption_log' in extensions:
+        return extensions['redemption_log']
+    with _extensions_lock:
+        if 'redemption_log' not in extensions:
+            # Importado somente quando o commit em grupo está ativo
+            from group_commit import GroupCommitLog
+            extensions['redemption_log'] = GroupCommitLog(db.engine,
+                                                          max_batch=current_app.config['REDEMPTION_BATCH_SIZE'],
+                                                          max_delay=current_app.config['REDEMPTION_BATCH_DELAY'],
+                                                          durability=current_app.config['REDEMPTION_DURABILITY'])
+        return extensions['redemption_log']
+
+
+# Obtendo o filtro de clientes conhecidos da aplicação atual, carregado do banco no primeiro acesso,
+# ou None quando o filtro está desativado
+def get_customer_filter():
+    if not current_app.config['CUSTOMER_FILTER_CAPACITY']:
+        return None
+    extensions = current_app.extensions
+    if 'customer_filter' in extensions:
+        return extensions['customer_filter']
+    with _extensions_lock:
+        if 'customer_filter' not in extensions:
+            customer_filter = BloomFilter(current_app.config['CUSTOMER_FILTER_CAPACITY'],
+                                          current_app.config['CUSTOMER_FILTER_ERROR_RATE'])
+            customer_filter.update(customer_id for (customer_id,) in db.session.execute(KNOWN_CUSTOMERS_SQL))
+            extensions['customer_filter'] = customer_filter
+        return extensions['customer_filter']
+
+
+# Lendo o histórico do cliente para o cupom: (pedidos anteriores, usos do cupom pelo cliente).
+# Um cliente ausente do filtro certamente não tem pedidos nem usos, e o banco não é consultado
+def load_customer_history(coupon_id, customer_id):
+    customer_filter = get_customer_filter()
+    if customer_filter is not None and customer_id not in customer_filter:
+        return 0, 0
+    orders_count, customer_uses = db.session.execute(CUSTOMER_HISTORY_SQL, {'coupon_id': coupon_id,
+                                                                            'customer_id': customer_id}).one()
+    return orders_count or 0, customer_uses
+
+
+# Marcando o cliente como conhecido no filtro, depois de gravar um pedido dele
+def remember_customer(customer_id):
+    customer_filter = get_customer_filter()
+    if customer_filter is not None:
+        customer_filter.add(customer_id)
+
+
+# Verificando as regras do cupom que dependem do histórico do cliente; retorna a mensagem de erro ou None
+def check_customer(coupon, total_value, orders_count, customer_uses, now, categories=None, stacked=0):
+    error = check_coupon(coupon, total_value, orders_count == 0, now, categories, stacked)
+    if error:
+        return error
+    if coupon.max_uses_per_customer is not None and customer_uses >= coupon.max_uses_per_customer:
+        return 'Limite de usos por cliente atingido'
+    return None
+
+
+# Obtendo o filtro dos códigos cadastrados da aplicação atual, carregado do banco no primeiro acesso,
+# ou None quando o filtro está desativado
+def get_code_filter():
+    if not current_app.config['CODE_FILTER_CAPACITY']:
+        return None
+    extensions = current_app.extensions
+    if 'code_filter' in extensions:
+        return extensions['code_filter']
+    with _extensions_lock:
+        if 'code_filter' not in extensions:
+            extensions['code_filter'] = CodeFilter(current_app.config['CODE_FILTER_CAPACITY'],
+                                                   current_app.config['CODE_FILTER_ERROR_RATE'],
+                                                   lambda last_id: db.session.execute(NEW_CODES_SQL, {'last_id': last_id}),
+                                                   current_app.config['CODE_FILTER_SYNC_INTERVAL'],
+                                                   current_app.config['CODE_FILTER_REBUILD_INTERVAL'])
+        return extensions['code_filter']
+
+
+# Verificando se o código pode estar cadastrado; False significa que certamente não está
+def code_may_exist(code):
+    code_filter = get_code_filter()
+    return code_filter is None or code in code_filter
+
+
+# Incluindo no filtro o código de um cupom recém-cadastrado
+def remember_code(code):
+    code_filter = get_code_filter()
+    if code_filter is not None:
+        code_filter.add(code)
+
+
+# Obtendo o limite de requisições por cliente da aplicação atual, ou None quando o limite está desativado
+def get_rate_limiter():
+    if not current_app.config['RATE_LIMIT_PER_SECOND']:
+        return None
+    extensions = current_app.extensions
+    if 'rate_limiter' in extensions:
+        return extensions['rate_limiter']
+    with _extensions_lock:
+        if 'rate_limiter' not in extensions:
+            extensions['rate_limiter'] = RateLimiter(current_app.config['RATE_LIMIT_PER_SECOND'],
+                                                     current_app.config['RATE_LIMIT_BURST'],
+                                                     current_app.config['RATE_LIMIT_MAX_KEYS'])
+        return extensions['rate_limiter']
+
+
+# Identificando o cliente da requisição: a chave de API, quando é uma das chaves conhecidas, ou o IP.
+# Uma chave desconhecida não é usada, para que trocar de chave a cada requisição não escape do limite
+def rate_limit_key():
+    api_key = request.headers.get('X-API-Key')
+    if api_key and api_key in current_app.config['RATE_LIMIT_API_KEYS']:
+        return 'key:' + api_key
+    return 'ip:' + (request.remote_addr or '')
+
+
+# Recusando a requisição quando o cliente já gastou as suas fichas, antes de qualquer acesso ao banco
+@bp.before_request
+def check_rate_limit():
+    limiter = get_rate_limiter()
+    if limiter is None or request.endpoint not in RATE_LIMITED_ENDPOINTS:
+        return None
+    wait = limiter.charge(rate_limit_key())
+    if wait:
+        return jsonify({'error': 'Muitas requisições'}), 429, {'Retry-After': str(math.ceil(wait))}
+    return None
+
+
+# Cobrando do cliente as fichas extras dos códigos não encontrados (a ficha da requisição já foi gasta)
+def charge_misses(misses):
+    limiter = get_rate_limiter()
+    if limiter is not None and misses:
+        limiter.charge(rate_limit_key(), misses * current_app.config['RATE_LIMIT_MISS_COST'] - 1, force=True)
+
+
+# Validando os dados de um cupom, com as mesmas regras para o cadastro individual e em lote.
+# code_exists é uma função que informa se o código já está cadastrado.
+def validate_coupon(data, code_exists):
+    if not isinstance(data, dict):
+        return None, 'Dados incompletos'
 
-# Definindo o endpoint para cadastro de cupons
-@app.route('/coupons', methods=['POST'])
-def create_coupon():
-    # Obtendo os dados do cupom do corpo da requisição
-    data = request.get_json()
     code = data.get('code')
     expiration_date = data.get('expiration_date')
     max_uses = data.get('max_uses')
@@ -56,36 +368,75 @@ def create_coupon():
     discount_amount = data.get('discount_amount')
     public = data.get('public')
     first_purchase = data.get('first_purchase')
+    max_uses_per_customer = data.get('max_uses_per_customer')
+    rules = data.get('rules')
 
-    # Validando os dados do cupom
-    if not code or not expiration_date or not max_uses or not min_value or not discount_type or not discount_amount or public is None or first_purchase is None:
-        return jsonify({'error': 'Dados incompletos'}), 400
+    if not isinstance(code, str) or not code or not expiration_date or not max_uses or not min_value or not discount_type or not discount_amount or public is None or first_purchase is None:
+        return None, 'Dados incompletos'
 
-    if Coupon.query.filter_by(code=code).first():
-        return jsonify({'error': 'Código já existe'}), 400
+    if code_exists(code):
+        return None, 'Código já existe'
+
+    try:
+        expiration_date = datetime.fromisoformat(expiration_date)
+    except (TypeError, ValueError):
+        return None, 'Data de expiração inválida'
 
     if expiration_date < datetime.now():
-        return jsonify({'error': 'Data de expiração inválida'}), 400
+        return None, 'Data de expiração inválida'
 
-    if max_uses <= 0 or min_value <= 0 or discount_amount <= 0:
-        return jsonify({'error': 'Valores inválidos'}), 400
+    try:
+        if max_uses <= 0 or min_value <= 0 or discount_amount <= 0:
+            return None, 'Valores inválidos'
+    except TypeError:
+        return None, 'Valores inválidos'
+
+    # Limite opcional de usos por cliente
+    if max_uses_per_customer is not None and (not isinstance(max_uses_per_customer, int)
+                                              or isinstance(max_uses_per_customer, bool) or max_uses_per_customer <= 0):
+        return None, 'Valores inválidos'
 
-    if discount_type not in ['percentual', 'fixo', 'primeira']:
-        return jsonify({'error': 'Tipo de desconto inválido'}), 400
+    if discount_type not in DISCOUNT_TYPES:
+        return None, 'Tipo de desconto inválido'
+
+    # Regras opcionais: categorias, janelas de horário e acúmulo com outros cupons (ver rules.py)
+    rules, error = parse_rules(rules)
+    if error:
+        return None, error
+
+    return {'code': code,
+            'expiration_date': expiration_date,
+            'max_uses': max_uses,
+            'min_value_cents': to_cents(min_value),
+            'discount_type': discount_type,
+            'discount_amount_cents': to_cents(discount_amount),
+            'public': public,
+            'first_purchase': first_purchase,
+            'max_uses_per_customer': max_uses_per_customer,
+            'rules': rules}, None
+
+
+# Definindo o endpoint para cadastro de cupons
+@bp.route('/coupons', methods=['POST'])
+def create_coupon():
+    # Obtendo os dados do cupom do corpo da requisição
+    data = request.get_json()
+
+    # Validando os dados do cupom
+    values, error = validate_coupon(data, lambda code: Coupon.query.filter_by(code=code).first() is not None)
+    if error:
+        return jsonify({'error': error}), 400
 
     # Criando o objeto do cupom e salvando no banco de dados
-    coupon = Coupon(code=code,
-                    expiration_date=expiration_date,
-                    max_uses=max_uses,
-                    min_value=min_value,
-                    discount_type=discount_type,
-                    discount_amount=discount_amount,
-                    public=public,
-                    first_purchase=first_purchase)
+    coupon = Coupon(**values)
 
     db.session.add(coupon)
     db.session.commit()
 
+    # Removendo o código do cache, que pode ter guardado a ausência do cupom, e incluindo-o no filtro de códigos
+    get_coupon_cache().invalidate(coupon.code)
+    remember_code(coupon.code)
+
     # Retornando uma resposta de sucesso com os dados do cupom criado
     return jsonify({'id': coupon.id,
                     'code': coupon.code,
@@ -95,68 +446,589 @@ def create_coupon():
                     'discount_type': coupon.discount_type,
                     'discount_amount': coupon.discount_amount,
                     'public': coupon.public,
-                    'first_purchase': coupon.first_purchase}), 201
+                    'first_purchase': coupon.first_purchase,
+                    'max_uses_per_customer': coupon.max_uses_per_customer,
+                    'rules': json.loads(coupon.rules) if coupon.rules else None}), 201
 
     # ou Retornar uma resposta com o cupom criado
     # return jsonify(coupon.__dict__), 201
 
+# Buscando quais dos códigos informados já estão cadastrados, com consultas do tipo IN
+def find_existing_codes(codes):
+    codes = list(codes)
+    existing = set()
+    for start in range(0, len(codes), SQLITE_MAX_VARIABLES):
+        chunk = codes[start:start + SQLITE_MAX_VARIABLES]
+        existing.update(code for (code,) in db.session.query(Coupon.code).filter(Coupon.code.in_(chunk)))
+    return existing
+
+
+# Gravando um lote de cupons já validados em uma única transação
+def insert_coupon_batch(rows):
+    db.session.execute(Coupon.__table__.insert(), rows)
+    db.session.commit()
+    for row in rows:
+        get_coupon_cache().invalidate(row['code'])
+        remember_code(row['code'])
+
+
+# Validando e gravando um lote de cupons, retornando o resultado de cada item
+def create_coupon_batch(batch, retry=True):
+    codes = {data.get('code') for _, data in batch if isinstance(data, dict) and isinstance(data.get('code'), str)}
+    existing = find_existing_codes(codes)
+
+    rows = []
+    results = []
+    for index, data in batch:
+        values, error = validate_coupon(data, lambda code: code in existing)
+        if error:
+            code = data.get('code') if isinstance(data, dict) else None
+            results.append({'index': index, 'code': code, 'status': 400, 'error': error})
+            continue
+        # Marcando o código como usado para recusar repetições dentro da mesma requisição
+        existing.add(values['code'])
+        rows.append(values)
+        results.append({'index': index, 'code': values['code'], 'status': 201})
+
+    if rows:
+        try:
+            insert_coupon_batch(rows)
+        except IntegrityError:
+            db.session.rollback()
+            # Outro processo cadastrou algum dos códigos depois da verificação: validando o lote novamente
+            if not retry:
+                raise
+            return create_coupon_batch(batch, retry=False)
+    return results
+
+
+# Cadastrando vários cupons, com as mesmas regras de create_coupon, em transações de até batch_size cupons.
+# items pode ser qualquer iterável de dicionários (lista, gerador lendo um arquivo NDJSON, etc.)
+def create_coupons_bulk(items, batch_size=None):
+    batch_size = batch_size or current_app.config['BULK_BATCH_SIZE']
+    results = []
+    batch = []
+    for index, data in enumerate(items):
+        batch.append((index, data))
+        if len(batch) >= batch_size:
+            results.extend(create_coupon_batch(batch))
+            batch = []
+    if batch:
+        results.extend(create_coupon_batch(batch))
+    return results
+
+
+# Gerando um código aleatório
+def generate_code(length, prefix=''):
+    return prefix + ''.join(secrets.choice(CODE_ALPHABET) for _ in range(length))
+
+
+# Cadastrando count cupons com códigos aleatórios e únicos, a partir de um modelo com os demais dados
+def generate_coupons_bulk(template, count, length=10, prefix='', batch_size=None):
+    batch_size = batch_size or current_app.config['BULK_BATCH_SIZE']
+
+    if not isinstance(count, int) or count <= 0:
+        return None, 'Valores inválidos'
+    if not isinstance(length, int) or not isinstance(prefix, str) or length <= 0 or len(prefix) + length > 20:
+        return None, 'Tamanho de código inválido'
+    # Exigindo folga no espaço de códigos para que as colisões continuem raras
+    if len(CODE_ALPHABET) ** length < count * 100:
+        return None, 'Tamanho de código insuficiente'
+
+    # Validando o modelo uma única vez, com um código provisório
+    if not isinstance(template, dict):
+        return None, 'Dados incompletos'
+    values, error = validate_coupon(dict(template, code=prefix + 'X' * length), lambda code: False)
+    if error:
+        return None, error
+
+    created = []
+    while len(created) < count:
+        size = min(batch_size, count - len(created))
+        candidates = set()
+        while len(candidates) < size:
+            candidates.add(generate_code(length, prefix))
+        candidates -= find_existing_codes(candidates)
+        try:
+            insert_coupon_batch([dict(values, code=code) for code in candidates])
+        except IntegrityError:
+            # Algum código foi cadastrado por outro processo ao mesmo tempo: gerando o lote novamente
+            db.session.rollback()
+            continue
+        created.extend(candidates)
+    return created, None
+
+
+# Lendo um corpo NDJSON linha a linha, sem carregar a requisição inteira na memória
+def read_ndjson(stream):
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+# Definindo o endpoint para cadastro de cupons em lote
+@bp.route('/coupons/bulk', methods=['POST'])
+def create_coupons():
+    # Recebendo os cupons como NDJSON (um cupom por linha)
+    if request.mimetype == 'application/x-ndjson':
+        results = create_coupons_bulk(read_ndjson(request.stream))
+    else:
+        data = request.get_json()
+        # Gerando cupons com códigos aleatórios no servidor
+        if isinstance(data, dict) and 'generate' in data:
+            codes, error = generate_coupons_bulk(data.get('coupon'),
+                                                 data['generate'],
+                                                 length=data.get('code_length', 10),
+                                                 prefix=data.get('code_prefix', ''))
+            if error:
+                return jsonify({'error': error}), 400
+            return jsonify({'created': len(codes), 'codes': codes}), 201
+
+        # Recebendo os cupons como uma lista JSON
+        if not isinstance(data, list):
+            return jsonify({'error': 'Dados incompletos'}), 400
+        results = create_coupons_bulk(data)
+
+    created = sum(1 for result in results if result['status'] == 201)
+    return jsonify({'created': created, 'errors': len(results) - created, 'results': results}), 200
+
+
+# Verificando as regras do cupom para uma compra, exceto o número de usos, com o avaliador compilado do cupom.
+# categories são as categorias dos itens da compra e stacked a quantidade de outros cupons aplicados nela.
+# Retorna a mensagem de erro, ou None se o cupom for válido.
+def check_coupon(coupon, total_value, first_purchase, now, categories=None, stacked=0):
+    return evaluator_for(coupon).check(Purchase(to_cents(total_value), first_purchase, now, categories, stacked))
+
+
+# Calculando o valor do desconto de acordo com o tipo de desconto, em centavos, e retornando em reais
+def get_discount_value(coupon, total_value):
+    return from_cents(evaluator_for(coupon).discount_cents(to_cents(total_value)))
+
+
+# Lendo as categorias dos itens da compra (opcionais), usadas pelas regras dos cupons; retorna (categorias, erro)
+def read_categories(data):
+    categories = data.get('categories')
+    if categories is None:
+        return None, None
+    if not isinstance(categories, list) or not all(isinstance(category, str) for category in categories):
+        return None, 'Categorias inválidas'
+    return frozenset(categories), None
+
+
+# Lendo os códigos dos outros cupons já aplicados na compra (opcionais), sem repetições e sem o próprio
+# cupom consumido; retorna (códigos, erro)
+def read_applied_coupons(data, code):
+    applied_coupons = data.get('applied_coupons', [])
+    if (not isinstance(applied_coupons, list) or len(applied_coupons) > MAX_APPLIED_COUPONS
+            or not all(isinstance(applied, str) and applied for applied in applied_coupons)):
+        return None, 'Cupons aplicados inválidos'
+    return [applied for applied in dict.fromkeys(applied_coupons) if applied != code], None
+
+
+# Verificando se os cupons já aplicados na compra existem e podem ser acumulados com outro cupom.
+# coupons são os cupons aplicados, já buscados (None quando não encontrado), em uma lista ou em um gerador,
+# que é consumido somente até o primeiro erro. Retorna a mensagem de erro, ou None
+def check_applied_coupons(coupons):
+    for coupon in coupons:
+        if not coupon:
+            return 'Cupom aplicado não encontrado'
+        if not evaluator_for(coupon).stackable:
+            return 'Cupom aplicado não é cumulativo'
+    return None
+
+
+# Colunas carregadas na cotação: apenas o necessário para validar e calcular o desconto
+QUOTE_COLUMNS = (Coupon.id, Coupon.code, Coupon.expiration_date, Coupon.max_uses, Coupon.uses_count,
+                 Coupon.min_value_cents, Coupon.discount_type, Coupon.discount_amount_cents, Coupon.public,
+                 Coupon.first_purchase, Coupon.rules)
+
+
+# Carregando os cupons candidatos de uma cotação, sem criar objetos do ORM
+def load_quote_candidates(codes=None, now=None):
+    query = db.session.query(*QUOTE_COLUMNS)
+    # Sem códigos informados, considerando todos os cupons públicos ainda não expirados
+    if codes is None:
+        return query.filter(Coupon.public.is_(True), Coupon.expiration_date >= now).all()
+    rows = []
+    for start in range(0, len(codes), SQLITE_MAX_VARIABLES):
+        rows.extend(query.filter(Coupon.code.in_(codes[start:start + SQLITE_MAX_VARIABLES])).all())
+    return rows
+
+
+# Avaliando vários cupons para a mesma compra, sem consumir nenhum deles, com os mesmos avaliadores do consumo.
+# Retorna os descontos válidos, do maior para o menor, os cupons recusados com o motivo e a melhor combinação:
+# o melhor cupom sozinho ou a soma dos cupons cumulativos, limitada ao valor da compra.
+def quote_coupons(total_value, first_purchase, codes=None, categories=None):
+    now = datetime.now()
+    # Os códigos que certamente não estão cadastrados (pelo filtro de códigos) nem chegam ao banco
+    rows = load_quote_candidates([code for code in codes if code_may_exist(code)] if codes is not None else None, now)
+    purchase = Purchase(to_cents(total_value), first_purchase, now, categories)
+
+    quotes = []
+    rejected = []
+    stackable = []
+    for row in rows:
+        evaluator = evaluator_for(row)
+        error = evaluator.check(purchase)
+        if not error and row.uses_count >= row.max_uses:
+            error = 'Cupom esgotado'
+        if error:
+            rejected.append({'code': row.code, 'coupon_id': row.id, 'error': error})
+            continue
+        discount_cents = evaluator.discount_cents(purchase.total_cents)
+        quotes.append({'code': row.code, 'coupon_id': row.id, 'discount_value': from_cents(discount_cents)})
+        if evaluator.stackable:
+            stackable.append((row.code, discount_cents))
+
+    if codes is not None:
+        found = {row.code for row in rows}
+        rejected.extend({'code': code, 'coupon_id': None, 'error': 'Cupom não encontrado'}
+                        for code in dict.fromkeys(codes) if code not in found)
+
+    quotes.sort(key=lambda quote: quote['discount_value'], reverse=True)
+
+    combination = None
+    if quotes:
+        combination = {'codes': [quotes[0]['code']], 'discount_value': quotes[0]['discount_value']}
+        stacked_cents = min(sum(cents for _, cents in stackable), purchase.total_cents)
+        if len(stackable) > 1 and from_cents(stacked_cents) > combination['discount_value']:
+            stackable.sort(key=lambda item: item[1], reverse=True)
+            combination = {'codes': [code for code, _ in stackable], 'discount_value': from_cents(stacked_cents)}
+    return quotes, rejected, combination
+
+
+# Definindo o endpoint de cotação: calcula o desconto de vários cupons sem consumi-los
+@bp.route('/coupons/quote', methods=['POST'])
+def quote_cart():
+    # Obtendo os dados da compra e os cupons candidatos do corpo da requisição
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Dados incompletos'}), 400
+    total_value = data.get('total_value')
+    first_purchase = data.get('first_purchase')
+    codes = data.get('codes')
+
+    # Validando os dados da compra
+    if not total_value or first_purchase is None:
+        return jsonify({'error': 'Dados incompletos'}), 400
+
+    if not isinstance(total_value, (int, float)) or total_value <= 0:
+        return jsonify({'error': 'Valor inválido'}), 400
+
+    # Sem a lista de códigos, é preciso pedir explicitamente todos os cupons públicos
+    if codes is None and not data.get('all_public'):
+        return jsonify({'error': 'Dados incompletos'}), 400
+
+    if codes is not None and (not isinstance(codes, list) or not all(isinstance(code, str) for code in codes)):
+        return jsonify({'error': 'Dados incompletos'}), 400
+
+    categories, error = read_categories(data)
+    if error:
+        return jsonify({'error': error}), 400
+
+    quotes, rejected, combination = quote_coupons(total_value, first_purchase, codes, categories)
+    charge_misses(sum(1 for coupon in rejected if coupon['coupon_id'] is None))
+    return jsonify({'best': quotes[0] if quotes else None, 'best_combination': combination,
+                    'quotes': quotes, 'rejected': rejected}), 200
+
+
+# Colunas da listagem e da exportação, na ordem das colunas do CSV
+LIST_COLUMNS = (Coupon.id, Coupon.code, Coupon.expiration_date, Coupon.max_uses, Coupon.uses_count,
+                Coupon.min_value_cents, Coupon.discount_type, Coupon.discount_amount_cents, Coupon.public,
+                Coupon.first_purchase)
+EXPORT_FIELDS = ('id', 'code', 'expiration_date', 'max_uses', 'uses_count', 'min_value', 'discount_type',
+                 'discount_amount', 'public', 'first_purchase')
+
+# Valores aceitos nos filtros booleanos
+BOOLEAN_FILTERS = {'true': True, '1': True, 'false': False, '0': False}
+
+
+# Convertendo uma linha da listagem para o formato da API, com os valores em reais
+def coupon_row_to_dict(row):
+    return {'id': row.id,
+            'code': row.code,
+            'expiration_date': row.expiration_date.isoformat(),
+            'max_uses': row.max_uses,
+            'uses_count': row.uses_count,
+            'min_value': from_cents(row.min_value_cents),
+            'discount_type': row.discount_type,
+            'discount_amount': from_cents(row.discount_amount_cents),
+            'public': row.public,
+            'first_purchase': row.first_purchase}
+
+
+# Montando a consulta da listagem a partir dos filtros da query string; retorna (consulta, erro)
+def build_list_query(args, now):
+    query = db.session.query(*LIST_COLUMNS)
+
+    # status=active: não expirado e com usos disponíveis; status=expired: data de expiração já passou
+    status = args.get('status')
+    if status == 'active':
+        query = query.filter(Coupon.expiration_date >= now, Coupon.uses_count < Coupon.max_uses)
+    elif status == 'expired':
+        query = query.filter(Coupon.expiration_date < now)
+    elif status is not None:
+        return None, 'Filtro inválido'
+
+    for name, column in (('public', Coupon.public), ('first_purchase', Coupon.first_purchase)):
+        if name in args:
+            value = BOOLEAN_FILTERS.get(args[name].lower())
+            if value is None:
+                return None, 'Filtro inválido'
+            query = query.filter(column.is_(value))
+
+    if 'discount_type' in args:
+        if args['discount_type'] not in DISCOUNT_TYPES:
+            return None, 'Filtro inválido'
+        query = query.filter(Coupon.discount_type == args['discount_type'])
+
+    # Paginação por cursor: continua a partir do último id da página anterior, sem OFFSET
+    if 'after' in args:
+        try:
+            query = query.filter(Coupon.id > int(args['after']))
+        except ValueError:
+            return None, 'Filtro inválido'
+
+    return query.order_by(Coupon.id), None
+
+
+# Gerando as linhas da exportação, lidas do cursor aos poucos, em memória constante
+def export_rows(query, export_format):
+    rows = query.yield_per(current_app.config['EXPORT_BATCH_SIZE'])
+    if export_format == 'ndjson':
+        for row in rows:
+            yield json.dumps(coupon_row_to_dict(row), ensure_ascii=False) + '\n'
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        coupon = coupon_row_to_dict(row)
+        writer.writerow([coupon[field] for field in EXPORT_FIELDS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # A última linha (ou apenas o cabeçalho) ainda está no buffer
+    yield buffer.getvalue()
+
+
+# Definindo o endpoint de listagem dos cupons, com filtros, paginação por cursor e exportação em NDJSON ou CSV
+@bp.route('/coupons', methods=['GET'])
+def list_coupons():
+    query, error = build_list_query(request.args, datetime.now())
+    if error:
+        return jsonify({'error': error}), 400
+
+    # Exportação completa: a resposta é gerada enquanto as linhas são lidas do banco
+    export_format = request.args.get('format', 'json')
+    if export_format in ('ndjson', 'csv'):
+        mimetype = 'application/x-ndjson' if export_format == 'ndjson' else 'text/csv'
+        return Response(stream_with_context(export_rows(query, export_format)), mimetype=mimetype,
+                        headers={'Content-Disposition': f'attachment; filename=coupons.{export_format}'})
+    if export_format != 'json':
+        return jsonify({'error': 'Formato inválido'}), 400
+
+    try:
+        limit = int(request.args.get('limit', current_app.config['LIST_PAGE_SIZE']))
+    except ValueError:
+        return jsonify({'error': 'Filtro inválido'}), 400
+    if limit <= 0:
+        return jsonify({'error': 'Filtro inválido'}), 400
+    limit = min(limit, current_app.config['LIST_MAX_PAGE_SIZE'])
+
+    # Buscando uma linha a mais para saber se existe uma próxima página
+    rows = query.limit(limit + 1).all()
+    coupons = [coupon_row_to_dict(row) for row in rows[:limit]]
+    next_cursor = coupons[-1]['id'] if len(rows) > limit else None
+    return jsonify({'coupons': coupons, 'next_cursor': next_cursor}), 200
+
+
+# Montando a resposta de uma nova tentativa com a mesma Idempotency-Key, ou None se a chave não foi usada
+def replay_response(idempotency_key, code):
+    stored = find_response(db.session, idempotency_key, datetime.now())
+    if stored is None:
+        return None
+    stored_code, response = stored
+    if stored_code != code:
+        return jsonify({'error': 'Idempotency-Key usada em outro cupom'}), 422
+    return jsonify(response), 200, {'Idempotency-Replayed': 'true'}
+
+
+# A chave foi gravada por outra requisição, mas a resposta dela já expirou
+def idempotency_conflict():
+    return jsonify({'error': 'Idempotency-Key em uso'}), 409
+
+
 # Definindo o endpoint para consumo dos cupons
-@app.route('/coupons/<code>', methods=['POST'])
+@bp.route('/coupons/<code>', methods=['POST'])
 def use_coupon(code):
+    # Devolvendo a resposta gravada quando a requisição repete uma Idempotency-Key já usada,
+    # sem validar a compra novamente e sem tocar no cupom
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key is not None:
+        if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+            return jsonify({'error': 'Idempotency-Key inválida'}), 400
+        replay = replay_response(idempotency_key, code)
+        if replay:
+            return replay
+
     # Obtendo os dados da compra do corpo da requisição
     data = request.get_json()
     total_value = data.get('total_value')
     first_purchase = data.get('first_purchase')
+    customer_id = data.get('customer_id')
 
-    # Validando os dados da compra
-    if not total_value or first_purchase is None:
+    # Validando os dados da compra. Com o cliente identificado, a primeira compra é obtida do histórico
+    # dele no servidor, e o campo first_purchase da requisição é ignorado
+    if not total_value or (first_purchase is None and customer_id is None):
         return jsonify({'error': 'Dados incompletos'}), 400
 
     if total_value <= 0:
         return jsonify({'error': 'Valor inválido'}), 400
 
-    # Buscando o cupom pelo código
-    coupon = Coupon.query.filter_by(code=code).first()
+    if customer_id is not None and (not isinstance(customer_id, str) or not customer_id
+                                    or len(customer_id) > MAX_CUSTOMER_ID_LENGTH):
+        return jsonify({'error': 'Cliente inválido'}), 400
+
+    # Dados opcionais usados pelas regras dos cupons: categorias dos itens e códigos dos outros cupons
+    # já aplicados na mesma compra (um cupom não cumulativo é recusado se houver algum, e todos eles
+    # também precisam ser cumulativos)
+    categories, error = read_categories(data)
+    if error:
+        return jsonify({'error': error}), 400
+    applied_coupons, error = read_applied_coupons(data, code)
+    if error:
+        return jsonify({'error': error}), 400
+    stacked = len(applied_coupons)
+
+    # Buscando o cupom pelo código, passando primeiro pelo filtro de códigos e pelo cache
+    coupon = get_coupon_cache().get(code, load_coupon) if code_may_exist(code) else None
 
     # Verificando se o cupom existe
     if not coupon:
+        charge_misses(1)
         return jsonify({'error': 'Cupom não encontrado'}), 404
 
-    # Verificando se o cupom está expirado
-    if coupon.expiration_date < datetime.now():
-        return jsonify({'error': 'Cupom expirado'}), 400
+    # Um cupom com limite por cliente só pode ser usado por um cliente identificado
+    if coupon.max_uses_per_customer is not None and customer_id is None:
+        return jsonify({'error': 'Cliente não informado'}), 400
 
-    # Verificando se o cupom atingiu o número máximo de usos
-    if len(coupon.uses) >= coupon.max_uses:
-        return jsonify({'error': 'Cupom esgotado'}), 400
+    # Verificando se o cupom é válido para a compra. O histórico do cliente é verificado pelo backend dos
+    # contadores na própria reserva (ver counters.py), e aqui apenas as demais regras
+    now = datetime.now()
+    backend = current_app.config['COUNTER_BACKEND']
+    # O cupom depende da primeira compra quando é exclusivo para ela (inclusive o tipo 'primeira')
+    # ou não é destinado ao público geral
+    first_purchase_only = evaluator_for(coupon).first_purchase_only
+    error = check_coupon(coupon, total_value, True if customer_id is not None else first_purchase, now, categories,
+                         stacked)
+    if not error and applied_coupons:
+        # Buscando os cupons aplicados pelo mesmo cache do consumo
+        error = check_applied_coupons(get_coupon_cache().get(applied, load_coupon) if code_may_exist(applied) else None
+                                      for applied in applied_coupons)
+    if error:
+        return jsonify({'error': error}), 400
 
-    # Verificando se o valor da compra é maior que o valor mínimo do cupom
-    if total_value < coupon.min_value:
-        return jsonify({'error': 'Valor mínimo não atingido'}), 400
+    # Calculando o valor do desconto de acordo com o tipo de desconto
+    discount_value = get_discount_value(coupon, total_value)
+    response = {'discount_value': discount_value, 'coupon_id': coupon.id}
+    expires_at = now + timedelta(seconds=current_app.config['IDEMPOTENCY_KEY_TTL'])
 
-    # Verificando se o cupom é destinado ao público geral ou à primeira compra
-    if not coupon.public and not first_purchase:
-        return jsonify({'error': 'Cupom não é destinado ao público geral'}), 400
+    # Escolhendo a mensagem de uma reserva recusada: o cupom pode estar esgotado ou o cliente não poder usá-lo.
+    # Com memory e redis, o histórico do cliente vem do backend, que inclui os usos ainda não reconciliados
+    def exhausted():
+        error = None
+        if customer_id is not None:
+            history = (get_counter_backend().customer_history(coupon.id, customer_id)
+                       or load_customer_history(coupon.id, customer_id))
+            error = check_customer(coupon, total_value, *history, now, categories, stacked)
+        return jsonify({'error': error or 'Cupom esgotado'}), 400
 
-    if coupon.first_purchase and not first_purchase:
-        return jsonify({'error': 'Cupom é válido apenas para a primeira compra'}), 400
+    # No modo de commit em grupo (backend sql), a reserva e o registro do uso são gravados no próximo lote
+    if current_app.config['REDEMPTION_GROUP_COMMIT'] and backend == 'sql':
+        from group_commit import EXHAUSTED, REPLAYED
+        idempotency = (idempotency_key, code, response, expires_at) if idempotency_key else None
+        customer = (customer_id, first_purchase_only) if customer_id is not None else None
+        result = get_redemption_log().redeem(coupon.id, now, idempotency, customer)
+        if result == REPLAYED:
+            return replay_response(idempotency_key, code) or idempotency_conflict()
+        if result == EXHAUSTED:
+            return exhausted()
+        if customer_id is not None:
+            remember_customer(customer_id)
+        return jsonify(response), 200
 
-    # Calculando o valor do desconto de acordo com o tipo de desconto
-    if coupon.discount_type == 'percentual':
-        discount_value = total_value * coupon.discount_amount / 100
-    else:
-        discount_value = coupon.discount_amount
+    # Gravando a resposta pela chave de idempotência na mesma transação do uso. Se outra tentativa
+    # com a mesma chave concluiu o consumo antes, a inserção falha e a resposta dela é devolvida
+    if idempotency_key:
+        try:
+            store_response(db.session, idempotency_key, code, response, now, expires_at)
+        except IntegrityError:
+            db.session.rollback()
+            return replay_response(idempotency_key, code) or idempotency_conflict()
 
-    # Criando o objeto do uso do cupom e salvando no banco de dados
-    use = Use(coupon_id=coupon.id, use_date=datetime.now())
+    # Reservando um uso no backend dos contadores. Com o backend sql, a reserva é um único UPDATE condicional,
+    # seguro entre vários processos/workers, e o uso é registrado na mesma transação.
+    # O número de usos é sempre verificado no backend, e não no cache
+    counters = get_counter_backend()
+    if not counters.reserve(coupon.id, now, customer_id, first_purchase_only):
+        db.session.rollback()
+        return exhausted()
 
-    db.session.add(use)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except Exception:
+        counters.release(coupon.id, now, customer_id)
+        raise
+
+    if customer_id is not None:
+        remember_customer(customer_id)
 
     # Retornando uma resposta de sucesso com os dados do cupom usado
-    return jsonify({'discount_value': discount_value, 'coupon_id': coupon.id}), 200
+    return jsonify(response), 200
+
+
+# Definindo o endpoint que registra no histórico do cliente pedidos feitos sem cupom,
+# para que a primeira compra seja verificada no servidor
+@bp.route('/customers/<customer_id>/orders', methods=['POST'])
+def create_customer_order(customer_id):
+    if len(customer_id) > MAX_CUSTOMER_ID_LENGTH:
+        return jsonify({'error': 'Cliente inválido'}), 400
+
+    # Quantidade de pedidos registrados (1 por padrão)
+    data = request.get_json(silent=True) or {}
+    count = data.get('count', 1) if isinstance(data, dict) else None
+    if not isinstance(count, int) or isinstance(count, bool) or count <= 0:
+        return jsonify({'error': 'Valores inválidos'}), 400
+
+    add_orders(db.session, customer_id, count, datetime.now())
+    db.session.commit()
+    remember_customer(customer_id)
+    # Com memory e redis, somando os pedidos também aos contadores dos clientes já carregados no backend
+    get_counter_backend().add_orders(customer_id, count)
+
+    customer = db.session.get(Customer, customer_id)
+    return jsonify({'customer_id': customer.customer_id, 'orders_count': customer.orders_count}), 201
+
+
+# Aplicação com a configuração padrão, usada pelo servidor (por exemplo, gunicorn app:app) e pelos módulos
+# que importam este arquivo. Criá-la não acessa o banco; outras instâncias podem ser criadas com create_app.
+app = create_app()
 
 
 # Executando a aplicação Flask
 if __name__ == '__main__':
+    with app.app_context():
+        # Criando ou atualizando o esquema do banco antes de iniciar o servidor
+        upgrade(db.engine)
+        if app.config['ARCHIVE_SWEEP_INTERVAL']:
+            start_sweeper()
+        if app.config['IDEMPOTENCY_PURGE_INTERVAL']:
+            start_idempotency_purger()
     app.run(debug=True, port=5000)
@@ -1,67 +1,83 @@
 # Importando as bibliotecas necessárias
-from flask import Flask, request, jsonify
-from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+import os
+from flask import Blueprint, Flask, current_app, request, jsonify
+from datetime import datetime, timedelta
+from models import db, Coupon
+from money import to_cents, from_cents
+from rules import Purchase, evaluator_for
+from counters import reserve_in_database
+from app import check_applied_coupons, read_applied_coupons, read_categories
+from coupon_cache import CouponCache, snapshot
+from sqlite_profile import configure_sqlite
+from metrics import install_metrics
+from migrations import upgrade
+from idempotency import MAX_KEY_LENGTH, find_response, store_response
+from sqlalchemy.exc import IntegrityError
 
-# Criando a aplicação Flask
-app = Flask(__name__)
+# Rotas da API, registradas em cada aplicação criada por create_app
+bp = Blueprint('coupons', __name__)
 
-# Configurando a conexão com o banco de dados SQLite
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///coupons.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+# Criando a aplicação Flask com a configuração padrão, sobrescrita por `config`. A engine do banco
+# só é criada no primeiro acesso, e o esquema é criado pelas migrações (migrations.py)
+def create_app(config=None):
+    app = Flask(__name__)
+    # Configurando a conexão com o banco de dados SQLite
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///coupons.db'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Perfil de ajustes do SQLite (WAL, busy timeout, pool de conexões), escolhido pela variável SQLITE_PROFILE
+    app.config['SQLITE_PROFILE'] = os.environ.get('SQLITE_PROFILE', 'production')
+    # Configurando o cache de cupons mais consultados (tamanho máximo e validade em segundos)
+    app.config['COUPON_CACHE_SIZE'] = 1024
+    app.config['COUPON_CACHE_TTL'] = 60
+    app.config['COUPON_CACHE_NEGATIVE_TTL'] = 5
+    # Configurando as métricas (GET /metrics) e o profiler opcional das requisições mais lentas (GET /metrics/slowest),
+    # que executa com o cProfile a fração METRICS_PROFILE_SAMPLE_RATE das requisições
+    app.config['METRICS_PROFILE_SAMPLE_RATE'] = float(os.environ.get('METRICS_PROFILE_SAMPLE_RATE', 0))
+    app.config['METRICS_PROFILE_KEEP'] = 10
+    # Tempo (em segundos) em que a resposta de um consumo fica guardada pela Idempotency-Key
+    app.config['IDEMPOTENCY_KEY_TTL'] = 24 * 60 * 60
+    # Aplicando a configuração desta instância
+    app.config.update(config or {})
+    # Montando as opções da engine pelo perfil e pela URI finais; opções passadas em `config` têm prioridade
+    configure_sqlite(app, app.config['SQLITE_PROFILE'])
+    if config and 'SQLALCHEMY_ENGINE_OPTIONS' in config:
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = config['SQLALCHEMY_ENGINE_OPTIONS']
+    db.init_app(app)
+    app.extensions['coupon_cache'] = CouponCache(max_size=app.config['COUPON_CACHE_SIZE'],
+                                                 ttl=app.config['COUPON_CACHE_TTL'],
+                                                 negative_ttl=app.config['COUPON_CACHE_NEGATIVE_TTL'])
+    install_metrics(app)
+    app.register_blueprint(bp)
+    return app
 
-# Definindo a classe Coupon que representa a tabela de cupons no banco de dados
-class Coupon(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    code = db.Column(db.String(20), unique=True, nullable=False)
-    expiration_date = db.Column(db.DateTime, nullable=False)
-    max_uses = db.Column(db.Integer, nullable=False)
-    min_value = db.Column(db.Float, nullable=False)
-    discount_type = db.Column(db.String(10), nullable=False)
-    discount_amount = db.Column(db.Float, nullable=False)
-    public = db.Column(db.Boolean, nullable=False)
-    first_purchase = db.Column(db.Boolean, nullable=False)
+# Função para validar se um cupom é válido para uma compra, com o avaliador compilado do cupom (ver rules.py).
+# categories são as categorias dos itens da compra e stacked a quantidade de outros cupons aplicados nela
+def is_valid(coupon, total_value, first_purchase, categories=None, stacked=0):
+    # O limite de usos não é verificado aqui: ele é garantido pelo UPDATE condicional em use_coupon
+    error = evaluator_for(coupon).check(Purchase(to_cents(total_value), first_purchase, datetime.now(), categories, stacked))
+    return error is None, error
 
-    def __repr__(self):
-        return f"<Coupon {self.code}>"
+# Função para calcular o valor do desconto de um cupom para uma compra, de acordo com o tipo de desconto
+def get_discount_value(coupon, total_value):
+    return from_cents(evaluator_for(coupon).discount_cents(to_cents(total_value)))
 
-    # Método para validar se um cupom é válido para uma compra
-    def is_valid(self, total_value, first_purchase):
-        # Verificar se o cupom não está expirado
-        if self.expiration_date < datetime.now():
-            return False, "Cupom expirado"
-        # Verificar se o cupom não está esgotado
-        if self.max_uses <= 0:
-            return False, "Cupom esgotado"
-        # Verificar se o valor da compra atinge o valor mínimo do cupom
-        if total_value < self.min_value:
-            return False, "Valor mínimo não atingido"
-        # Verificar se o cupom é destinado ao público geral ou à primeira compra
-        if not self.public and not first_purchase:
-            return False, "Cupom não é destinado ao público geral"
-        if self.first_purchase and not first_purchase:
-            return False, "Cupom é válido apenas para a primeira compra"
-        # Se passar por todas as verificações, o cupom é válido
-        return True, None
+# Montar a resposta de uma nova tentativa com a mesma Idempotency-Key, ou None se a chave não foi usada
+def replay_response(idempotency_key, code):
+    stored = find_response(db.session, idempotency_key, datetime.now())
+    if stored is None:
+        return None
+    stored_code, response = stored
+    if stored_code != code:
+        return jsonify({'error': 'Idempotency-Key usada em outro cupom'}), 422
+    return jsonify(response), 200, {'Idempotency-Replayed': 'true'}
 
-    # Método para calcular o valor do desconto de um cupom para uma compra
-    def get_discount_value(self, total_value):
-        # Se o tipo de desconto é percentual, calcular o valor proporcional ao valor da compra
-        if self.discount_type == "percentual":
-            return total_value * (self.discount_amount / 100)
-        # Se o tipo de desconto é fixo, retornar o valor do desconto
-        elif self.discount_type == "fixo":
-            return self.discount_amount
-        # Se o tipo de desconto é inválido, retornar zero
-        else:
-            return 0
-
-# Criando as tabelas no banco de dados SQLite
-db.create_all()
+# Carregando do banco uma cópia do cupom, desvinculada da sessão, apenas com os atributos imutáveis
+def load_coupon(code):
+    coupon = Coupon.query.filter_by(code=code).first()
+    return snapshot(coupon) if coupon else None
 
 # Definindo o endpoint para cadastro de cupons
-@app.route('/coupons', methods=['POST'])
+@bp.route('/coupons', methods=['POST'])
 def create_coupon():
     # Obter os dados do cupom do corpo da requisição
     data = request.get_json()
@@ -93,34 +109,87 @@ def create_coupon():
     # Adicionar o cupom no banco de dados
     db.session.add(coupon)
     db.session.commit()
+    # Remover o código do cache, que pode ter guardado a ausência do cupom
+    current_app.extensions['coupon_cache'].invalidate(coupon.code)
     # Retornar uma resposta com o cupom criado
-    return jsonify(coupon.__dict__), 201
+    return jsonify({'id': coupon.id,
+                    'code': coupon.code,
+                    'expiration_date': coupon.expiration_date.isoformat(),
+                    'max_uses': coupon.max_uses,
+                    'min_value': coupon.min_value,
+                    'discount_type': coupon.discount_type,
+                    'discount_amount': coupon.discount_amount,
+                    'public': coupon.public,
+                    'first_purchase': coupon.first_purchase}), 201
 
 # Definindo o endpoint para consumo dos cupons
-@app.route('/coupons/<code>', methods=['POST'])
+@bp.route('/coupons/<code>', methods=['POST'])
 def use_coupon(code):
+    # Devolver a resposta gravada quando a requisição repete uma Idempotency-Key já usada, sem tocar no cupom
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key is not None:
+        if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+            return jsonify({'error': 'Idempotency-Key inválida'}), 400
+        replay = replay_response(idempotency_key, code)
+        if replay:
+            return replay
     # Obter os dados da compra do corpo da requisição
     data = request.get_json()
     # Validar se os dados estão completos
     if not data or not all(key in data for key in ['total_value', 'first_purchase']):
         return jsonify({'error': 'Dados incompletos'}), 400
-    # Buscar o cupom pelo código no banco de dados
-    coupon = Coupon.query.filter_by(code=code).first()
+    # Ler as categorias dos itens e os outros cupons aplicados na compra, usados pelas regras como em app.py
+    categories, error = read_categories(data)
+    if error:
+        return jsonify({'error': error}), 400
+    applied_coupons, error = read_applied_coupons(data, code)
+    if error:
+        return jsonify({'error': error}), 400
+    # Buscar o cupom pelo código, passando primeiro pelo cache
+    coupon_cache = current_app.extensions['coupon_cache']
+    coupon = coupon_cache.get(code, load_coupon)
     # Validar se o cupom existe
     if not coupon:
         return jsonify({'error': 'Cupom não encontrado'}), 404
+    # Recusar cupons com limite por cliente (cadastrados por app.py), que esta versão não verifica
+    if coupon.max_uses_per_customer is not None:
+        return jsonify({'error': 'Limite por cliente não suportado'}), 400
     # Validar se o cupom é válido para a compra
-    valid, error = coupon.is_valid(data['total_value'], data['first_purchase'])
+    valid, error = is_valid(coupon, data['total_value'], data['first_purchase'], categories, len(applied_coupons))
+    # Os cupons já aplicados na compra também precisam existir e ser cumulativos
+    if valid and applied_coupons:
+        error = check_applied_coupons(coupon_cache.get(applied, load_coupon) for applied in applied_coupons)
+        valid = error is None
     if not valid:
         return jsonify({'error': error}), 400
     # Calcular o valor do desconto do cupom para a compra
-    discount_value = coupon.get_discount_value(data['total_value'])
-    # Atualizar o número de usos do cupom no banco de dados
-    coupon.max_uses -= 1
+    discount_value = get_discount_value(coupon, data['total_value'])
+    response = {'discount_value': discount_value, 'coupon_id': coupon.id}
+    # Gravar a resposta pela chave de idempotência na mesma transação do consumo; se outra tentativa
+    # com a mesma chave já concluiu o consumo, a inserção falha e a resposta dela é devolvida
+    if idempotency_key:
+        now = datetime.now()
+        try:
+            store_response(db.session, idempotency_key, code, response, now,
+                           now + timedelta(seconds=current_app.config['IDEMPOTENCY_KEY_TTL']))
+        except IntegrityError:
+            db.session.rollback()
+            return replay_response(idempotency_key, code) or (jsonify({'error': 'Idempotency-Key em uso'}), 409)
+    # Reservar um uso com o mesmo UPDATE condicional de app.py (uses_count < max_uses) e registrar o uso
+    # na mesma transação, evitando que consumos concorrentes, por app.py ou por app2.py, ultrapassem o limite
+    if not reserve_in_database(db.session, coupon.id, datetime.now()):
+        db.session.rollback()
+        return jsonify({'error': 'Cupom esgotado'}), 400
     db.session.commit()
     # Retornar uma resposta com o valor do desconto e o id do cupom usado
-    return jsonify({'discount_value': discount_value, 'coupon_id': coupon.id}), 200
+    return jsonify(response), 200
+
+# Aplicação com a configuração padrão, usada pelo servidor; criá-la não acessa o banco
+app = create_app()
 
 # Rodar a aplicação Flask na porta 5000
 if __name__ == '__main__':
+    # Criando ou atualizando o esquema do banco antes de iniciar o servidor
+    with app.app_context():
+        upgrade(db.engine)
     app.run(port=5000)
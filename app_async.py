@@ -0,0 +1,341 @@
+# Versão assíncrona (asyncio) da API de cupons, com o mesmo contrato de app.py:
+#     POST /coupons          cadastro de cupons
+#     POST /coupons/<code>   consumo de cupons
+# Usa Quart (API compatível com o Flask) e aiosqlite, com um pool limitado de conexões,
+# permitindo que um único processo mantenha milhares de requisições em andamento.
+#
+# Executando: python app_async.py, ou hypercorn app_async:app --bind 127.0.0.1:5000
+
+# Importando as bibliotecas necessárias
+import asyncio
+import json
+import os
+import sqlite3
+from contextlib import asynccontextmanager, closing
+from datetime import datetime, timedelta
+
+import aiosqlite
+from quart import Quart, request, jsonify
+
+from app import (MAX_CUSTOMER_ID_LENGTH, check_applied_coupons, check_coupon, check_customer, get_discount_value,
+                 read_applied_coupons, read_categories, validate_coupon)
+from counters import ADD_ORDERS_SQL, CUSTOMER_HISTORY_SQL, INSERT_USE_SQL, RESERVE_FOR_CUSTOMER_SQL, RESERVE_SQL
+from coupon_cache import CouponCache, CachedCoupon
+from idempotency import DELETE_EXPIRED_KEY_SQL, FIND_SQL, INSERT_SQL, MAX_KEY_LENGTH, key_digest
+from migrations import upgrade_connection
+from money import from_cents
+from rules import evaluator_for
+from sqlite_profile import PROFILES
+
+# Criando a aplicação Quart
+app = Quart(__name__)
+
+# Configurando o banco de dados, o perfil do SQLite e o tamanho do pool de conexões
+app.config['DATABASE_PATH'] = os.environ.get('COUPONS_DATABASE', 'coupons.db')
+app.config['SQLITE_PROFILE'] = os.environ.get('SQLITE_PROFILE', 'production')
+app.config['DATABASE_POOL_SIZE'] = 8
+
+# Configurando o cache de cupons mais consultados, como em app.py
+app.config['COUPON_CACHE_SIZE'] = 1024
+app.config['COUPON_CACHE_TTL'] = 60
+app.config['COUPON_CACHE_NEGATIVE_TTL'] = 5
+coupon_cache = CouponCache(max_size=app.config['COUPON_CACHE_SIZE'],
+                           ttl=app.config['COUPON_CACHE_TTL'],
+                           negative_ttl=app.config['COUPON_CACHE_NEGATIVE_TTL'])
+
+# Configurando o tempo (em segundos) em que a resposta de um consumo fica guardada pela Idempotency-Key, como em app.py
+app.config['IDEMPOTENCY_KEY_TTL'] = 24 * 60 * 60
+
+# Formato de data usado pelo SQLAlchemy nas colunas DateTime do SQLite
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+# Pool limitado de conexões aiosqlite: as requisições esperam por uma conexão livre
+class ConnectionPool:
+
+    def __init__(self, path, size, pragmas):
+        self.path = path
+        self.size = size
+        self.pragmas = pragmas
+        self._connections = asyncio.Queue()
+        self._created = 0
+        self._lock = asyncio.Lock()
+
+    async def _connect(self):
+        connection = await aiosqlite.connect(self.path)
+        for name, value in self.pragmas.items():
+            await connection.execute(f'PRAGMA {name}={value}')
+        return connection
+
+    @asynccontextmanager
+    async def connection(self):
+        # Abrindo uma nova conexão enquanto o pool não atingiu o tamanho máximo
+        async with self._lock:
+            if self._connections.empty() and self._created < self.size:
+                self._created += 1
+                await self._connections.put(await self._connect())
+        connection = await self._connections.get()
+        try:
+            yield connection
+        finally:
+            # Desfazendo o que a requisição deixou sem commit (por exemplo, depois de uma exceção), para que a
+            # próxima requisição nesta conexão não confirme gravações de outra, como uma chave de idempotência
+            try:
+                if connection.in_transaction:
+                    await connection.rollback()
+            finally:
+                await self._connections.put(connection)
+
+    async def close(self):
+        while not self._connections.empty():
+            await (await self._connections.get()).close()
+        self._created = 0
+
+
+pool = None
+
+
+# Criando o pool ao iniciar o servidor, com a configuração atual da aplicação
+@app.before_serving
+async def open_pool():
+    global pool
+    pool = ConnectionPool(app.config['DATABASE_PATH'],
+                          app.config['DATABASE_POOL_SIZE'],
+                          PROFILES[app.config['SQLITE_PROFILE']])
+
+
+@app.after_serving
+async def close_pool():
+    await pool.close()
+
+
+# Carregando do banco os atributos imutáveis de um cupom, no mesmo formato do cache de app.py
+async def load_coupon(connection, code):
+    cursor = await connection.execute('SELECT id, code, expiration_date, min_value_cents, discount_type, '
+                                      'discount_amount_cents, public, first_purchase, max_uses_per_customer, rules '
+                                      'FROM coupon WHERE code = ?',
+                                      (code,))
+    row = await cursor.fetchone()
+    await cursor.close()
+    if row is None:
+        return None
+    return CachedCoupon(id=row[0],
+                        code=row[1],
+                        expiration_date=datetime.fromisoformat(row[2]),
+                        min_value_cents=int(row[3]),
+                        discount_type=row[4],
+                        discount_amount_cents=int(row[5]),
+                        public=bool(row[6]),
+                        first_purchase=bool(row[7]),
+                        max_uses_per_customer=row[8],
+                        rules=row[9])
+
+
+# Buscando um cupom pelo código, passando primeiro pelo cache
+async def find_coupon(connection, code):
+    found, coupon = coupon_cache.lookup(code)
+    if not found:
+        coupon = await load_coupon(connection, code)
+        coupon_cache.put(code, coupon)
+    return coupon
+
+
+# Reservando um uso e registrando-o na transação da conexão, com as mesmas instruções de counters.py:
+# com o cliente identificado, o limite por cliente e a primeira compra são verificados no próprio UPDATE
+async def reserve(connection, coupon_id, use_date, customer_id=None, first_purchase_only=False):
+    if customer_id is None:
+        cursor = await connection.execute(RESERVE_SQL.text, {'coupon_id': coupon_id})
+    else:
+        cursor = await connection.execute(RESERVE_FOR_CUSTOMER_SQL.text,
+                                          {'coupon_id': coupon_id, 'customer_id': customer_id,
+                                           'first_purchase_only': first_purchase_only})
+    if cursor.rowcount != 1:
+        return False
+    await connection.execute(INSERT_USE_SQL.text, {'coupon_id': coupon_id, 'use_date': use_date.strftime(DATETIME_FORMAT),
+                                                   'customer_id': customer_id})
+    if customer_id is not None:
+        await connection.execute(ADD_ORDERS_SQL.text, {'customer_id': customer_id, 'count': 1,
+                                                       'order_date': use_date.strftime(DATETIME_FORMAT)})
+    return True
+
+
+# Lendo o histórico do cliente para o cupom: (pedidos anteriores, usos do cupom pelo cliente)
+async def load_customer_history(connection, coupon_id, customer_id):
+    cursor = await connection.execute(CUSTOMER_HISTORY_SQL.text, {'coupon_id': coupon_id, 'customer_id': customer_id})
+    orders_count, customer_uses = await cursor.fetchone()
+    await cursor.close()
+    return orders_count or 0, customer_uses
+
+
+# Montando a resposta de uma nova tentativa com a mesma Idempotency-Key, ou None se a chave não foi usada,
+# com as mesmas instruções de idempotency.py
+async def replay_response(connection, idempotency_key, code):
+    cursor = await connection.execute(FIND_SQL.text, {'key': key_digest(idempotency_key),
+                                                      'now': datetime.now().strftime(DATETIME_FORMAT)})
+    row = await cursor.fetchone()
+    await cursor.close()
+    if row is None:
+        return None
+    stored_code, response = row
+    if stored_code != code:
+        return jsonify({'error': 'Idempotency-Key usada em outro cupom'}), 422
+    return jsonify(json.loads(response)), 200, {'Idempotency-Replayed': 'true'}
+
+
+# Gravando a resposta de um consumo pela chave, na transação atual; falha com IntegrityError se a chave já foi usada
+async def store_response(connection, idempotency_key, code, response, now):
+    digest = key_digest(idempotency_key)
+    expires_at = now + timedelta(seconds=app.config['IDEMPOTENCY_KEY_TTL'])
+    await connection.execute(DELETE_EXPIRED_KEY_SQL.text, {'key': digest, 'now': now.strftime(DATETIME_FORMAT)})
+    await connection.execute(INSERT_SQL.text, {'key': digest, 'code': code, 'response': json.dumps(response),
+                                               'expires_at': expires_at.strftime(DATETIME_FORMAT)})
+
+
+# Definindo o endpoint para cadastro de cupons
+@app.route('/coupons', methods=['POST'])
+async def create_coupon():
+    # Obtendo os dados do cupom do corpo da requisição
+    data = await request.get_json()
+
+    async with pool.connection() as connection:
+        # Verificando antes da validação se o código já existe, pois validate_coupon é síncrona
+        exists = False
+        if isinstance(data, dict) and isinstance(data.get('code'), str):
+            cursor = await connection.execute('SELECT 1 FROM coupon WHERE code = ?', (data['code'],))
+            exists = await cursor.fetchone() is not None
+            await cursor.close()
+
+        # Validando os dados do cupom com as mesmas regras de app.py
+        values, error = validate_coupon(data, lambda code: exists)
+        if error:
+            return jsonify({'error': error}), 400
+
+        # Salvando o cupom no banco de dados
+        try:
+            cursor = await connection.execute(
+                'INSERT INTO coupon (code, expiration_date, max_uses, min_value_cents, discount_type, '
+                'discount_amount_cents, public, first_purchase, max_uses_per_customer, rules, uses_count) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)',
+                (values['code'], values['expiration_date'].strftime(DATETIME_FORMAT), values['max_uses'],
+                 values['min_value_cents'], values['discount_type'], values['discount_amount_cents'],
+                 values['public'], values['first_purchase'], values['max_uses_per_customer'], values['rules']))
+            await connection.commit()
+        except sqlite3.IntegrityError:
+            # Outro cadastro com o mesmo código entre a verificação e a inserção
+            await connection.rollback()
+            return jsonify({'error': 'Código já existe'}), 400
+        coupon_id = cursor.lastrowid
+
+    # Removendo o código do cache, que pode ter guardado a ausência do cupom
+    coupon_cache.invalidate(values['code'])
+
+    # Retornando uma resposta de sucesso com os dados do cupom criado
+    return jsonify({'id': coupon_id,
+                    'code': values['code'],
+                    'expiration_date': values['expiration_date'].isoformat(),
+                    'max_uses': values['max_uses'],
+                    'min_value': from_cents(values['min_value_cents']),
+                    'discount_type': values['discount_type'],
+                    'discount_amount': from_cents(values['discount_amount_cents']),
+                    'public': values['public'],
+                    'first_purchase': values['first_purchase'],
+                    'max_uses_per_customer': values['max_uses_per_customer'],
+                    'rules': json.loads(values['rules']) if values['rules'] else None}), 201
+
+
+# Definindo o endpoint para consumo dos cupons
+@app.route('/coupons/<code>', methods=['POST'])
+async def use_coupon(code):
+    # Validando a Idempotency-Key, cuja resposta gravada é devolvida sem validar a compra novamente
+    idempotency_key = request.headers.get('Idempotency-Key')
+    if idempotency_key is not None:
+        if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+            return jsonify({'error': 'Idempotency-Key inválida'}), 400
+        async with pool.connection() as connection:
+            replay = await replay_response(connection, idempotency_key, code)
+        if replay:
+            return replay
+
+    # Obtendo os dados da compra do corpo da requisição
+    data = await request.get_json()
+    total_value = data.get('total_value')
+    first_purchase = data.get('first_purchase')
+    customer_id = data.get('customer_id')
+
+    # Validando os dados da compra. Com o cliente identificado, a primeira compra é obtida do histórico
+    # dele, como em app.py, e o campo first_purchase da requisição é ignorado
+    if not total_value or (first_purchase is None and customer_id is None):
+        return jsonify({'error': 'Dados incompletos'}), 400
+
+    if total_value <= 0:
+        return jsonify({'error': 'Valor inválido'}), 400
+
+    if customer_id is not None and (not isinstance(customer_id, str) or not customer_id
+                                    or len(customer_id) > MAX_CUSTOMER_ID_LENGTH):
+        return jsonify({'error': 'Cliente inválido'}), 400
+
+    # Dados opcionais usados pelas regras dos cupons, como em app.py: categorias dos itens e códigos dos outros
+    # cupons já aplicados na mesma compra
+    categories, error = read_categories(data)
+    if error:
+        return jsonify({'error': error}), 400
+    applied_coupons, error = read_applied_coupons(data, code)
+    if error:
+        return jsonify({'error': error}), 400
+
+    async with pool.connection() as connection:
+        # Buscando o cupom pelo código, passando primeiro pelo cache
+        coupon = await find_coupon(connection, code)
+
+        # Verificando se o cupom existe
+        if not coupon:
+            return jsonify({'error': 'Cupom não encontrado'}), 404
+
+        # Um cupom com limite por cliente só pode ser usado por um cliente identificado
+        if coupon.max_uses_per_customer is not None and customer_id is None:
+            return jsonify({'error': 'Cliente não informado'}), 400
+
+        # Verificando se o cupom é válido para a compra, com as mesmas regras de app.py. O histórico do cliente
+        # é verificado no UPDATE da reserva, como no backend sql de app.py
+        now = datetime.now()
+        error = check_coupon(coupon, total_value, True if customer_id is not None else first_purchase, now, categories,
+                             len(applied_coupons))
+        # Os cupons já aplicados na compra também precisam existir e ser cumulativos
+        if not error and applied_coupons:
+            error = check_applied_coupons([await find_coupon(connection, applied) for applied in applied_coupons])
+        if error:
+            return jsonify({'error': error}), 400
+
+        response = {'discount_value': get_discount_value(coupon, total_value), 'coupon_id': coupon.id}
+
+        # Gravando a resposta pela chave de idempotência na mesma transação do uso. Se outra tentativa
+        # com a mesma chave concluiu o consumo antes, a inserção falha e a resposta dela é devolvida
+        if idempotency_key:
+            try:
+                await store_response(connection, idempotency_key, code, response, now)
+            except sqlite3.IntegrityError:
+                await connection.rollback()
+                return (await replay_response(connection, idempotency_key, code)
+                        or (jsonify({'error': 'Idempotency-Key em uso'}), 409))
+
+        # Reservando um uso com um único UPDATE condicional e registrando o uso na mesma transação
+        if not await reserve(connection, coupon.id, now, customer_id, evaluator_for(coupon).first_purchase_only):
+            await connection.rollback()
+            error = None
+            # Escolhendo a mensagem: o cupom pode estar esgotado ou o cliente não poder usá-lo
+            if customer_id is not None:
+                history = await load_customer_history(connection, coupon.id, customer_id)
+                error = check_customer(coupon, total_value, *history, now, categories, len(applied_coupons))
+            return jsonify({'error': error or 'Cupom esgotado'}), 400
+        await connection.commit()
+
+    # Retornando uma resposta de sucesso com os dados do cupom usado
+    return jsonify(response), 200
+
+
+# Executando a aplicação Quart
+if __name__ == '__main__':
+    # Criando ou atualizando o esquema do banco antes de iniciar o servidor
+    with closing(sqlite3.connect(app.config['DATABASE_PATH'])) as connection:
+        upgrade_connection(connection)
+    app.run(port=5000)
@@ -0,0 +1,181 @@
+# Versão da API de cupons com os dados particionados em vários arquivos SQLite, com o mesmo contrato de app.py:
+#     POST /coupons          cadastro de cupons
+#     POST /coupons/<code>   consumo de cupons
+# Cada cupom e os seus usos ficam no shard escolhido pelo hash do código (sharding.py). Como o código
+# sempre leva ao mesmo shard, a restrição UNIQUE de cada arquivo garante a unicidade em todos eles,
+# e os consumos de cupons em shards diferentes não disputam o mesmo lock de escrita.
+# O id retornado é único apenas dentro do shard; o código continua sendo o identificador do cupom.
+#
+# Executando: COUPON_SHARDS=4 python app_sharded.py
+
+# Importando as bibliotecas necessárias
+import os
+from datetime import datetime
+
+from flask import Blueprint, Flask, current_app, request, jsonify
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from app import validate_coupon, check_coupon, get_discount_value
+from models import Coupon, Use
+from coupon_cache import CouponCache, snapshot
+from metrics import install_metrics
+from money import from_cents
+from sharding import ShardedStore, shard_paths
+
+# Blueprint com os endpoints, registrado em cada aplicação criada por create_app
+bp = Blueprint('coupons', __name__)
+
+# Tabelas do modelo de app.py, usadas com as engines dos shards
+coupon_table = Coupon.__table__
+use_table = Use.__table__
+
+
+# Criando a aplicação Flask, com a configuração padrão sobrescrita por `config`, como em app.py
+def create_app(config=None):
+    app = Flask(__name__)
+
+    # Configurando a quantidade de shards e o modelo dos nomes dos arquivos
+    app.config['COUPON_SHARDS'] = int(os.environ.get('COUPON_SHARDS', 4))
+    app.config['COUPON_SHARD_PATH'] = os.environ.get('COUPON_SHARD_PATH', 'coupons_shard{}.db')
+    app.config['SQLITE_PROFILE'] = os.environ.get('SQLITE_PROFILE', 'production')
+
+    # Configurando o cache de cupons mais consultados, como em app.py
+    app.config['COUPON_CACHE_SIZE'] = 1024
+    app.config['COUPON_CACHE_TTL'] = 60
+    app.config['COUPON_CACHE_NEGATIVE_TTL'] = 5
+
+    # Aplicando a configuração desta instância
+    app.config.update(config or {})
+
+    # Estado de cada aplicação: o cache de cupons e as engines dos shards, que só abrem conexões na primeira requisição
+    app.extensions['coupon_cache'] = CouponCache(max_size=app.config['COUPON_CACHE_SIZE'],
+                                                 ttl=app.config['COUPON_CACHE_TTL'],
+                                                 negative_ttl=app.config['COUPON_CACHE_NEGATIVE_TTL'])
+    app.extensions['shard_store'] = ShardedStore(shard_paths(app.config['COUPON_SHARD_PATH'],
+                                                             app.config['COUPON_SHARDS']),
+                                                 app.config['SQLITE_PROFILE'])
+
+    install_metrics(app)
+    app.register_blueprint(bp)
+    return app
+
+
+# Obtendo os shards da aplicação atual
+def get_store():
+    return current_app.extensions['shard_store']
+
+
+# Obtendo o cache de cupons da aplicação atual
+def get_coupon_cache():
+    return current_app.extensions['coupon_cache']
+
+
+# Carregando os atributos imutáveis de um cupom no shard do código
+def load_coupon(code):
+    with get_store().engine_for(code).connect() as connection:
+        row = connection.execute(select(coupon_table).where(coupon_table.c.code == code)).first()
+    return snapshot(row) if row else None
+
+
+# Definindo o endpoint para cadastro de cupons
+@bp.route('/coupons', methods=['POST'])
+def create_coupon():
+    # Obtendo os dados do cupom do corpo da requisição
+    data = request.get_json()
+
+    # Validando os dados do cupom, verificando a existência do código somente no shard dele
+    def code_exists(code):
+        with get_store().engine_for(code).connect() as connection:
+            return connection.execute(select(coupon_table.c.id).where(coupon_table.c.code == code)).first() is not None
+
+    values, error = validate_coupon(data, code_exists)
+    if error:
+        return jsonify({'error': error}), 400
+
+    # O histórico dos clientes ficaria dividido entre os shards, então o limite por cliente não é aceito aqui
+    if values['max_uses_per_customer'] is not None:
+        return jsonify({'error': 'Limite por cliente não suportado'}), 400
+
+    # Salvando o cupom no shard do código
+    try:
+        with get_store().engine_for(values['code']).begin() as connection:
+            coupon_id = connection.execute(coupon_table.insert().values(uses_count=0, **values)).inserted_primary_key[0]
+    except IntegrityError:
+        # Outro cadastro com o mesmo código entre a verificação e a inserção
+        return jsonify({'error': 'Código já existe'}), 400
+
+    # Removendo o código do cache, que pode ter guardado a ausência do cupom
+    get_coupon_cache().invalidate(values['code'])
+
+    # Retornando uma resposta de sucesso com os dados do cupom criado
+    return jsonify({'id': coupon_id,
+                    'code': values['code'],
+                    'expiration_date': values['expiration_date'].isoformat(),
+                    'max_uses': values['max_uses'],
+                    'min_value': from_cents(values['min_value_cents']),
+                    'discount_type': values['discount_type'],
+                    'discount_amount': from_cents(values['discount_amount_cents']),
+                    'public': values['public'],
+                    'first_purchase': values['first_purchase']}), 201
+
+
+# Definindo o endpoint para consumo dos cupons
+@bp.route('/coupons/<code>', methods=['POST'])
+def use_coupon(code):
+    # Obtendo os dados da compra do corpo da requisição
+    data = request.get_json()
+    total_value = data.get('total_value')
+    first_purchase = data.get('first_purchase')
+
+    # Validando os dados da compra
+    if not total_value or first_purchase is None:
+        return jsonify({'error': 'Dados incompletos'}), 400
+
+    if total_value <= 0:
+        return jsonify({'error': 'Valor inválido'}), 400
+
+    # Buscando o cupom pelo código, passando primeiro pelo cache
+    coupon = get_coupon_cache().get(code, load_coupon)
+
+    # Verificando se o cupom existe
+    if not coupon:
+        return jsonify({'error': 'Cupom não encontrado'}), 404
+
+    # Recusando cupons com limite por cliente (por exemplo, redistribuídos de um banco de app.py), que esta versão não verifica
+    if coupon.max_uses_per_customer is not None:
+        return jsonify({'error': 'Limite por cliente não suportado'}), 400
+
+    # Verificando se o cupom é válido para a compra, com as mesmas regras de app.py
+    now = datetime.now()
+    error = check_coupon(coupon, total_value, first_purchase, now)
+    if error:
+        return jsonify({'error': error}), 400
+
+    discount_value = get_discount_value(coupon, total_value)
+
+    # Reservando um uso com um UPDATE condicional e registrando o uso, na mesma transação do shard do cupom
+    with get_store().engine_for(code).begin() as connection:
+        reserved = connection.execute(coupon_table.update()
+                                      .where(coupon_table.c.id == coupon.id,
+                                             coupon_table.c.uses_count < coupon_table.c.max_uses)
+                                      .values(uses_count=coupon_table.c.uses_count + 1)).rowcount == 1
+        if reserved:
+            connection.execute(use_table.insert().values(coupon_id=coupon.id, use_date=now))
+    if not reserved:
+        return jsonify({'error': 'Cupom esgotado'}), 400
+
+    # Retornando uma resposta de sucesso com os dados do cupom usado
+    return jsonify({'discount_value': discount_value, 'coupon_id': coupon.id}), 200
+
+
+# Aplicação com a configuração padrão, usada pelo servidor (por exemplo, gunicorn app_sharded:app).
+# Outras instâncias, com outros shards, podem ser criadas com create_app.
+app = create_app()
+
+
+# Executando a aplicação Flask
+if __name__ == '__main__':
+    # Criando ou atualizando o esquema de todos os shards antes de iniciar o servidor
+    app.extensions['shard_store'].upgrade()
+    app.run(debug=True, port=5000)
@@ -0,0 +1,191 @@
+# Benchmark de carga e latência da API de cupons.
+# Prepara um banco com N cupons e M usos históricos e executa os cenários de cadastro (POST /coupons)
+# e consumo (POST /coupons/<code>), dentro do processo (test_client) e contra um servidor local,
+# com várias requisições simultâneas. O relatório em JSON permite comparar execuções e implementações.
+#
+# Executar a partir da raiz do repositório:
+#     python -m benchmarks.bench_api --targets app app2 --modes inprocess server --output bench.json
+#     python -m benchmarks.bench_api --targets app --compare bench.json
+#
+# Comparação entre o modelo de workers do Flask e a versão assíncrona (app_async.py), com muitas conexões simultâneas:
+#     python -m benchmarks.bench_api --targets app app_async --modes server --scenarios redeem --concurrency 256
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from benchmarks.serve import ASYNC_TARGETS
+from benchmarks.common import PURCHASE, load_target, random_code, remove_database, seed_database, summarize
+
+SCENARIOS = ('create', 'redeem')
+
+
+# Montando a lista de requisições (caminho, corpo) de um cenário
+def build_requests(scenario, codes, count, seed=7):
+    generator = random.Random(seed)
+    if scenario == 'redeem':
+        return [(f'/coupons/{generator.choice(codes)}', PURCHASE) for _ in range(count)]
+    expiration_date = (datetime.now() + timedelta(days=30)).isoformat()
+    return [('/coupons', {'code': random_code('N'), 'expiration_date': expiration_date, 'max_uses': 100,
+                          'min_value': 100, 'discount_type': 'fixo', 'discount_amount': 10,
+                          'public': True, 'first_purchase': False}) for _ in range(count)]
+
+
+# Enviando requisições pelo test_client do Flask, um cliente por thread
+def inprocess_sender(app):
+    local = threading.local()
+
+    def send(path, body):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        response = local.client.post(path, json=body)
+        return response.status_code, float(response.headers.get('X-DB-Time-Ms', 0))
+    return send
+
+
+# Enviando requisições HTTP para o servidor local
+def http_sender(base_url):
+    def send(path, body):
+        request = urllib.request.Request(base_url + path, data=json.dumps(body).encode(),
+                                         headers={'Content-Type': 'application/json'}, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                response.read()
+                return response.status, float(response.headers.get('X-DB-Time-Ms', 0))
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code, float(error.headers.get('X-DB-Time-Ms', 0))
+    return send
+
+
+# Executando as requisições com a concorrência pedida e medindo a latência de cada uma
+def drive(send, requests, concurrency):
+    def timed(item):
+        started = time.perf_counter()
+        try:
+            status, db_ms = send(*item)
+        except Exception:
+            status, db_ms = 'exception', 0.0
+        return time.perf_counter() - started, db_ms, status
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Aquecendo as conexões e os caches antes de medir
+        list(executor.map(timed, requests[:concurrency]))
+        started = time.perf_counter()
+        samples = list(executor.map(timed, requests[concurrency:]))
+        elapsed = time.perf_counter() - started
+    return summarize(samples, elapsed)
+
+
+# Encontrando uma porta livre para o servidor local
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Iniciando o servidor local em outro processo e esperando a porta abrir
+def start_server(target, database_path):
+    port = free_port()
+    process = subprocess.Popen([sys.executable, '-m', 'benchmarks.serve', '--target', target,
+                                '--database', database_path, '--port', str(port)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.2):
+                return process, f'http://127.0.0.1:{port}'
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'O servidor de {target} não iniciou')
+
+
+def run(targets, modes, scenarios, coupons, uses, requests_count, concurrency):
+    results = []
+    for target in targets:
+        for mode in modes:
+            # A versão assíncrona só é medida através do servidor HTTP
+            if mode == 'inprocess' and target in ASYNC_TARGETS:
+                continue
+            for scenario in scenarios:
+                # Um banco novo por cenário, para que as execuções sejam comparáveis
+                handle, path = tempfile.mkstemp(suffix='.db')
+                os.close(handle)
+                process = None
+                try:
+                    codes = seed_database(path, coupons, uses)
+                    requests = build_requests(scenario, codes, requests_count + concurrency)
+                    if mode == 'server':
+                        process, base_url = start_server(target, path)
+                        send = http_sender(base_url)
+                    else:
+                        send = inprocess_sender(load_target(target, path))
+                    summary = drive(send, requests, concurrency)
+                finally:
+                    if process:
+                        process.terminate()
+                        process.wait()
+                    remove_database(path)
+                results.append(dict({'target': target, 'mode': mode, 'scenario': scenario,
+                                     'concurrency': concurrency}, **summary))
+    return results
+
+
+# Comparando o relatório atual com um relatório anterior
+def compare(current, baseline_path):
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+    previous = {(row['target'], row['mode'], row['scenario']): row for row in baseline['results']}
+    for row in current['results']:
+        key = (row['target'], row['mode'], row['scenario'])
+        if key not in previous:
+            continue
+        old = previous[key]
+        print(f'{"/".join(key):<28} rps {old["rps"]:>9} -> {row["rps"]:>9} ({change(old["rps"], row["rps"])})  '
+              f'p99 {old["p99_ms"]:>8}ms -> {row["p99_ms"]:>8}ms ({change(old["p99_ms"], row["p99_ms"])})')
+
+
+def change(old, new):
+    return f'{(new - old) / old * 100:+.1f}%' if old else 'n/a'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark de carga e latência da API de cupons')
+    parser.add_argument('--targets', nargs='+', default=['app'], help='módulos da aplicação (app, app2, app_async)')
+    parser.add_argument('--modes', nargs='+', default=['inprocess', 'server'], choices=['inprocess', 'server'])
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument('--coupons', type=int, default=1000, help='cupons cadastrados antes do teste (N)')
+    parser.add_argument('--uses', type=int, default=10000, help='usos históricos cadastrados antes do teste (M)')
+    parser.add_argument('--requests', type=int, default=2000, help='requisições medidas por cenário')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--output', help='arquivo JSON para gravar o relatório')
+    parser.add_argument('--compare', help='relatório JSON anterior para comparação')
+    args = parser.parse_args()
+
+    report = {'created_at': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'sqlite_profile': os.environ.get('SQLITE_PROFILE', 'production'),
+              'coupons': args.coupons,
+              'uses': args.uses,
+              'results': run(args.targets, args.modes, args.scenarios, args.coupons, args.uses,
+                             args.requests, args.concurrency)}
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    if args.compare:
+        compare(report, args.compare)
+    else:
+        print(json.dumps(report, indent=2))
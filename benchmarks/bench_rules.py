@@ -0,0 +1,84 @@
+# Microbenchmark: avaliações por segundo das regras dos cupons (rules.py), sem banco e sem HTTP:
+#   compile     compilando o avaliador a cada avaliação (sem o cache)
+#   cached      obtendo o avaliador pelo cache (evaluator_for), como no consumo e na cotação
+#   evaluator   usando um avaliador já obtido, como na cotação de um mesmo cupom
+# Cada avaliação verifica a compra e calcula o desconto.
+#
+# Executar a partir da raiz do repositório:
+#     python -m benchmarks.bench_rules --coupons 1000 --evaluations 200000
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta
+
+from coupon_cache import CachedCoupon
+from rules import Purchase, compile_rules, evaluator_for, parse_rules
+
+# Regras opcionais sorteadas para os cupons do benchmark
+RULES = [None,
+         {'categories': ['livros', 'games']},
+         {'time_windows': [{'weekdays': [0, 1, 2, 3, 4], 'start': '08:00', 'end': '20:00'},
+                           {'weekdays': [5, 6], 'start': '22:00', 'end': '02:00'}]},
+         {'categories': ['livros'], 'time_windows': [{'start': '00:00', 'end': '24:00'}], 'stackable': True}]
+
+
+# Gerando cupons variados, no formato do cache de app.py
+def make_coupons(count, seed=42):
+    generator = random.Random(seed)
+    expiration_date = datetime.now() + timedelta(days=365)
+    coupons = []
+    for index in range(count):
+        rules, _ = parse_rules(generator.choice(RULES))
+        coupons.append(CachedCoupon(id=index, code=f'R{index:08d}', expiration_date=expiration_date,
+                                    min_value_cents=generator.choice([0, 5000, 10000]),
+                                    discount_type=generator.choice(['percentual', 'fixo', 'primeira']),
+                                    discount_amount_cents=generator.choice([1000, 3000]),
+                                    public=generator.random() < 0.9, first_purchase=generator.random() < 0.2,
+                                    rules=rules))
+    return coupons
+
+
+def run(mode, coupons, purchases, evaluations):
+    evaluators = [evaluator_for(coupon) for coupon in coupons]
+    compile_uncached = compile_rules.__wrapped__
+    started = time.perf_counter()
+    for index in range(evaluations):
+        coupon = coupons[index % len(coupons)]
+        purchase = purchases[index % len(purchases)]
+        if mode == 'compile':
+            evaluator = compile_uncached(coupon.expiration_date, coupon.min_value_cents, coupon.discount_type,
+                                         coupon.discount_amount_cents, coupon.public, coupon.first_purchase,
+                                         coupon.rules)
+        elif mode == 'cached':
+            evaluator = evaluator_for(coupon)
+        else:
+            evaluator = evaluators[index % len(evaluators)]
+        if evaluator.check(purchase) is None:
+            evaluator.discount_cents(purchase.total_cents)
+    elapsed = time.perf_counter() - started
+    return {'mode': mode, 'evaluations': evaluations, 'seconds': round(elapsed, 4),
+            'evaluations_per_second': round(evaluations / elapsed)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Avaliações por segundo das regras dos cupons')
+    parser.add_argument('--coupons', type=int, default=1000)
+    parser.add_argument('--evaluations', type=int, default=200000)
+    parser.add_argument('--modes', nargs='+', default=['compile', 'cached', 'evaluator'])
+    parser.add_argument('--json', action='store_true', help='imprimir o resultado em JSON')
+    args = parser.parse_args()
+
+    coupons = make_coupons(args.coupons)
+    now = datetime.now()
+    purchases = [Purchase(total_cents, first_purchase, now, categories, stacked)
+                 for total_cents in (4000, 15000) for first_purchase in (False, True)
+                 for categories in (None, frozenset(['livros'])) for stacked in (0, 1)]
+
+    report = [run(mode, coupons, purchases, args.evaluations) for mode in args.modes]
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for row in report:
+            print(f"{row['mode']:>9}: {row['evaluations_per_second']} avaliações/s "
+                  f"({row['evaluations']} em {row['seconds']} s)")
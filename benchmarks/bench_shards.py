@@ -0,0 +1,107 @@
+# Benchmark: vazão de consumo de cupons com os dados particionados em 1, 2, 4 e 8 arquivos SQLite (app_sharded.py).
+# Vários processos, como workers do gunicorn, consomem cupons aleatórios ao mesmo tempo. Com um único
+# arquivo todos disputam o mesmo lock de escrita; com mais shards a vazão cresce com o número de núcleos.
+#
+# Executar a partir da raiz do repositório:
+#     python -m benchmarks.bench_shards --processes 8 --requests 500 --shards 1 2 4 8
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from contextlib import closing
+from datetime import datetime, timedelta
+
+from benchmarks.common import PURCHASE, remove_database
+from migrations import upgrade_connection
+from sharding import shard_index, shard_paths
+
+
+# Criando os shards pelas migrações e distribuindo os cupons pelo hash do código
+def seed_shards(paths, coupons):
+    expiration_date = (datetime.now() + timedelta(days=365)).isoformat(' ')
+    codes = [f'SEED{index:08d}' for index in range(coupons)]
+    for index, path in enumerate(paths):
+        with closing(sqlite3.connect(path)) as connection:
+            upgrade_connection(connection)
+            connection.executemany('INSERT INTO coupon (code, expiration_date, max_uses, min_value_cents, '
+                                   'discount_type, discount_amount_cents, public, first_purchase, uses_count) '
+                                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)',
+                                   ((code, expiration_date, 10 ** 9, 10000, 'percentual', 3000, 1, 0)
+                                    for code in codes if shard_index(code, len(paths)) == index))
+            connection.commit()
+    return codes
+
+
+# Consumindo cupons aleatórios em um processo separado
+def redeem_worker(shards, template, codes, requests_per_process, seed):
+    os.environ['COUPON_SHARDS'] = str(shards)
+    os.environ['COUPON_SHARD_PATH'] = template
+    module = importlib.import_module('app_sharded')
+    client = module.app.test_client()
+    generator = random.Random(seed)
+
+    ok = errors = 0
+    for _ in range(requests_per_process):
+        try:
+            status = client.post(f'/coupons/{generator.choice(codes)}', json=PURCHASE).status_code
+        except Exception:
+            status = 500
+        if status == 200:
+            ok += 1
+        else:
+            errors += 1
+    return ok, errors
+
+
+def run_shards(shards, processes, requests_per_process, coupons):
+    directory = tempfile.mkdtemp()
+    template = os.path.join(directory, 'shard{}.db')
+    paths = shard_paths(template, shards)
+    try:
+        codes = seed_shards(paths, coupons)
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processes) as pool:
+            # Aquecendo os processos (importação da aplicação e conexões) antes de medir
+            pool.starmap(redeem_worker, [(shards, template, codes, 10, seed) for seed in range(processes)])
+            start = time.perf_counter()
+            results = pool.starmap(redeem_worker, [(shards, template, codes, requests_per_process, seed)
+                                                   for seed in range(processes)])
+            elapsed = time.perf_counter() - start
+    finally:
+        for path in paths:
+            remove_database(path)
+        os.rmdir(directory)
+
+    ok = sum(result[0] for result in results)
+    errors = sum(result[1] for result in results)
+    return {'shards': shards,
+            'processes': processes,
+            'requests': ok + errors,
+            'ok': ok,
+            'errors': errors,
+            'seconds': round(elapsed, 3),
+            'redemptions_per_second': round(ok / elapsed, 1)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Vazão de consumo de cupons por quantidade de shards')
+    parser.add_argument('--shards', nargs='+', type=int, default=[1, 2, 4, 8])
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--requests', type=int, default=500, help='consumos por processo')
+    parser.add_argument('--coupons', type=int, default=1000)
+    parser.add_argument('--json', action='store_true', help='imprimir o resultado em JSON')
+    args = parser.parse_args()
+
+    report = [run_shards(shards, args.processes, args.requests, args.coupons) for shards in args.shards]
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f'{os.cpu_count()} núcleos, {args.processes} processos')
+        for row in report:
+            print(f"{row['shards']:>3} shards: {row['redemptions_per_second']:>8} consumos/s "
+                  f"({row['ok']} ok, {row['errors']} erros em {row['seconds']}s)")
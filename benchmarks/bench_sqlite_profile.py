@@ -0,0 +1,107 @@
+# Benchmark: vazão de consumo de cupons com e sem o perfil de ajustes do SQLite.
+# Executar a partir da raiz do repositório:
+#     python -m benchmarks.bench_sqlite_profile --processes 8 --requests 200
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+CODE = 'BENCH'
+
+
+# Aplicações criadas em cada processo, reaproveitadas entre o aquecimento e a medição
+_apps = {}
+
+
+def get_app(profile, database_uri):
+    if (profile, database_uri) not in _apps:
+        app_module = importlib.import_module('app')
+        _apps[profile, database_uri] = app_module.create_app({'SQLALCHEMY_DATABASE_URI': database_uri,
+                                                             'SQLITE_PROFILE': profile})
+    return _apps[profile, database_uri]
+
+
+# Consumindo o cupom várias vezes em um processo separado, como um worker do gunicorn
+def redeem_worker(profile, database_uri, requests_per_process):
+    client = get_app(profile, database_uri).test_client()
+    data = {'total_value': 150, 'first_purchase': False}
+
+    ok = errors = 0
+    for _ in range(requests_per_process):
+        try:
+            status = client.post(f'/coupons/{CODE}', json=data).status_code
+        except Exception:
+            status = 500
+        if status == 200:
+            ok += 1
+        else:
+            errors += 1
+    return ok, errors
+
+
+# Criando um banco novo com um cupom de usos ilimitados na prática.
+# Executado em um dos processos do benchmark, para que o modo de journal seja o do perfil medido.
+def seed_database(profile, path):
+    app_module = importlib.import_module('app')
+    with app_module.create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}', 'SQLITE_PROFILE': profile}).app_context():
+        app_module.db.create_all()
+        app_module.db.session.add(app_module.Coupon(code=CODE,
+                                                    expiration_date=datetime.now() + timedelta(days=30),
+                                                    max_uses=10 ** 9,
+                                                    min_value=100,
+                                                    discount_type='percentual',
+                                                    discount_amount=30,
+                                                    public=True,
+                                                    first_purchase=False))
+        app_module.db.session.commit()
+        app_module.db.session.remove()
+        app_module.db.engine.dispose()
+
+
+def run_profile(profile, processes, requests_per_process):
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    try:
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processes) as pool:
+            pool.apply(seed_database, (profile, path))
+            # Aquecendo os processos (importação da aplicação) antes de medir
+            pool.starmap(redeem_worker, [(profile, f'sqlite:///{path}', 0)] * processes)
+            start = time.perf_counter()
+            results = pool.starmap(redeem_worker, [(profile, f'sqlite:///{path}', requests_per_process)] * processes)
+            elapsed = time.perf_counter() - start
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    ok = sum(result[0] for result in results)
+    errors = sum(result[1] for result in results)
+    return {'profile': profile,
+            'processes': processes,
+            'requests': ok + errors,
+            'ok': ok,
+            'errors': errors,
+            'seconds': round(elapsed, 3),
+            'redemptions_per_second': round(ok / elapsed, 1)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Vazão de consumo de cupons por perfil do SQLite')
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='consumos por processo')
+    parser.add_argument('--profiles', nargs='+', default=['default', 'production'])
+    parser.add_argument('--json', action='store_true', help='imprimir o resultado em JSON')
+    args = parser.parse_args()
+
+    report = [run_profile(profile, args.processes, args.requests) for profile in args.profiles]
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for row in report:
+            print(f"{row['profile']:>10}: {row['redemptions_per_second']:>8} consumos/s "
+                  f"({row['ok']} ok, {row['errors']} erros em {row['seconds']}s)")
@@ -0,0 +1,72 @@
+# Benchmark: tempo de partida de um worker, medido em um processo novo a cada execução:
+#   import        importação do módulo da aplicação (app ou app2)
+#   create_app    criação de uma instância pela fábrica, apontando para o banco do benchmark
+#   first         primeiro consumo, que cria a engine, abre a conexão e carrega o cupom
+#   second        segundo consumo, já com a engine e o cache prontos
+#
+# Executar a partir da raiz do repositório:
+#     python -m benchmarks.bench_startup --targets app app2 --runs 7
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from benchmarks.common import PURCHASE, remove_database, seed_database
+
+# Código executado no processo novo; imprime os tempos em milissegundos, em JSON
+MEASURE = '''
+import importlib, json, sys, time
+started = time.perf_counter()
+module = importlib.import_module(sys.argv[1])
+imported = time.perf_counter()
+app = module.create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + sys.argv[2]})
+created = time.perf_counter()
+client = app.test_client()
+status = client.post('/coupons/' + sys.argv[3], json=json.loads(sys.argv[4])).status_code
+first = time.perf_counter()
+client.post('/coupons/' + sys.argv[3], json=json.loads(sys.argv[4]))
+second = time.perf_counter()
+print(json.dumps({'import': (imported - started) * 1000, 'create_app': (created - imported) * 1000,
+                  'first': (first - created) * 1000, 'second': (second - first) * 1000, 'status': status}))
+'''
+
+
+def measure(target, runs, coupons):
+    samples = []
+    for _ in range(runs):
+        # Um banco novo por execução, para que o primeiro consumo não encontre páginas em cache do SQLite
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        try:
+            code = seed_database(path, coupons, 0)[0]
+            output = subprocess.run([sys.executable, '-c', MEASURE, target, path, code, json.dumps(PURCHASE)],
+                                    capture_output=True, text=True, check=True).stdout
+            samples.append(json.loads(output.splitlines()[-1]))
+        finally:
+            remove_database(path)
+    report = {'target': target, 'runs': runs}
+    for phase in ('import', 'create_app', 'first', 'second'):
+        report[f'{phase}_ms'] = round(statistics.median(sample[phase] for sample in samples), 2)
+    report['status_counts'] = {str(status): sum(1 for sample in samples if sample['status'] == status)
+                               for status in {sample['status'] for sample in samples}}
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tempo de importação, criação da aplicação e primeira requisição')
+    parser.add_argument('--targets', nargs='+', default=['app', 'app2'])
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--coupons', type=int, default=1000)
+    parser.add_argument('--json', action='store_true', help='imprimir o resultado em JSON')
+    args = parser.parse_args()
+
+    report = [measure(target, args.runs, args.coupons) for target in args.targets]
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for row in report:
+            print(f"{row['target']:>5}: importação {row['import_ms']} ms, create_app {row['create_app_ms']} ms, "
+                  f"primeira requisição {row['first_ms']} ms, segunda {row['second_ms']} ms (mediana de {row['runs']})")
@@ -0,0 +1,117 @@
+# Funções compartilhadas pelos benchmarks: preparação do banco, medição do tempo de banco e percentis
+import importlib
+import os
+import random
+import sqlite3
+import string
+import threading
+import time
+from contextlib import closing
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from migrations import upgrade_connection
+
+# Dados da compra usados nos consumos
+PURCHASE = {'total_value': 150, 'first_purchase': False}
+
+
+# Gerando um código aleatório para os cupons do benchmark
+def random_code(prefix='B', length=10):
+    return prefix + ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(length))
+
+
+# Criando um banco novo, pelas migrações, com N cupons e M usos históricos distribuídos entre eles
+def seed_database(path, coupons, uses, seed=42):
+    generator = random.Random(seed)
+    expiration_date = (datetime.now() + timedelta(days=365)).isoformat(' ')
+    codes = [f'SEED{index:08d}' for index in range(coupons)]
+    with closing(sqlite3.connect(path)) as connection:
+        upgrade_connection(connection)
+        connection.executemany('INSERT INTO coupon (code, expiration_date, max_uses, min_value_cents, discount_type, '
+                               'discount_amount_cents, public, first_purchase, uses_count) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)',
+                               ((code, expiration_date, 10 ** 9, 10000, 'percentual', 3000, 1, 0) for code in codes))
+        use_date = (datetime.now() - timedelta(days=1)).isoformat(' ')
+        connection.executemany('INSERT INTO use (coupon_id, use_date) VALUES (?, ?)',
+                               ((generator.randint(1, coupons), use_date) for _ in range(uses)))
+        connection.execute('UPDATE coupon SET uses_count = (SELECT COUNT(*) FROM use WHERE use.coupon_id = coupon.id)')
+        connection.commit()
+    return codes
+
+
+# Criando uma instância da aplicação (app ou app2) apontando para o banco do benchmark, com cache e engine próprios
+def load_target(target, database_path):
+    module = importlib.import_module(target)
+    app = module.create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{database_path}'})
+    install_db_timer(app)
+    return app
+
+
+# Acumulando o tempo gasto em comandos SQL por requisição (thread), devolvido no cabeçalho X-DB-Time-Ms
+_db_time = threading.local()
+_timer_apps = set()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    _db_time.started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(_db_time, 'started', None)
+    if started is not None:
+        _db_time.total = getattr(_db_time, 'total', 0.0) + time.perf_counter() - started
+        _db_time.started = None
+
+
+def install_db_timer(app):
+    if not _timer_apps:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+    # Cada instância criada por create_app recebe os seus próprios hooks
+    if app in _timer_apps:
+        return
+    _timer_apps.add(app)
+
+    @app.before_request
+    def reset_db_time():
+        _db_time.total = 0.0
+
+    @app.after_request
+    def add_db_time_header(response):
+        response.headers['X-DB-Time-Ms'] = f'{getattr(_db_time, "total", 0.0) * 1000:.4f}'
+        return response
+
+
+# Calculando um percentil pelo método do posto mais próximo
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+# Resumindo as amostras (latência em segundos, tempo de banco em ms, status) de um cenário
+def summarize(samples, elapsed):
+    latencies = sorted(sample[0] * 1000 for sample in samples)
+    statuses = {}
+    for sample in samples:
+        statuses[str(sample[2])] = statuses.get(str(sample[2]), 0) + 1
+    return {'requests': len(samples),
+            'seconds': round(elapsed, 4),
+            'rps': round(len(samples) / elapsed, 1) if elapsed else 0.0,
+            'p50_ms': round(percentile(latencies, 0.50), 3),
+            'p95_ms': round(percentile(latencies, 0.95), 3),
+            'p99_ms': round(percentile(latencies, 0.99), 3),
+            'max_ms': round(latencies[-1], 3) if latencies else 0.0,
+            'db_ms_per_request': round(sum(sample[1] for sample in samples) / len(samples), 4) if samples else 0.0,
+            'status_counts': statuses}
+
+
+# Removendo o arquivo do banco e os arquivos auxiliares do WAL
+def remove_database(path):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
@@ -0,0 +1,47 @@
+# Servidor HTTP local usado pelo benchmark no modo "server":
+#     python -m benchmarks.serve --target app --database /tmp/bench.db --port 5001
+# O alvo app_async é servido pelo hypercorn (asyncio); os demais pelo servidor do werkzeug, com threads.
+import argparse
+import asyncio
+import importlib
+
+from werkzeug.serving import make_server
+
+from benchmarks.common import load_target
+
+ASYNC_TARGETS = ('app_async',)
+
+
+def serve_async(target, database, host, port):
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    module = importlib.import_module(target)
+    module.app.config['DATABASE_PATH'] = database
+    config = Config()
+    config.bind = [f'{host}:{port}']
+    config.accesslog = None
+    config.backlog = 4096
+    asyncio.run(serve(module.app, config))
+
+
+def serve_threaded(target, database, host, port):
+    app = load_target(target, database)
+    # Servidor com uma thread por requisição, como o servidor de desenvolvimento do Flask
+    server = make_server(host, port, app, threaded=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Servidor local para os benchmarks')
+    parser.add_argument('--target', default='app', help='módulo da aplicação (app, app2 ou app_async)')
+    parser.add_argument('--database', required=True)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5001)
+    args = parser.parse_args()
+
+    print(f'Servindo {args.target} em http://{args.host}:{args.port}', flush=True)
+    if args.target in ASYNC_TARGETS:
+        serve_async(args.target, args.database, args.host, args.port)
+    else:
+        serve_threaded(args.target, args.database, args.host, args.port)
@@ -0,0 +1,101 @@
+# Filtro de Bloom: conjunto aproximado em memória, com um bit por posição.
+# Um valor adicionado está sempre no filtro (sem falsos negativos); um valor que não foi adicionado
+# pode aparecer como presente com probabilidade próxima de error_rate, enquanto o filtro tiver até
+# `capacity` valores. Serve para evitar consultas ao banco quando a resposta certamente é "não existe".
+# Usado para os clientes com pedidos (app.py) e para os códigos de cupons cadastrados (CodeFilter).
+
+# Importando as bibliotecas necessárias
+import hashlib
+import math
+import threading
+import time
+
+
+class BloomFilter:
+
+    def __init__(self, capacity, error_rate=0.01):
+        # Tamanho ótimo, em bits, e quantidade de funções de hash para a capacidade e a taxa de erro
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+        # Marcar um bit é uma leitura seguida de uma escrita do byte: sem o lock, duas adições
+        # simultâneas no mesmo byte poderiam perder um bit e criar um falso negativo
+        self._lock = threading.Lock()
+
+    # Posições do valor, pela técnica de hash duplo sobre um único digest de 16 bytes
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + index * second) % self.size for index in range(self.hashes)]
+
+    def add(self, value):
+        positions = self._positions(value)
+        with self._lock:
+            for position in positions:
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def __contains__(self, value):
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+# Filtro dos códigos de cupons cadastrados, atualizado de forma incremental pelos ids dos cupons.
+# load(last_id) retorna os (id, código) cadastrados com id maior que last_id, em ordem de id; os ids não podem
+# ser reaproveitados (na tabela coupon, a limpeza do arquivo morto mantém o cupom de maior id, ver sweeper.py).
+# Os códigos cadastrados por este processo entram no filtro com add; os cadastrados por outros processos,
+# na próxima sincronização, feita quando um código não é encontrado, no máximo a cada sync_interval segundos.
+# O filtro é recriado por inteiro a cada rebuild_interval segundos, ou quando passa da capacidade (com o
+# dobro dela), o que também remove os códigos dos cupons que foram para o arquivo morto.
+class CodeFilter:
+
+    def __init__(self, capacity, error_rate, load, sync_interval=1.0, rebuild_interval=3600.0):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.load = load
+        self.sync_interval = sync_interval
+        self.rebuild_interval = rebuild_interval
+        self._lock = threading.Lock()
+        self._rebuild(time.monotonic())
+
+    def _rebuild(self, now):
+        codes = BloomFilter(self.capacity, self.error_rate)
+        last_id = 0
+        for last_id, code in self.load(0):
+            codes.add(code)
+        self.codes, self.last_id, self.built_at, self.synced_at = codes, last_id, now, now
+
+    # Carregando os códigos cadastrados desde a última sincronização (ou recriando o filtro, quando é a hora)
+    def sync(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self.synced_at < self.sync_interval:
+                return
+            if now - self.built_at >= self.rebuild_interval or self.codes.count > self.capacity:
+                self.capacity = max(self.capacity, self.codes.count * 2)
+                self._rebuild(now)
+                return
+            for self.last_id, code in self.load(self.last_id):
+                self.codes.add(code)
+            self.synced_at = now
+
+    def add(self, code):
+        self.codes.add(code)
+
+    # Um código fora do filtro certamente não está cadastrado, exceto se foi cadastrado por outro processo
+    # depois da última sincronização
+    def __contains__(self, code):
+        if code in self.codes:
+            return True
+        if time.monotonic() - self.synced_at < self.sync_interval:
+            return False
+        self.sync()
+        return code in self.codes
@@ -0,0 +1,505 @@
+# Contadores de usos dos cupons, com implementações intercambiáveis (COUNTER_BACKEND em app.py):
+#   sql    - UPDATE condicional e registro do uso na transação da requisição (comportamento padrão)
+#   memory - contadores em memória, divididos em shards com locks próprios, para implantações com um único processo
+#   redis  - contadores no Redis, com a reserva atômica feita por um script Lua, compartilhados entre processos e máquinas
+#
+# Nos backends memory e redis a reserva não passa pelo banco: cada reserva (+1) ou devolução (-1) entra em
+# uma lista de eventos pendentes no backend, gravada na tabela Use, junto com o contador uses_count, pela
+# reconciliação periódica (Reconciler). Assim a vazão de consumos deixa de depender do caminho de escrita do SQLite.
+# O limite por cliente e a primeira compra também são verificados no backend, com um contador de usos por
+# cupom e cliente e um contador de pedidos por cliente, iniciados pelo histórico do banco no primeiro consumo
+# do cliente: o histórico no banco só fica completo depois da reconciliação.
+# Os contadores são identificados pelo id do cupom, que não é reaproveitado depois da limpeza do arquivo morto
+# (a limpeza mantém o cupom de maior id, ver sweeper.py): um cupom novo nunca herda o contador de um cupom arquivado.
+
+# Importando as bibliotecas necessárias
+import logging
+import threading
+import uuid
+from datetime import datetime
+from collections import Counter
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Formato de data usado pelo SQLAlchemy nas colunas DateTime do SQLite
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+RESERVE_SQL = text('UPDATE coupon SET uses_count = uses_count + 1 WHERE id = :coupon_id AND uses_count < max_uses')
+# Reserva de um uso por um cliente identificado: além do limite geral, verifica no mesmo UPDATE o limite
+# por cliente (índice parcial de use por cupom e cliente) e, quando o cupom depende da primeira compra,
+# a ausência de pedidos anteriores (chave primária de customer). Com o lock de escrita do SQLite, nenhum
+# consumo concorrente do mesmo cliente pode ser gravado entre a verificação e a reserva.
+RESERVE_FOR_CUSTOMER_SQL = text('UPDATE coupon SET uses_count = uses_count + 1 '
+                                'WHERE id = :coupon_id AND uses_count < max_uses '
+                                'AND (max_uses_per_customer IS NULL OR max_uses_per_customer > '
+                                '(SELECT COUNT(*) FROM use WHERE coupon_id = :coupon_id AND customer_id = :customer_id)) '
+                                'AND (NOT :first_purchase_only OR NOT EXISTS '
+                                '(SELECT 1 FROM customer WHERE customer_id = :customer_id AND orders_count > 0))')
+INSERT_USE_SQL = text('INSERT INTO use (coupon_id, use_date, customer_id) VALUES (:coupon_id, :use_date, :customer_id)')
+DELETE_USE_SQL = text('DELETE FROM use WHERE id = (SELECT id FROM use WHERE coupon_id = :coupon_id AND use_date = :use_date '
+                      'AND customer_id IS :customer_id ORDER BY id DESC LIMIT 1)')
+ADD_USES_SQL = text('UPDATE coupon SET uses_count = uses_count + :count WHERE id = :coupon_id')
+LIMITS_SQL = text('SELECT max_uses, uses_count, max_uses_per_customer FROM coupon WHERE id = :coupon_id')
+# Histórico de um cliente para um cupom: pedidos anteriores (chave primária de customer) e usos do cupom
+# pelo cliente (índice parcial de use por cupom e cliente), lidos em uma única consulta
+CUSTOMER_HISTORY_SQL = text('SELECT (SELECT orders_count FROM customer WHERE customer_id = :customer_id), '
+                            '(SELECT COUNT(*) FROM use WHERE coupon_id = :coupon_id AND customer_id = :customer_id)')
+# Registrando pedidos no histórico do cliente (count > 0) ou desfazendo pedidos devolvidos (count < 0)
+ADD_ORDERS_SQL = text('INSERT INTO customer (customer_id, orders_count, first_order_date) '
+                      'VALUES (:customer_id, :count, :order_date) '
+                      'ON CONFLICT (customer_id) DO UPDATE SET orders_count = orders_count + excluded.orders_count')
+REMOVE_ORDERS_SQL = text('UPDATE customer SET orders_count = MAX(orders_count + :count, 0) WHERE customer_id = :customer_id')
+# Último evento de um backend gravado pela reconciliação, registrado na mesma transação dos usos
+LAST_EVENT_SQL = text('SELECT epoch, last_event_id FROM reconciled_event WHERE backend = :backend')
+SAVE_LAST_EVENT_SQL = text('INSERT INTO reconciled_event (backend, epoch, last_event_id) VALUES (:backend, :epoch, :event_id) '
+                           'ON CONFLICT (backend) DO UPDATE SET epoch = excluded.epoch, last_event_id = excluded.last_event_id')
+
+
+# Registrando pedidos de um cliente no histórico, na transação da conexão ou sessão
+def add_orders(connection, customer_id, count, order_date):
+    sql = ADD_ORDERS_SQL if count > 0 else REMOVE_ORDERS_SQL
+    connection.execute(sql, {'customer_id': customer_id, 'count': count,
+                             'order_date': order_date.strftime(DATETIME_FORMAT)})
+
+
+# Reservando um uso somente no contador uses_count, sem registrar o uso; retorna False se o cupom estiver
+# esgotado ou se o cliente não puder usá-lo (limite por cliente ou pedido anterior, com first_purchase_only)
+def reserve_count(connection, coupon_id, customer_id=None, first_purchase_only=False):
+    if customer_id is None:
+        return connection.execute(RESERVE_SQL, {'coupon_id': coupon_id}).rowcount == 1
+    return connection.execute(RESERVE_FOR_CUSTOMER_SQL, {'coupon_id': coupon_id, 'customer_id': customer_id,
+                                                         'first_purchase_only': first_purchase_only}).rowcount == 1
+
+
+# Registrando um uso na tabela Use, na transação da conexão ou sessão
+def insert_use(connection, coupon_id, use_date, customer_id=None):
+    connection.execute(INSERT_USE_SQL, {'coupon_id': coupon_id, 'use_date': use_date.strftime(DATETIME_FORMAT),
+                                        'customer_id': customer_id})
+
+
+# Reservando um uso e registrando-o no banco, na transação da conexão ou sessão; retorna False se o cupom
+# estiver esgotado ou se o cliente não puder usá-lo (limite por cliente ou pedido anterior, com first_purchase_only)
+def reserve_in_database(connection, coupon_id, use_date, customer_id=None, first_purchase_only=False):
+    if not reserve_count(connection, coupon_id, customer_id, first_purchase_only):
+        return False
+    insert_use(connection, coupon_id, use_date, customer_id)
+    if customer_id is not None:
+        add_orders(connection, customer_id, 1, use_date)
+    return True
+
+
+# Interface dos contadores de usos
+class CounterBackend:
+
+    # Nome sob o qual o último evento gravado fica em reconciled_event, nos backends cujos eventos pendentes
+    # sobrevivem ao processo e podem ser retirados de novo depois de gravados; None nos demais
+    event_log = None
+
+    # Reservando um uso do cupom, pelo cliente customer_id (opcional); retorna False se o cupom estiver esgotado.
+    # first_purchase_only indica que o consumo depende de ser a primeira compra do cliente
+    def reserve(self, coupon_id, use_date, customer_id=None, first_purchase_only=False):
+        raise NotImplementedError
+
+    # Devolvendo um uso reservado, quando o consumo não pôde ser concluído
+    def release(self, coupon_id, use_date, customer_id=None):
+        raise NotImplementedError
+
+    # Histórico do cliente visto pelo backend, incluindo os usos ainda não reconciliados:
+    # (pedidos, usos do cupom), ou None quando o histórico do banco já está completo
+    def customer_history(self, coupon_id, customer_id):
+        return None
+
+    # Registrando pedidos do cliente gravados no banco fora dos consumos (por exemplo, em /customers/<id>/orders)
+    def add_orders(self, customer_id, count):
+        pass
+
+    # Retirando até `limit` eventos pendentes, na ordem em que ocorreram: lista de
+    # (coupon_id, use_date, customer_id, delta, event_id), com event_id = (época, sequência) quando há event_log
+    def claim(self, limit):
+        return []
+
+    # Confirmando que os eventos retirados por claim foram gravados no banco
+    def complete(self, items):
+        pass
+
+    # Devolvendo aos pendentes os eventos retirados por claim que não puderam ser gravados
+    def requeue(self, items):
+        pass
+
+
+# Contadores no próprio banco: a reserva e o registro do uso são feitos na sessão da requisição,
+# que deve ser confirmada (commit) ou desfeita (rollback) por quem chamou
+class SqlCounterBackend(CounterBackend):
+
+    def __init__(self, session):
+        self.session = session
+
+    # O limite por cliente e a primeira compra são verificados no próprio UPDATE da reserva
+    def reserve(self, coupon_id, use_date, customer_id=None, first_purchase_only=False):
+        return reserve_in_database(self.session, coupon_id, use_date, customer_id, first_purchase_only)
+
+    # O uso é desfeito pelo rollback da sessão
+    def release(self, coupon_id, use_date, customer_id=None):
+        pass
+
+
+# Contadores em memória, divididos em shards pelo id do cupom para reduzir a disputa pelos locks.
+# Válidos apenas com um único processo: cada processo teria os seus próprios contadores.
+# load_limits(coupon_id) retorna (max_uses, uses_count, max_uses_per_customer) do banco, lidos no primeiro
+# uso do cupom, e load_customer(coupon_id, customer_id) retorna (pedidos, usos do cupom) do cliente, lidos
+# no primeiro consumo do cliente. Os contadores dos clientes ficam em memória enquanto o processo durar.
+class MemoryCounterBackend(CounterBackend):
+
+    def __init__(self, load_limits, load_customer=None, shards=16):
+        self.load_limits = load_limits
+        self.load_customer = load_customer
+        self._shards = [{'lock': threading.Lock(), 'counters': {}, 'customers': {}, 'pending': []}
+                        for _ in range(shards)]
+        # Pedidos por cliente, compartilhados pelos cupons de todos os shards; sempre obtido depois do lock do shard
+        self._orders_lock = threading.Lock()
+        self._orders = {}
+
+    def _shard(self, coupon_id):
+        return self._shards[coupon_id % len(self._shards)]
+
+    def reserve(self, coupon_id, use_date, customer_id=None, first_purchase_only=False):
+        shard = self._shard(coupon_id)
+        counter = shard['counters'].get(coupon_id)
+        if counter is None:
+            # Lendo os limites fora do lock, para não bloquear os outros cupons do shard durante a consulta
+            limits = list(self.load_limits(coupon_id))
+            with shard['lock']:
+                counter = shard['counters'].setdefault(coupon_id, limits)
+        key = (coupon_id, customer_id)
+        history = None
+        if customer_id is not None and (key not in shard['customers'] or customer_id not in self._orders):
+            history = self.load_customer(coupon_id, customer_id)
+        with shard['lock']:
+            if counter[1] >= counter[0]:
+                return False
+            if customer_id is not None:
+                with self._orders_lock:
+                    if history is not None:
+                        shard['customers'].setdefault(key, history[1])
+                        self._orders.setdefault(customer_id, history[0])
+                    if counter[2] is not None and shard['customers'][key] >= counter[2]:
+                        return False
+                    if first_purchase_only and self._orders[customer_id] > 0:
+                        return False
+                    shard['customers'][key] += 1
+                    self._orders[customer_id] += 1
+            counter[1] += 1
+            shard['pending'].append((coupon_id, use_date, customer_id, 1, None))
+        return True
+
+    def release(self, coupon_id, use_date, customer_id=None):
+        shard = self._shard(coupon_id)
+        with shard['lock']:
+            shard['counters'][coupon_id][1] -= 1
+            if customer_id is not None:
+                with self._orders_lock:
+                    shard['customers'][coupon_id, customer_id] -= 1
+                    self._orders[customer_id] -= 1
+            shard['pending'].append((coupon_id, use_date, customer_id, -1, None))
+
+    def customer_history(self, coupon_id, customer_id):
+        shard = self._shard(coupon_id)
+        with shard['lock'], self._orders_lock:
+            if (coupon_id, customer_id) not in shard['customers']:
+                return None
+            return self._orders[customer_id], shard['customers'][coupon_id, customer_id]
+
+    def add_orders(self, customer_id, count):
+        with self._orders_lock:
+            if customer_id in self._orders:
+                self._orders[customer_id] += count
+
+    def claim(self, limit):
+        items = []
+        for shard in self._shards:
+            with shard['lock']:
+                taken = shard['pending'][:limit - len(items)]
+                del shard['pending'][:len(taken)]
+            items.extend(taken)
+            if len(items) >= limit:
+                break
+        return items
+
+    # Os eventos voltam para o início da lista, antes dos eventos mais recentes do mesmo cupom
+    def requeue(self, items):
+        for item in reversed(items):
+            shard = self._shard(item[0])
+            with shard['lock']:
+                shard['pending'].insert(0, item)
+
+
+# Id de cada evento pendente, 'época|sequência', gerado no mesmo script que o registra: a sequência cresce na ordem
+# da lista de pendentes. Se a sequência se perder (Redis reiniciado sem persistência, chave removida), ela recomeça
+# em uma época nova, para que os eventos novos não sejam confundidos com os já gravados pela reconciliação.
+EVENT_ID_SCRIPT = '''
+local function event_id(key, new_epoch)
+    local sequence = redis.call('HINCRBY', key, 'sequence', 1)
+    if sequence == 1 then
+        redis.call('HSET', key, 'epoch', new_epoch)
+    end
+    return redis.call('HGET', key, 'epoch') .. '|' .. sequence
+end
+'''
+
+# Reserva atômica no Redis: carrega os limites na primeira vez, verifica o limite, incrementa o contador
+# e registra o uso pendente, tudo no mesmo script Lua. Com um cliente, também carrega o histórico dele
+# na primeira vez e verifica o limite por cliente e a primeira compra no mesmo script.
+# KEYS: contador, limite, lista de pendentes, limite por cliente, usos do cliente no cupom, pedidos do cliente,
+# sequência dos eventos.
+# ARGV: limite, usos atuais e limite por cliente no banco ('' sem limite), uso pendente, usos do cliente no cupom
+# e pedidos do cliente no banco, '1' se o consumo depende da primeira compra, '1' se há um cliente, nova época
+RESERVE_SCRIPT = EVENT_ID_SCRIPT + '''
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('SET', KEYS[2], ARGV[1])
+    redis.call('SET', KEYS[4], ARGV[3])
+    redis.call('SET', KEYS[1], ARGV[2])
+end
+if tonumber(redis.call('GET', KEYS[1])) >= tonumber(redis.call('GET', KEYS[2])) then
+    return 0
+end
+if ARGV[8] == '1' then
+    redis.call('SET', KEYS[5], ARGV[5], 'NX')
+    redis.call('SET', KEYS[6], ARGV[6], 'NX')
+    local limit = redis.call('GET', KEYS[4])
+    if limit and limit ~= '' and tonumber(redis.call('GET', KEYS[5])) >= tonumber(limit) then
+        return 0
+    end
+    if ARGV[7] == '1' and tonumber(redis.call('GET', KEYS[6])) > 0 then
+        return 0
+    end
+    redis.call('INCR', KEYS[5])
+    redis.call('INCR', KEYS[6])
+end
+redis.call('INCR', KEYS[1])
+redis.call('RPUSH', KEYS[3], event_id(KEYS[7], ARGV[9]) .. '|' .. ARGV[4])
+return 1
+'''
+
+# Devolvendo um uso reservado: decrementa os contadores e registra a devolução entre os pendentes.
+# KEYS: contador, lista de pendentes, sequência dos eventos, usos do cliente no cupom e pedidos do cliente
+# (quando há um cliente). ARGV: evento de devolução, nova época
+RELEASE_SCRIPT = EVENT_ID_SCRIPT + '''
+for index = 4, #KEYS do
+    redis.call('DECR', KEYS[index])
+end
+redis.call('DECR', KEYS[1])
+redis.call('RPUSH', KEYS[2], event_id(KEYS[3], ARGV[2]) .. '|' .. ARGV[1])
+return 1
+'''
+
+# Somando pedidos ao contador de um cliente, somente se ele já existe no Redis
+# KEYS: pedidos do cliente. ARGV: quantidade de pedidos
+ADD_ORDERS_SCRIPT = '''
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return 1
+'''
+
+
+# Contadores no Redis (ou em outro servidor com o mesmo protocolo), compartilhados entre processos.
+# A lista de pendentes é reconciliada por um processo por vez, protegida por um lock no Redis. Os eventos só saem
+# da lista depois de gravados no banco; se o processo cair entre a gravação e a remoção, a próxima reconciliação
+# retira os mesmos eventos e descarta os que já foram gravados, pelo último id registrado em reconciled_event.
+# Como no backend memory, os contadores dos clientes são iniciados pelo histórico do banco (load_customer).
+class RedisCounterBackend(CounterBackend):
+
+    def __init__(self, client, load_limits, load_customer=None, prefix='coupons', lock_timeout=60):
+        self.client = client
+        self.load_limits = load_limits
+        self.load_customer = load_customer
+        self.prefix = prefix
+        self.lock_timeout = lock_timeout
+        self.pending_key = f'{prefix}:pending'
+        self.events_key = f'{prefix}:events'
+        self.event_log = prefix
+        self.lock_key = f'{prefix}:reconcile-lock'
+        self._reserve = client.register_script(RESERVE_SCRIPT)
+        self._release = client.register_script(RELEASE_SCRIPT)
+        self._add_orders = client.register_script(ADD_ORDERS_SCRIPT)
+
+    def _keys(self, coupon_id):
+        return f'{self.prefix}:{coupon_id}:used', f'{self.prefix}:{coupon_id}:max'
+
+    # Limite por cliente do cupom, usos do cliente no cupom e pedidos do cliente
+    def _customer_keys(self, coupon_id, customer_id):
+        return (f'{self.prefix}:{coupon_id}:max-per-customer', f'{self.prefix}:{coupon_id}:customer:{customer_id}',
+                f'{self.prefix}:customer:{customer_id}:orders')
+
+    # O cliente fica no final, porque o seu id pode conter o separador; vazio quando não informado.
+    # Os scripts acrescentam o id do evento ('época|sequência') no início
+    @staticmethod
+    def _encode(coupon_id, use_date, customer_id, delta):
+        return f'{coupon_id}|{use_date.strftime(DATETIME_FORMAT)}|{delta}|{customer_id or ""}'
+
+    @staticmethod
+    def _decode(item):
+        epoch, sequence, coupon_id, use_date, delta, customer_id = (
+            item.decode() if isinstance(item, bytes) else item).split('|', 5)
+        return (int(coupon_id), datetime.strptime(use_date, DATETIME_FORMAT), customer_id or None, int(delta),
+                (epoch, int(sequence)))
+
+    def reserve(self, coupon_id, use_date, customer_id=None, first_purchase_only=False):
+        used_key, max_key = self._keys(coupon_id)
+        customer_keys = self._customer_keys(coupon_id, customer_id)
+        # Os limites e o histórico do cliente só são lidos do banco enquanto os contadores ainda não existem no Redis
+        if self.client.exists(used_key):
+            max_uses, uses_count, max_uses_per_customer = 0, 0, None
+        else:
+            max_uses, uses_count, max_uses_per_customer = self.load_limits(coupon_id)
+        orders_count, customer_uses = 0, 0
+        if customer_id is not None and self.client.exists(*customer_keys[1:]) < 2:
+            orders_count, customer_uses = self.load_customer(coupon_id, customer_id)
+        return self._reserve(keys=[used_key, max_key, self.pending_key, *customer_keys, self.events_key],
+                             args=[max_uses, uses_count, '' if max_uses_per_customer is None else max_uses_per_customer,
+                                   self._encode(coupon_id, use_date, customer_id, 1), customer_uses, orders_count,
+                                   int(first_purchase_only), int(customer_id is not None), uuid.uuid4().hex]) == 1
+
+    def release(self, coupon_id, use_date, customer_id=None):
+        used_key, _ = self._keys(coupon_id)
+        keys = [used_key, self.pending_key, self.events_key]
+        if customer_id is not None:
+            keys.extend(self._customer_keys(coupon_id, customer_id)[1:])
+        self._release(keys=keys, args=[self._encode(coupon_id, use_date, customer_id, -1), uuid.uuid4().hex])
+
+    def customer_history(self, coupon_id, customer_id):
+        _, uses_key, orders_key = self._customer_keys(coupon_id, customer_id)
+        customer_uses, orders_count = self.client.mget(uses_key, orders_key)
+        if customer_uses is None or orders_count is None:
+            return None
+        return int(orders_count), int(customer_uses)
+
+    def add_orders(self, customer_id, count):
+        self._add_orders(keys=[self._customer_keys(0, customer_id)[2]], args=[count])
+
+    def claim(self, limit):
+        # Apenas um processo reconcilia por vez; o lock expira sozinho se o processo cair
+        if not self.client.set(self.lock_key, '1', nx=True, ex=self.lock_timeout):
+            return []
+        items = self.client.lrange(self.pending_key, 0, limit - 1)
+        if not items:
+            self.client.delete(self.lock_key)
+        return [self._decode(item) for item in items]
+
+    def complete(self, items):
+        # Os eventos gravados são os primeiros da lista: novos eventos entram sempre no final
+        self.client.ltrim(self.pending_key, len(items), -1)
+        self.client.delete(self.lock_key)
+
+    def requeue(self, items):
+        self.client.delete(self.lock_key)
+
+
+# Lendo (max_uses, uses_count) de um cupom no banco, para iniciar os contadores memory e redis
+def sql_limits_loader(engine):
+    def load_limits(coupon_id):
+        with engine.connect() as connection:
+            row = connection.execute(LIMITS_SQL, {'coupon_id': coupon_id}).first()
+        return (row.max_uses, row.uses_count, row.max_uses_per_customer) if row else (0, 0, None)
+    return load_limits
+
+
+# Lendo (pedidos, usos do cupom) de um cliente no banco, para iniciar os contadores dos clientes em memory e redis
+def sql_customer_loader(engine):
+    def load_customer(coupon_id, customer_id):
+        with engine.connect() as connection:
+            orders_count, customer_uses = connection.execute(CUSTOMER_HISTORY_SQL, {'coupon_id': coupon_id,
+                                                                                    'customer_id': customer_id}).one()
+        return orders_count or 0, customer_uses
+    return load_customer
+
+
+# Descartando os eventos já gravados por uma reconciliação anterior, interrompida antes de confirmar a
+# retirada deles no backend (complete), e registrando o último evento do lote na mesma transação
+def skip_reconciled(connection, event_log, items):
+    row = connection.execute(LAST_EVENT_SQL, {'backend': event_log}).first()
+    if row:
+        items = [item for item in items if item[4][0] != row.epoch or item[4][1] > row.last_event_id]
+    if items:
+        epoch, event_id = items[-1][4]
+        connection.execute(SAVE_LAST_EVENT_SQL, {'backend': event_log, 'epoch': epoch, 'event_id': event_id})
+    return items
+
+
+# Gravando no banco os eventos pendentes do backend, em lotes: insere os usos reservados na tabela Use,
+# remove os usos devolvidos e ajusta o uses_count de cada cupom e o histórico de pedidos de cada cliente,
+# na mesma transação. Retorna a quantidade de eventos retirados do backend.
+def reconcile(backend, engine, batch_size=1000):
+    total = 0
+    while True:
+        claimed = backend.claim(batch_size)
+        if not claimed:
+            return total
+        try:
+            with engine.begin() as connection:
+                items = claimed
+                if backend.event_log is not None:
+                    items = skip_reconciled(connection, backend.event_log, items)
+                # Uma reserva e a sua devolução no mesmo lote se anulam
+                uses = Counter()
+                for coupon_id, use_date, customer_id, delta, _ in items:
+                    uses[coupon_id, use_date, customer_id] += delta
+                counts = Counter()
+                orders = Counter()
+                order_dates = {}
+                for (coupon_id, use_date, customer_id), delta in uses.items():
+                    counts[coupon_id] += delta
+                    if customer_id is not None:
+                        orders[customer_id] += delta
+                        order_dates[customer_id] = min(use_date, order_dates.get(customer_id, use_date))
+                inserted = [{'coupon_id': coupon_id, 'use_date': use_date.strftime(DATETIME_FORMAT),
+                             'customer_id': customer_id}
+                            for (coupon_id, use_date, customer_id), delta in uses.items() for _ in range(delta)]
+                if inserted:
+                    connection.execute(INSERT_USE_SQL, inserted)
+                # Devoluções de usos gravados em um lote anterior
+                for (coupon_id, use_date, customer_id), delta in uses.items():
+                    for _ in range(-delta):
+                        connection.execute(DELETE_USE_SQL, {'coupon_id': coupon_id,
+                                                            'use_date': use_date.strftime(DATETIME_FORMAT),
+                                                            'customer_id': customer_id})
+                for coupon_id, count in counts.items():
+                    if count:
+                        connection.execute(ADD_USES_SQL, {'coupon_id': coupon_id, 'count': count})
+                for customer_id, count in orders.items():
+                    if count:
+                        add_orders(connection, customer_id, count, order_dates[customer_id])
+        except Exception:
+            backend.requeue(claimed)
+            raise
+        backend.complete(claimed)
+        total += len(claimed)
+        if len(claimed) < batch_size:
+            return total
+
+
+# Executando a reconciliação periodicamente em uma thread da aplicação
+class Reconciler(threading.Thread):
+
+    def __init__(self, backend, engine, interval=1.0, batch_size=1000):
+        super().__init__(name='counter-reconciler', daemon=True)
+        self.backend = backend
+        self.engine = engine
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                reconcile(self.backend, self.engine, self.batch_size)
+            except Exception:
+                logger.exception('Falha ao reconciliar os usos pendentes')
+
+    # Parando a thread e gravando os usos que ainda estão pendentes
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        reconcile(self.backend, self.engine, self.batch_size)
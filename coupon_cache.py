@@ -0,0 +1,93 @@
+# Importando as bibliotecas necessárias
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# Atributos imutáveis do cupom, suficientes para a validação e o cálculo do desconto.
+# O número de usos não faz parte do cache: ele continua sendo controlado pelo banco de dados.
+CachedCoupon = namedtuple('CachedCoupon', ['id', 'code', 'expiration_date', 'min_value_cents', 'discount_type',
+                                           'discount_amount_cents', 'public', 'first_purchase', 'max_uses_per_customer',
+                                           'rules'],
+                          defaults=(None, None))
+
+# Marcador para códigos que não existem no banco de dados (cache negativo)
+MISSING = object()
+
+
+# Criando uma cópia dos atributos imutáveis de um cupom
+def snapshot(coupon):
+    return CachedCoupon(id=coupon.id,
+                        code=coupon.code,
+                        expiration_date=coupon.expiration_date,
+                        min_value_cents=coupon.min_value_cents,
+                        discount_type=coupon.discount_type,
+                        discount_amount_cents=coupon.discount_amount_cents,
+                        public=coupon.public,
+                        first_purchase=coupon.first_purchase,
+                        max_uses_per_customer=coupon.max_uses_per_customer,
+                        rules=coupon.rules)
+
+
+# Cache LRU com tempo de expiração, indexado pelo código do cupom
+class CouponCache:
+
+    def __init__(self, max_size=1024, ttl=60, negative_ttl=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Buscando o cupom no cache, ou carregando do banco com a função loader (read-through).
+    # O loader deve retornar o cupom ou None quando o código não existe.
+    def get(self, code, loader):
+        found, value = self.lookup(code)
+        if found:
+            return value
+        value = loader(code)
+        self.put(code, value)
+        return value
+
+    # Consultando apenas o cache, sem carregar do banco: retorna (encontrado, cupom ou None).
+    # Usado quando o carregamento não pode ser feito por uma função síncrona (ex.: app_async.py).
+    def lookup(self, code):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(code)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(code)
+                self.hits += 1
+                return True, None if entry[0] is MISSING else entry[0]
+            self.misses += 1
+        return False, None
+
+    # Guardando um cupom (ou a ausência dele) no cache
+    def put(self, code, value):
+        if self.max_size <= 0:
+            return
+        if value is None:
+            value, ttl = MISSING, self.negative_ttl
+        else:
+            ttl = self.ttl
+        with self._lock:
+            self._entries[code] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(code)
+            # Removendo os cupons usados há mais tempo quando o limite é atingido
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    # Removendo um código do cache, por exemplo após o cadastro de um cupom
+    def invalidate(self, code):
+        with self._lock:
+            self._entries.pop(code, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
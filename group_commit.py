@@ -0,0 +1,155 @@
+# Importando as bibliotecas necessárias
+import atexit
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy.exc import IntegrityError
+
+from counters import add_orders, insert_use, reserve_count, reserve_in_database
+from idempotency import forget_response, store_response
+
+logger = logging.getLogger(__name__)
+
+# Níveis de durabilidade do modo de commit em grupo:
+#   commit  - a resposta só é enviada depois do commit do lote: nenhum uso confirmado se perde
+#   reserve - a reserva (UPDATE condicional do uses_count e a chave de idempotência) é confirmada em uma
+#             transação curta da própria requisição, antes da resposta, e somente o registro do uso na
+#             tabela Use vai para o lote. Em uma queda, nenhum uso confirmado sai do contador; apenas os
+#             registros de auditoria ainda não gravados podem faltar na tabela Use. Os consumos de um cliente
+#             identificado são registrados na própria transação, porque o limite por cliente conta a tabela Use.
+DURABILITY_LEVELS = ('commit', 'reserve')
+
+# Resultados de um consumo
+RESERVED = 'reserved'
+EXHAUSTED = 'exhausted'
+# Outra requisição com a mesma Idempotency-Key já consumiu o cupom
+REPLAYED = 'replayed'
+
+
+# Registro de consumos com commit em grupo: as reservas de várias requisições (ou, com 'reserve', os
+# registros dos usos já reservados) são gravadas por uma única thread, em transações de até max_batch
+# itens ou max_delay segundos, e o custo do commit (fsync) é dividido entre todas as requisições do lote.
+class GroupCommitLog:
+
+    def __init__(self, engine, max_batch=256, max_delay=0.002, durability='commit'):
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f'Durabilidade desconhecida: {durability}')
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.durability = durability
+        self._queue = queue.Queue()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # Reservando um uso do cupom e registrando o uso; retorna RESERVED, EXHAUSTED ou REPLAYED.
+    # idempotency é (chave, código, resposta, expiração), gravada no mesmo lote que o uso.
+    # customer é (customer_id, first_purchase_only), verificado no mesmo UPDATE da reserva (ver counters.py)
+    def redeem(self, coupon_id, use_date, idempotency=None, customer=None, timeout=30):
+        if self.durability == 'reserve':
+            return self._reserve(coupon_id, use_date, idempotency, customer)
+        future = Future()
+        self._queue.put((coupon_id, use_date, idempotency, customer, future))
+        return future.result(timeout)
+
+    # Gravando os consumos pendentes e encerrando a thread de escrita
+    def close(self):
+        if not self._stopped.is_set():
+            self._stopped.set()
+            self._queue.put(None)
+            self._thread.join()
+
+    # Coletando o próximo lote: espera o primeiro item e junta os que chegarem até max_delay
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    # Modo 'reserve': confirmando a reserva antes de responder e enviando somente o registro do uso para o lote
+    def _reserve(self, coupon_id, use_date, idempotency, customer):
+        with self.engine.connect() as connection:
+            transaction = connection.begin()
+            try:
+                result = self._reserve_count(connection, coupon_id, use_date, idempotency, customer)
+            except Exception:
+                transaction.rollback()
+                raise
+            if result != RESERVED:
+                transaction.rollback()
+                return result
+            transaction.commit()
+        if not customer:
+            self._queue.put((coupon_id, use_date, None, None, None))
+        return RESERVED
+
+    def _reserve_count(self, connection, coupon_id, use_date, idempotency, customer):
+        if idempotency:
+            key, code, response, expires_at = idempotency
+            try:
+                store_response(connection, key, code, response, use_date, expires_at)
+            except IntegrityError:
+                return REPLAYED
+        if not reserve_count(connection, coupon_id, *(customer or ())):
+            return EXHAUSTED
+        if customer:
+            insert_use(connection, coupon_id, use_date, customer[0])
+            add_orders(connection, customer[0], 1, use_date)
+        return RESERVED
+
+    def _redeem(self, connection, coupon_id, use_date, idempotency, customer):
+        # Gravando primeiro a chave de idempotência: se ela já foi usada, o cupom não é tocado
+        if idempotency:
+            key, code, response, expires_at = idempotency
+            try:
+                store_response(connection, key, code, response, use_date, expires_at)
+            except IntegrityError:
+                return REPLAYED
+        # O UPDATE condicional continua sendo a autoridade sobre o limite de usos
+        if not reserve_in_database(connection, coupon_id, use_date, *(customer or ())):
+            # Desfazendo somente a chave deste consumo, sem desfazer o restante do lote
+            if idempotency:
+                forget_response(connection, idempotency[0])
+            return EXHAUSTED
+        return RESERVED
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            results = []
+            try:
+                with self.engine.begin() as connection:
+                    for coupon_id, use_date, idempotency, customer, future in batch:
+                        # Sem future, é o registro de um uso já reservado e confirmado (modo 'reserve')
+                        if future is None:
+                            insert_use(connection, coupon_id, use_date)
+                        else:
+                            results.append((future, self._redeem(connection, coupon_id, use_date, idempotency, customer)))
+            except Exception as error:
+                logger.exception('Falha ao gravar um lote de %d consumos', len(batch))
+                for *_, future in batch:
+                    if future is not None and not future.done():
+                        future.set_exception(error)
+                continue
+            # Respondendo às requisições somente depois do commit do lote
+            for future, result in results:
+                future.set_result(result)
@@ -0,0 +1,58 @@
+# Chaves de idempotência dos consumos (cabeçalho Idempotency-Key).
+# A resposta de um consumo bem-sucedido é gravada na mesma transação do uso, indexada pelo hash da chave.
+# Uma nova tentativa com a mesma chave devolve a resposta gravada com uma única leitura pela chave primária,
+# sem validar o cupom novamente, sem consumir outro uso e sem pedir o lock de escrita.
+# Consumos recusados não são gravados: uma nova tentativa é avaliada novamente, sem alterar o banco.
+
+# Importando as bibliotecas necessárias
+import hashlib
+import json
+
+from sqlalchemy import text
+
+# Tamanho máximo aceito para a chave enviada pelo cliente
+MAX_KEY_LENGTH = 255
+
+# Formato de data usado pelo SQLAlchemy nas colunas DateTime do SQLite
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+FIND_SQL = text('SELECT code, response FROM idempotency_key WHERE key = :key AND expires_at >= :now')
+DELETE_EXPIRED_KEY_SQL = text('DELETE FROM idempotency_key WHERE key = :key AND expires_at < :now')
+INSERT_SQL = text('INSERT INTO idempotency_key (key, code, response, expires_at) '
+                  'VALUES (:key, :code, :response, :expires_at)')
+FORGET_SQL = text('DELETE FROM idempotency_key WHERE key = :key')
+PURGE_SQL = ('DELETE FROM idempotency_key WHERE key IN '
+             '(SELECT key FROM idempotency_key WHERE expires_at < ? LIMIT ?)')
+
+
+# Guardando apenas um hash de 16 bytes da chave, com tamanho fixo, qualquer que seja a chave do cliente
+def key_digest(key):
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+
+
+# Buscando a resposta gravada para a chave; retorna (código do cupom, resposta) ou None
+def find_response(connection, key, now):
+    row = connection.execute(FIND_SQL, {'key': key_digest(key), 'now': now.strftime(DATETIME_FORMAT)}).first()
+    if row is None:
+        return None
+    return row.code, json.loads(row.response)
+
+
+# Gravando a resposta de um consumo na transação atual. Se outra requisição gravou a mesma chave
+# antes, a inserção falha com IntegrityError e a transação inteira (inclusive o uso) deve ser desfeita.
+def store_response(connection, key, code, response, now, expires_at):
+    digest = key_digest(key)
+    # Liberando a chave se ela existir apenas com uma resposta já expirada
+    connection.execute(DELETE_EXPIRED_KEY_SQL, {'key': digest, 'now': now.strftime(DATETIME_FORMAT)})
+    connection.execute(INSERT_SQL, {'key': digest, 'code': code, 'response': json.dumps(response),
+                                    'expires_at': expires_at.strftime(DATETIME_FORMAT)})
+
+
+# Removendo a resposta gravada na transação atual, quando o consumo não pôde ser concluído
+def forget_response(connection, key):
+    connection.execute(FORGET_SQL, {'key': key_digest(key)})
+
+
+# Removendo um lote de chaves expiradas (conexão sqlite3); retorna a quantidade removida
+def purge_expired(connection, now, limit=1000):
+    return connection.execute(PURGE_SQL, (now.strftime(DATETIME_FORMAT), limit)).rowcount
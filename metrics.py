@@ -0,0 +1,256 @@
+# Métricas das aplicações Flask, expostas em GET /metrics no formato texto do Prometheus:
+#   coupon_http_request_duration_seconds   histograma de latência por endpoint
+#   coupon_http_requests_total             requisições por endpoint e status
+#   coupon_sql_statements_per_request      histograma de comandos SQL por requisição
+#   coupon_sql_duration_seconds            histograma do tempo em comandos SQL por requisição
+#   coupon_sql_statements_total            comandos SQL por endpoint e tipo (SELECT, INSERT, ...)
+#   coupon_rejections_total                respostas de erro por endpoint e motivo ("Cupom expirado", ...)
+#
+# O profiler por amostragem é opcional (METRICS_PROFILE_SAMPLE_RATE entre 0 e 1): uma fração das
+# requisições é executada com o cProfile, e as mais lentas ficam disponíveis em GET /metrics/slowest.
+
+# Importando as bibliotecas necessárias
+import cProfile
+import heapq
+import io
+import itertools
+import pstats
+import random
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Limites dos buckets dos histogramas
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+# Histograma cumulativo no formato do Prometheus
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield f'{name}_bucket', dict(labels, le=str(bound)), cumulative
+        yield f'{name}_sum', labels, self.sum
+        yield f'{name}_count', labels, self.count
+
+
+# Registro das métricas de uma aplicação
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.latency = {}
+            self.requests = {}
+            self.sql_statements = {}
+            self.sql_duration = {}
+            self.sql_statements_total = {}
+            self.rejections = {}
+
+    # Registrando uma requisição finalizada
+    def observe_request(self, endpoint, method, status, duration, statements, sql_duration, statement_verbs, error):
+        with self._lock:
+            self.latency.setdefault((endpoint, method), Histogram(LATENCY_BUCKETS)).observe(duration)
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.sql_statements.setdefault(endpoint, Histogram(STATEMENT_BUCKETS)).observe(statements)
+            self.sql_duration.setdefault(endpoint, Histogram(LATENCY_BUCKETS)).observe(sql_duration)
+            for verb, count in statement_verbs.items():
+                key = (endpoint, verb)
+                self.sql_statements_total[key] = self.sql_statements_total.get(key, 0) + count
+            if error:
+                key = (endpoint, error)
+                self.rejections[key] = self.rejections.get(key, 0) + 1
+
+    # Gerando o texto no formato de exposição do Prometheus
+    def render(self):
+        lines = []
+
+        def family(name, kind, description, samples):
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for sample_name, labels, value in samples:
+                lines.append(f'{sample_name}{format_labels(labels)} {format_value(value)}')
+
+        with self._lock:
+            family('coupon_http_request_duration_seconds', 'histogram', 'Latência das requisições por endpoint.',
+                   [sample for (endpoint, method), histogram in sorted(self.latency.items())
+                    for sample in histogram.samples('coupon_http_request_duration_seconds',
+                                                    {'endpoint': endpoint, 'method': method})])
+            family('coupon_http_requests_total', 'counter', 'Requisições por endpoint e status.',
+                   [('coupon_http_requests_total', {'endpoint': endpoint, 'method': method, 'status': str(status)}, count)
+                    for (endpoint, method, status), count in sorted(self.requests.items())])
+            family('coupon_sql_statements_per_request', 'histogram', 'Comandos SQL executados por requisição.',
+                   [sample for endpoint, histogram in sorted(self.sql_statements.items())
+                    for sample in histogram.samples('coupon_sql_statements_per_request', {'endpoint': endpoint})])
+            family('coupon_sql_duration_seconds', 'histogram', 'Tempo gasto em comandos SQL por requisição.',
+                   [sample for endpoint, histogram in sorted(self.sql_duration.items())
+                    for sample in histogram.samples('coupon_sql_duration_seconds', {'endpoint': endpoint})])
+            family('coupon_sql_statements_total', 'counter', 'Comandos SQL por endpoint e tipo.',
+                   [('coupon_sql_statements_total', {'endpoint': endpoint, 'statement': verb}, count)
+                    for (endpoint, verb), count in sorted(self.sql_statements_total.items())])
+            family('coupon_rejections_total', 'counter', 'Respostas de erro por endpoint e motivo.',
+                   [('coupon_rejections_total', {'endpoint': endpoint, 'reason': reason}, count)
+                    for (endpoint, reason), count in sorted(self.rejections.items())])
+        return '\n'.join(lines) + '\n'
+
+
+# Escapando os valores dos rótulos (barra invertida, aspas e quebra de linha)
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels.items()) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Profiler por amostragem que guarda as requisições mais lentas entre as amostradas
+class SlowRequestProfiler:
+
+    def __init__(self):
+        # O cProfile só pode perfilar uma requisição por vez
+        self._busy = threading.Lock()
+        self._lock = threading.Lock()
+        self._slowest = []
+        self._sequence = itertools.count()
+
+    def start(self, sample_rate):
+        if sample_rate <= 0 or random.random() >= sample_rate or not self._busy.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def cancel(self, profile):
+        profile.disable()
+        self._busy.release()
+
+    def stop(self, profile, label, duration, keep):
+        self.cancel(profile)
+        with self._lock:
+            # Guardando a amostra somente se ela estiver entre as `keep` mais lentas
+            if len(self._slowest) >= keep and duration <= self._slowest[0][0]:
+                return
+            entry = (duration, next(self._sequence), label, pstats.Stats(profile))
+            heapq.heappush(self._slowest, entry)
+            while len(self._slowest) > keep:
+                heapq.heappop(self._slowest)
+
+    # Gerando o relatório das requisições mais lentas, da mais lenta para a mais rápida
+    def dump(self, limit=25):
+        with self._lock:
+            entries = sorted(self._slowest, reverse=True)
+        output = io.StringIO()
+        for duration, _, label, stats in entries:
+            output.write(f'=== {label} {duration * 1000:.3f} ms\n')
+            stats.stream = output
+            stats.sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
+
+    def clear(self):
+        with self._lock:
+            self._slowest = []
+
+
+# Contando os comandos SQL e o tempo gasto neles na requisição atual (de qualquer aplicação com métricas)
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'metrics_started' in g:
+        g.metrics_sql_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not has_request_context() or g.get('metrics_sql_started') is None:
+        return
+    g.metrics_sql_duration += time.perf_counter() - g.metrics_sql_started
+    g.metrics_sql_started = None
+    verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+    g.metrics_sql_verbs[verb] = g.metrics_sql_verbs.get(verb, 0) + 1
+
+
+_listening = False
+
+
+# Instalando as métricas e o profiler em uma aplicação Flask
+def install_metrics(app):
+    global _listening
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listening = True
+
+    app.config.setdefault('METRICS_PROFILE_SAMPLE_RATE', 0.0)
+    app.config.setdefault('METRICS_PROFILE_KEEP', 10)
+    metrics = Metrics()
+    profiler = SlowRequestProfiler()
+    app.extensions['metrics'] = metrics
+    app.extensions['metrics_profiler'] = profiler
+
+    @app.before_request
+    def start_metrics():
+        g.metrics_sql_duration = 0.0
+        g.metrics_sql_verbs = {}
+        g.metrics_profile = profiler.start(app.config['METRICS_PROFILE_SAMPLE_RATE'])
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def record_metrics(response):
+        if 'metrics_started' not in g:
+            return response
+        duration = time.perf_counter() - g.metrics_started
+        # Usando a regra da rota (/coupons/<code>), e não o caminho, para limitar o número de séries
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        if g.metrics_profile is not None:
+            profiler.stop(g.metrics_profile, f'{request.method} {request.path} {response.status_code}',
+                          duration, app.config['METRICS_PROFILE_KEEP'])
+            g.metrics_profile = None
+        error = None
+        if response.status_code >= 400 and response.is_json and not response.is_streamed:
+            body = response.get_json(silent=True)
+            error = body.get('error') if isinstance(body, dict) else None
+        metrics.observe_request(endpoint, request.method, response.status_code, duration,
+                                sum(g.metrics_sql_verbs.values()), g.metrics_sql_duration, g.metrics_sql_verbs, error)
+        return response
+
+    # Liberando o profiler se a requisição terminar com uma exceção não tratada
+    @app.teardown_request
+    def release_profiler(exception):
+        if g.get('metrics_profile') is not None:
+            profiler.cancel(g.metrics_profile)
+            g.metrics_profile = None
+
+    def metrics_endpoint():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+    def slowest_endpoint():
+        return Response(profiler.dump(), mimetype='text/plain; charset=utf-8')
+
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint, methods=['GET'])
+    app.add_url_rule('/metrics/slowest', 'metrics_slowest', slowest_endpoint, methods=['GET'])
+    return metrics
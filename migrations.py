@@ -0,0 +1,210 @@
+# Importando as bibliotecas necessárias
+import sqlite3
+import sys
+from contextlib import closing
+
+# Migrações do esquema do banco de dados SQLite.
+# A versão do esquema fica em PRAGMA user_version, e cada migração roda em uma transação própria,
+# junto com a atualização da versão. Bancos criados antes do versionamento têm versão 0.
+
+
+# Listando as colunas de uma tabela
+def table_columns(connection, table):
+    return [row[1] for row in connection.execute(f'PRAGMA table_info("{table}")')]
+
+
+# Verificando se a tabela tem algum registro
+def table_is_empty(connection, table):
+    return connection.execute(f'SELECT 1 FROM "{table}" LIMIT 1').fetchone() is None
+
+
+# Recalculando o contador de usos de cada cupom a partir do histórico da tabela Use
+def backfill_uses_count(connection):
+    connection.execute('UPDATE coupon SET uses_count = '
+                       '(SELECT COUNT(*) FROM use WHERE use.coupon_id = coupon.id)')
+
+
+# Versão 1: tabelas iniciais, como criadas pelas primeiras versões da aplicação
+def create_base_tables(connection):
+    connection.execute('CREATE TABLE IF NOT EXISTS coupon ('
+                       'id INTEGER NOT NULL, '
+                       'code VARCHAR(20) NOT NULL, '
+                       'expiration_date DATETIME NOT NULL, '
+                       'max_uses INTEGER NOT NULL, '
+                       'min_value FLOAT NOT NULL, '
+                       'discount_type VARCHAR(10) NOT NULL, '
+                       'discount_amount FLOAT NOT NULL, '
+                       'public BOOLEAN NOT NULL, '
+                       'first_purchase BOOLEAN NOT NULL, '
+                       'PRIMARY KEY (id), '
+                       'UNIQUE (code))')
+    connection.execute('CREATE TABLE IF NOT EXISTS use ('
+                       'id INTEGER NOT NULL, '
+                       'coupon_id INTEGER NOT NULL, '
+                       'use_date DATETIME NOT NULL, '
+                       'PRIMARY KEY (id), '
+                       'FOREIGN KEY(coupon_id) REFERENCES coupon (id))')
+
+
+# Versão 2: contador de usos em Coupon, preenchido a partir do histórico
+def add_uses_count(connection):
+    if 'uses_count' not in table_columns(connection, 'coupon'):
+        connection.execute('ALTER TABLE coupon ADD COLUMN uses_count INTEGER NOT NULL DEFAULT 0')
+        backfill_uses_count(connection)
+
+
+# Versão 3: valores monetários em centavos inteiros no lugar de Float.
+# Com a tabela vazia ou em SQLite sem RENAME COLUMN, a tabela é recriada com colunas INTEGER;
+# caso contrário os valores são convertidos no lugar e as colunas apenas renomeadas, sem reescrever a tabela.
+def convert_money_to_cents(connection):
+    if 'min_value_cents' in table_columns(connection, 'coupon'):
+        return
+
+    if table_is_empty(connection, 'coupon') or sqlite3.sqlite_version_info < (3, 25, 0):
+        connection.execute('CREATE TABLE coupon_new ('
+                           'id INTEGER NOT NULL, '
+                           'code VARCHAR(20) NOT NULL, '
+                           'expiration_date DATETIME NOT NULL, '
+                           'max_uses INTEGER NOT NULL, '
+                           'min_value_cents INTEGER NOT NULL, '
+                           'discount_type VARCHAR(10) NOT NULL, '
+                           'discount_amount_cents INTEGER NOT NULL, '
+                           'public BOOLEAN NOT NULL, '
+                           'first_purchase BOOLEAN NOT NULL, '
+                           'uses_count INTEGER NOT NULL DEFAULT 0, '
+                           'PRIMARY KEY (id), '
+                           'UNIQUE (code))')
+        connection.execute('INSERT INTO coupon_new '
+                           'SELECT id, code, expiration_date, max_uses, CAST(ROUND(min_value * 100) AS INTEGER), '
+                           'discount_type, CAST(ROUND(discount_amount * 100) AS INTEGER), public, first_purchase, '
+                           'uses_count FROM coupon')
+        connection.execute('DROP TABLE coupon')
+        connection.execute('ALTER TABLE coupon_new RENAME TO coupon')
+        return
+
+    connection.execute('UPDATE coupon SET '
+                       'min_value = CAST(ROUND(min_value * 100) AS INTEGER), '
+                       'discount_amount = CAST(ROUND(discount_amount * 100) AS INTEGER)')
+    connection.execute('ALTER TABLE coupon RENAME COLUMN min_value TO min_value_cents')
+    connection.execute('ALTER TABLE coupon RENAME COLUMN discount_amount TO discount_amount_cents')
+
+
+# Versão 4: índices para contagem de usos, consultas por data e listagem de cupons públicos
+def add_indexes(connection):
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_use_coupon_id_use_date ON use (coupon_id, use_date)')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_use_use_date ON use (use_date)')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_coupon_expiration_date ON coupon (expiration_date)')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_coupon_public_expiration_date ON coupon (public, expiration_date)')
+    # O índice composto já atende às buscas só por coupon_id
+    connection.execute('DROP INDEX IF EXISTS ix_use_coupon_id')
+
+
+# Versão 5: respostas dos consumos por chave de idempotência (hash da chave), com data de expiração
+def add_idempotency_keys(connection):
+    connection.execute('CREATE TABLE IF NOT EXISTS idempotency_key ('
+                       'key BLOB NOT NULL PRIMARY KEY, '
+                       'code VARCHAR(20) NOT NULL, '
+                       'response TEXT NOT NULL, '
+                       'expires_at DATETIME NOT NULL) WITHOUT ROWID')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_idempotency_key_expires_at ON idempotency_key (expires_at)')
+
+
+# Versão 6: clientes. O cliente de cada uso, o limite de usos por cliente e o histórico de pedidos dos clientes.
+# O índice dos usos por cliente é parcial: os usos anteriores, sem cliente, não ocupam espaço nele.
+def add_customers(connection):
+    if 'customer_id' not in table_columns(connection, 'use'):
+        connection.execute('ALTER TABLE use ADD COLUMN customer_id VARCHAR(64)')
+    if 'max_uses_per_customer' not in table_columns(connection, 'coupon'):
+        connection.execute('ALTER TABLE coupon ADD COLUMN max_uses_per_customer INTEGER')
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_use_coupon_id_customer_id ON use (coupon_id, customer_id) '
+                       'WHERE customer_id IS NOT NULL')
+    connection.execute('CREATE TABLE IF NOT EXISTS customer ('
+                       'customer_id VARCHAR(64) NOT NULL PRIMARY KEY, '
+                       'orders_count INTEGER NOT NULL DEFAULT 0, '
+                       'first_order_date DATETIME NOT NULL) WITHOUT ROWID')
+
+
+# Versão 7: regras opcionais dos cupons (ver rules.py)
+def add_coupon_rules(connection):
+    if 'rules' not in table_columns(connection, 'coupon'):
+        connection.execute('ALTER TABLE coupon ADD COLUMN rules TEXT')
+
+
+# Versão 8: último evento dos contadores redis gravado pela reconciliação (ver counters.py), por backend
+def add_reconciled_events(connection):
+    connection.execute('CREATE TABLE IF NOT EXISTS reconciled_event ('
+                       'backend VARCHAR(64) NOT NULL PRIMARY KEY, '
+                       'epoch VARCHAR(32) NOT NULL, '
+                       'last_event_id INTEGER NOT NULL) WITHOUT ROWID')
+
+
+# Lista das migrações, em ordem: (versão, descrição, função)
+MIGRATIONS = [
+    (1, 'tabelas iniciais', create_base_tables),
+    (2, 'contador de usos', add_uses_count),
+    (3, 'valores em centavos', convert_money_to_cents),
+    (4, 'índices', add_indexes),
+    (5, 'chaves de idempotência', add_idempotency_keys),
+    (6, 'clientes', add_customers),
+    (7, 'regras dos cupons', add_coupon_rules),
+    (8, 'eventos reconciliados', add_reconciled_events),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+# Lendo a versão atual do esquema
+def current_version(connection):
+    return connection.execute('PRAGMA user_version').fetchone()[0]
+
+
+# Aplicando as migrações pendentes em uma conexão sqlite3
+def upgrade_connection(connection):
+    isolation_level = connection.isolation_level
+    # Controlando as transações manualmente, para que DDL e versão sejam gravados juntos
+    connection.isolation_level = None
+    applied = []
+    try:
+        for version, description, migrate in MIGRATIONS:
+            if version <= current_version(connection):
+                continue
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                migrate(connection)
+                connection.execute(f'PRAGMA user_version = {version}')
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            applied.append((version, description))
+    finally:
+        connection.isolation_level = isolation_level
+    return applied
+
+
+# Aplicando as migrações pendentes no banco de uma engine do SQLAlchemy
+def upgrade(engine):
+    raw_connection = engine.raw_connection()
+    try:
+        return upgrade_connection(getattr(raw_connection, 'driver_connection', None) or raw_connection.connection)
+    finally:
+        raw_connection.close()
+
+
+# Executando a migração manualmente: python migrations.py [caminho do banco] [--status] [--recount]
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    path = args[0] if args else 'coupons.db'
+
+    with closing(sqlite3.connect(path)) as connection:
+        if '--status' in sys.argv:
+            print(f'Banco de dados {path}: versão {current_version(connection)} (última: {LATEST_VERSION})')
+            sys.exit(0)
+
+        for version, description in upgrade_connection(connection):
+            print(f'Migração {version} aplicada: {description}')
+        # Permitindo recalcular os contadores caso o histórico tenha sido alterado manualmente
+        if '--recount' in sys.argv:
+            with connection:
+                backfill_uses_count(connection)
+    print(f'Banco de dados {path} atualizado')
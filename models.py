@@ -0,0 +1,118 @@
+# Modelos das tabelas do banco, compartilhados por app.py e app2.py.
+# O objeto db não fica ligado a nenhuma aplicação na importação: cada aplicação criada pela fábrica
+# (create_app) se registra com db.init_app, e a engine só é criada no primeiro acesso ao banco,
+# com a configuração daquela aplicação.
+# O esquema do banco não é criado na importação: ele é criado e atualizado pelas migrações (migrations.py).
+
+# Importando as bibliotecas necessárias
+from money import Cents, to_cents, from_cents
+from sqlite_profile import ProfiledSQLAlchemy
+
+# Cada engine recebe os PRAGMAs do perfil SQLite (SQLITE_PROFILE) da sua aplicação
+db = ProfiledSQLAlchemy()
+
+
+# Definindo o modelo da tabela de cupons
+class Coupon(db.Model):
+    __table_args__ = (db.Index('ix_coupon_expiration_date', 'expiration_date'),
+                      db.Index('ix_coupon_public_expiration_date', 'public', 'expiration_date'))
+
+    id = db.Column(db.Integer, primary_key=True)
+    code = db.Column(db.String(20), unique=True, nullable=False)
+    expiration_date = db.Column(db.DateTime, nullable=False)
+    max_uses = db.Column(db.Integer, nullable=False)
+    # Valores monetários em centavos inteiros, sem os erros de arredondamento do Float
+    min_value_cents = db.Column(Cents, nullable=False)
+    discount_type = db.Column(db.String(10), nullable=False)
+    # Desconto fixo em centavos, ou percentual em centésimos de ponto percentual (30% = 3000)
+    discount_amount_cents = db.Column(Cents, nullable=False)
+    public = db.Column(db.Boolean, nullable=False)
+    first_purchase = db.Column(db.Boolean, nullable=False)
+    # Contador de usos mantido junto com a tabela Use, evitando carregar o histórico a cada consumo
+    uses_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Limite de usos por cliente (customer_id), além do limite geral; None = sem limite por cliente
+    max_uses_per_customer = db.Column(db.Integer, nullable=True)
+    # Regras opcionais (categorias, janelas de horário, acúmulo), em JSON normalizado; ver rules.py
+    rules = db.Column(db.Text, nullable=True)
+    uses = db.relationship('Use', backref='coupon', lazy=True)
+
+    def __repr__(self):
+        return f"<Coupon {self.code}>"
+
+    # Valor mínimo em reais, como recebido e retornado pela API
+    @property
+    def min_value(self):
+        return from_cents(self.min_value_cents)
+
+    @min_value.setter
+    def min_value(self, value):
+        self.min_value_cents = to_cents(value)
+
+    # Valor do desconto em reais (ou percentual), como recebido e retornado pela API
+    @property
+    def discount_amount(self):
+        return from_cents(self.discount_amount_cents)
+
+    @discount_amount.setter
+    def discount_amount(self, value):
+        self.discount_amount_cents = to_cents(value)
+
+
+# Definindo o modelo da tabela de usos dos cupons
+class Use(db.Model):
+    __table_args__ = (db.Index('ix_use_coupon_id_use_date', 'coupon_id', 'use_date'),
+                      db.Index('ix_use_use_date', 'use_date'),
+                      # Contagem dos usos de um cupom por cliente; parcial, sem os usos anônimos
+                      db.Index('ix_use_coupon_id_customer_id', 'coupon_id', 'customer_id',
+                               sqlite_where=db.text('customer_id IS NOT NULL')))
+
+    id = db.Column(db.Integer, primary_key=True)
+    coupon_id = db.Column(db.Integer, db.ForeignKey('coupon.id'), nullable=False)
+    use_date = db.Column(db.DateTime, nullable=False)
+    # Cliente que consumiu o cupom; None nos usos anteriores à identificação dos clientes
+    customer_id = db.Column(db.String(64), nullable=True)
+
+    def __repr__(self):
+        return f"<Use {self.coupon_id} {self.use_date}>"
+
+
+# Definindo o modelo da tabela de clientes: o histórico de pedidos usado para saber se uma compra é a primeira.
+# Fica separado da tabela Use, cujos registros vão para o arquivo morto junto com os cupons expirados.
+class Customer(db.Model):
+    __tablename__ = 'customer'
+    __table_args__ = {'sqlite_with_rowid': False}
+
+    customer_id = db.Column(db.String(64), primary_key=True)
+    # Pedidos do cliente: consumos de cupons e pedidos registrados sem cupom
+    orders_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    first_order_date = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<Customer {self.customer_id}>"
+
+
+# Definindo o modelo da tabela de respostas dos consumos por chave de idempotência (ver idempotency.py)
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_key'
+    __table_args__ = (db.Index('ix_idempotency_key_expires_at', 'expires_at'), {'sqlite_with_rowid': False})
+
+    # Hash de 16 bytes da chave enviada no cabeçalho Idempotency-Key
+    key = db.Column(db.LargeBinary(16), primary_key=True)
+    code = db.Column(db.String(20), nullable=False)
+    response = db.Column(db.Text, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+# Definindo o modelo da tabela com o último evento dos contadores gravado pela reconciliação (ver counters.py).
+# Evita gravar de novo os eventos de uma reconciliação interrompida antes de retirá-los do Redis.
+class ReconciledEvent(db.Model):
+    __tablename__ = 'reconciled_event'
+    __table_args__ = {'sqlite_with_rowid': False}
+
+    # Prefixo das chaves do backend no Redis
+    backend = db.Column(db.String(64), primary_key=True)
+    epoch = db.Column(db.String(32), nullable=False)
+    last_event_id = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f"<ReconciledEvent {self.backend} {self.last_event_id}>"
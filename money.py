@@ -0,0 +1,30 @@
+# Importando as bibliotecas necessárias
+from decimal import Decimal, ROUND_HALF_UP
+from sqlalchemy.types import Integer, TypeDecorator
+
+
+# Convertendo um valor em reais (número do JSON) para centavos inteiros, sem erros de arredondamento do float
+def to_cents(value):
+    return int((Decimal(str(value)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+
+# Convertendo centavos para reais, no formato usado nas respostas da API
+def from_cents(cents):
+    return cents / 100
+
+
+# Calculando um percentual sobre um valor em centavos.
+# O percentual também é inteiro, em centésimos de ponto percentual (30% = 3000).
+def percent_of(total_cents, percent_hundredths):
+    return (total_cents * percent_hundredths + 5000) // 10000
+
+
+# Tipo de coluna para valores em centavos.
+# Bancos migrados no lugar mantêm a coluna declarada como FLOAT; os valores são inteiros,
+# mas o SQLite os devolve como REAL, por isso o resultado é convertido para int.
+class Cents(TypeDecorator):
+    impl = Integer
+    cache_ok = True
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else int(value)
@@ -0,0 +1,47 @@
+# Limite de requisições por cliente (IP ou chave de API), com um balde de fichas (token bucket) por chave.
+# Cada chave recebe `rate` fichas por segundo, acumula no máximo `burst`, e cada requisição gasta uma ficha
+# (ou mais, com charge). A memória é limitada: no máximo max_keys chaves, em shards com LRU; a chave menos
+# usada recentemente é descartada, e volta com o balde cheio se aparecer de novo.
+
+# Importando as bibliotecas necessárias
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+
+class RateLimiter:
+
+    def __init__(self, rate, burst, max_keys=100000, shards=16):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max(shards, max_keys)
+        # Cada shard tem o seu lock, para que requisições de clientes diferentes não disputem o mesmo lock
+        self._shards = [{'lock': threading.Lock(), 'buckets': OrderedDict()} for _ in range(shards)]
+
+    def _shard(self, key):
+        return self._shards[zlib.crc32(key.encode('utf-8')) % len(self._shards)]
+
+    # Gastando `cost` fichas da chave. Retorna 0 se a requisição pode seguir, ou os segundos até haver
+    # fichas suficientes. Com force, as fichas são gastas mesmo sem saldo (o balde fica negativo)
+    def charge(self, key, cost=1, force=False, now=None):
+        now = time.monotonic() if now is None else now
+        shard = self._shard(key)
+        buckets = shard['buckets']
+        with shard['lock']:
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = [self.burst, now]
+                if len(buckets) > self.max_keys // len(self._shards):
+                    buckets.popitem(last=False)
+            else:
+                buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= cost or force:
+                bucket[0] -= cost
+                return 0
+            return (cost - bucket[0]) / self.rate
+
+    def __len__(self):
+        return sum(len(shard['buckets']) for shard in self._shards)
@@ -0,0 +1,169 @@
+# Motor de regras dos cupons: as restrições de um cupom (validade, valor mínimo, público, primeira compra,
+# categorias, janelas de horário e acúmulo com outros cupons) são compiladas uma única vez em um avaliador,
+# uma lista curta de verificações que contém somente as regras que o cupom realmente tem.
+# O avaliador fica em cache pelo conteúdo das restrições, e é o mesmo no consumo e na cotação.
+#
+# As regras opcionais ficam na coluna coupon.rules, em JSON, por exemplo:
+#     {"categories": ["livros", "games"],
+#      "time_windows": [{"weekdays": [5, 6], "start": "10:00", "end": "22:00"}],
+#      "stackable": true}
+# - categories: o cupom vale apenas para compras com algum item dessas categorias
+# - time_windows: o cupom vale apenas dentro de alguma das janelas (dias da semana de 0 = segunda a 6 = domingo,
+#   todos quando omitidos; horário de início incluído e de fim excluído, "24:00" para o fim do dia; uma janela
+#   com o fim antes do início atravessa a meia-noite)
+# - stackable: o cupom pode ser usado junto com outros cupons na mesma compra (falso quando omitido)
+
+# Importando as bibliotecas necessárias
+import json
+from collections import namedtuple
+from functools import lru_cache
+
+from money import percent_of
+
+# Tipos de desconto: 'primeira' é um desconto fixo válido apenas na primeira compra do cliente
+DISCOUNT_TYPES = ('percentual', 'fixo', 'primeira')
+
+# Quantidade máxima de avaliadores compilados em memória
+EVALUATOR_CACHE_SIZE = 4096
+
+# Dados da compra avaliados pelas regras: total em centavos, primeira compra, data e hora da compra,
+# categorias dos itens (None quando não informadas) e quantidade de outros cupons aplicados na mesma compra
+Purchase = namedtuple('Purchase', ['total_cents', 'first_purchase', 'now', 'categories', 'stacked'],
+                      defaults=(None, 0))
+
+
+# Avaliador compilado de um cupom
+class Evaluator:
+    __slots__ = ('checks', 'discount_cents', 'first_purchase_only', 'stackable')
+
+    def __init__(self, checks, discount_cents, first_purchase_only, stackable):
+        self.checks = checks
+        self.discount_cents = discount_cents
+        # O cupom depende de ser a primeira compra do cliente (exclusivo da primeira compra ou fora do público geral)
+        self.first_purchase_only = first_purchase_only
+        self.stackable = stackable
+
+    # Verificando a compra; retorna a mensagem da primeira regra não atendida, ou None se o cupom for válido
+    def check(self, purchase):
+        for check in self.checks:
+            error = check(purchase)
+            if error:
+                return error
+        return None
+
+
+# Convertendo "HH:MM" em minutos desde a meia-noite; None se o horário for inválido
+def parse_minutes(value):
+    if not isinstance(value, str) or len(value) != 5 or value[2] != ':':
+        return None
+    hours, minutes = value[:2], value[3:]
+    if not hours.isdigit() or not minutes.isdigit() or int(minutes) > 59 or int(hours) * 60 + int(minutes) > 24 * 60:
+        return None
+    return int(hours) * 60 + int(minutes)
+
+
+# Validando as regras opcionais recebidas no cadastro; retorna (JSON normalizado ou None, erro)
+def parse_rules(data):
+    if data is None:
+        return None, None
+    if not isinstance(data, dict) or set(data) - {'categories', 'time_windows', 'stackable'}:
+        return None, 'Regras inválidas'
+
+    rules = {}
+    categories = data.get('categories')
+    if categories is not None:
+        if not isinstance(categories, list) or not categories or not all(isinstance(category, str) and category
+                                                                         for category in categories):
+            return None, 'Regras inválidas'
+        rules['categories'] = sorted(set(categories))
+
+    time_windows = data.get('time_windows')
+    if time_windows is not None:
+        if not isinstance(time_windows, list) or not time_windows:
+            return None, 'Regras inválidas'
+        rules['time_windows'] = []
+        for window in time_windows:
+            if not isinstance(window, dict) or set(window) - {'weekdays', 'start', 'end'}:
+                return None, 'Regras inválidas'
+            start, end = parse_minutes(window.get('start')), parse_minutes(window.get('end'))
+            weekdays = window.get('weekdays', list(range(7)))
+            if start is None or end is None or start == end or start == 24 * 60:
+                return None, 'Regras inválidas'
+            if not isinstance(weekdays, list) or not weekdays or not all(
+                    isinstance(day, int) and not isinstance(day, bool) and 0 <= day <= 6 for day in weekdays):
+                return None, 'Regras inválidas'
+            rules['time_windows'].append({'weekdays': sorted(set(weekdays)), 'start': window['start'], 'end': window['end']})
+
+    stackable = data.get('stackable')
+    if stackable is not None:
+        if not isinstance(stackable, bool):
+            return None, 'Regras inválidas'
+        rules['stackable'] = stackable
+
+    return (json.dumps(rules, sort_keys=True, separators=(',', ':')) if rules else None), None
+
+
+# Compilando as restrições de um cupom em um avaliador. Os argumentos são a chave do cache: cupons com
+# as mesmas restrições (por exemplo, gerados em lote a partir de um modelo) compartilham o avaliador
+@lru_cache(maxsize=EVALUATOR_CACHE_SIZE)
+def compile_rules(expiration_date, min_value_cents, discount_type, discount_amount_cents, public, first_purchase,
+                  rules=None):
+    rules = json.loads(rules) if rules else {}
+    checks = []
+
+    # Verificando se o cupom está expirado
+    checks.append(lambda purchase: 'Cupom expirado' if expiration_date < purchase.now else None)
+
+    # Verificando se o valor da compra é maior que o valor mínimo do cupom
+    checks.append(lambda purchase: 'Valor mínimo não atingido' if purchase.total_cents < min_value_cents else None)
+
+    # Verificando se o cupom é destinado ao público geral ou à primeira compra
+    if not public:
+        checks.append(lambda purchase: None if purchase.first_purchase else 'Cupom não é destinado ao público geral')
+
+    first_purchase_only = first_purchase or discount_type == 'primeira'
+    if first_purchase_only:
+        checks.append(lambda purchase: None if purchase.first_purchase
+                      else 'Cupom é válido apenas para a primeira compra')
+
+    # Verificando se algum item da compra é de uma das categorias do cupom
+    if 'categories' in rules:
+        categories = frozenset(rules['categories'])
+        checks.append(lambda purchase: None if purchase.categories and not categories.isdisjoint(purchase.categories)
+                      else 'Cupom não é válido para as categorias da compra')
+
+    # Verificando se a compra está dentro de alguma janela de horário, com os dias da semana em um bitmap
+    if 'time_windows' in rules:
+        windows = tuple((sum(1 << day for day in window['weekdays']), parse_minutes(window['start']),
+                         parse_minutes(window['end'])) for window in rules['time_windows'])
+
+        def in_time_window(purchase):
+            minute = purchase.now.hour * 60 + purchase.now.minute
+            day = 1 << purchase.now.weekday()
+            for weekdays, start, end in windows:
+                if weekdays & day and (start <= minute < end if start < end else minute >= start or minute < end):
+                    return None
+            return 'Cupom fora do horário de validade'
+        checks.append(in_time_window)
+
+    # Verificando se o cupom pode ser usado junto com os outros cupons da compra
+    stackable = rules.get('stackable', False)
+    if not stackable:
+        checks.append(lambda purchase: 'Cupom não é cumulativo' if purchase.stacked else None)
+
+    # Calculando o valor do desconto em centavos, de acordo com o tipo de desconto
+    if discount_type == 'percentual':
+        def discount_cents(total_cents):
+            return percent_of(total_cents, discount_amount_cents)
+    else:
+        def discount_cents(total_cents):
+            return discount_amount_cents
+
+    return Evaluator(tuple(checks), discount_cents, first_purchase_only or not public, stackable)
+
+
+# Obtendo o avaliador de um cupom (modelo do ORM, linha de consulta ou cópia do cache)
+def evaluator_for(coupon):
+    return compile_rules(coupon.expiration_date, coupon.min_value_cents, coupon.discount_type,
+                         coupon.discount_amount_cents, coupon.public, coupon.first_purchase,
+                         getattr(coupon, 'rules', None))
@@ -0,0 +1,141 @@
+# Armazenamento particionado dos cupons em vários arquivos SQLite (shards).
+# Cada cupom, junto com os seus usos, fica no shard escolhido pelo hash do código, de forma que
+# consumos de cupons diferentes não disputem o mesmo lock de escrita do SQLite.
+#
+# Redistribuindo os cupons entre shards (com a aplicação parada):
+#     python sharding.py --source coupons.db --target coupons_shard0.db coupons_shard1.db coupons_shard2.db
+#     python sharding.py --source coupons_shard0.db coupons_shard1.db --target novo0.db novo1.db novo2.db novo3.db
+
+# Importando as bibliotecas necessárias
+import argparse
+import os
+import sqlite3
+import zlib
+from contextlib import ExitStack, closing
+
+from sqlalchemy import create_engine
+
+from migrations import upgrade, upgrade_connection
+from sqlite_profile import engine_options, install_pragmas
+
+# Quantidade de linhas lidas e gravadas por vez na redistribuição
+RESHARD_BATCH_SIZE = 5000
+
+
+# Escolhendo o shard de um código. O crc32 é estável entre processos e versões do Python,
+# ao contrário do hash() embutido, que muda a cada execução.
+def shard_index(code, count):
+    return zlib.crc32(code.encode('utf-8')) % count
+
+
+# Montando os caminhos dos arquivos dos shards a partir de um modelo, como 'coupons_shard{}.db'
+def shard_paths(template, count):
+    return [template.format(index) for index in range(count)]
+
+
+# Conjunto de engines, uma por shard, com roteamento pelo código do cupom
+class ShardedStore:
+
+    def __init__(self, paths, profile='production', pool_size=5, max_overflow=10):
+        self.paths = list(paths)
+        self.engines = []
+        for path in self.paths:
+            uri = f'sqlite:///{path}'
+            engine = create_engine(uri, **engine_options(profile, uri, pool_size, max_overflow))
+            install_pragmas(engine, profile)
+            self.engines.append(engine)
+
+    def __len__(self):
+        return len(self.engines)
+
+    def index_for(self, code):
+        return shard_index(code, len(self.engines))
+
+    def engine_for(self, code):
+        return self.engines[self.index_for(code)]
+
+    # Criando ou atualizando o esquema de todos os shards
+    def upgrade(self):
+        for engine in self.engines:
+            upgrade(engine)
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+# Copiando as linhas de uma consulta da origem para o shard escolhido por route(linha), em lotes
+def copy_rows(source, outputs, select_sql, insert_sql, route, batch_size):
+    cursor = source.execute(select_sql)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for row in rows:
+            outputs[route(row)].execute(insert_sql, row)
+
+
+# Redistribuindo os cupons e os usos de um conjunto de bancos para um novo conjunto de shards.
+# Os bancos de destino são criados pelas migrações e precisam estar vazios. Os ids dos cupons
+# são renumerados em cada shard de destino, e os usos acompanham o novo id do cupom.
+# Os clientes vão para o shard do customer_id, somando o histórico de um cliente presente em mais de uma
+# origem, e as chaves de idempotência vão para o shard do código do cupom consumido.
+def reshard(sources, targets, batch_size=RESHARD_BATCH_SIZE):
+    if set(map(os.path.abspath, sources)) & set(map(os.path.abspath, targets)):
+        raise ValueError('Os bancos de destino devem ser diferentes dos bancos de origem')
+
+    moved = [0] * len(targets)
+    with ExitStack() as stack:
+        outputs = [stack.enter_context(closing(sqlite3.connect(path))) for path in targets]
+        for output in outputs:
+            upgrade_connection(output)
+            if output.execute('SELECT EXISTS (SELECT 1 FROM coupon)').fetchone()[0]:
+                raise ValueError('Os bancos de destino devem estar vazios')
+
+        for source_path in sources:
+            with closing(sqlite3.connect(source_path)) as source:
+                upgrade_connection(source)
+                cursor = source.execute('SELECT id, code, expiration_date, max_uses, min_value_cents, discount_type, '
+                                        'discount_amount_cents, public, first_purchase, uses_count, '
+                                        'max_uses_per_customer, rules FROM coupon')
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        index = shard_index(row[1], len(targets))
+                        output = outputs[index]
+                        coupon_id = output.execute('INSERT INTO coupon (code, expiration_date, max_uses, min_value_cents, '
+                                                   'discount_type, discount_amount_cents, public, first_purchase, '
+                                                   'uses_count, max_uses_per_customer, rules) '
+                                                   'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row[1:]).lastrowid
+                        output.executemany('INSERT INTO use (coupon_id, use_date, customer_id) VALUES (?, ?, ?)',
+                                           ((coupon_id, use_date, customer_id) for use_date, customer_id in
+                                            source.execute('SELECT use_date, customer_id FROM use WHERE coupon_id = ?',
+                                                           (row[0],))))
+                        moved[index] += 1
+
+                copy_rows(source, outputs, 'SELECT customer_id, orders_count, first_order_date FROM customer',
+                          'INSERT INTO customer (customer_id, orders_count, first_order_date) VALUES (?, ?, ?) '
+                          'ON CONFLICT (customer_id) DO UPDATE SET '
+                          'orders_count = orders_count + excluded.orders_count, '
+                          'first_order_date = MIN(first_order_date, excluded.first_order_date)',
+                          lambda row: shard_index(row[0], len(targets)), batch_size)
+                copy_rows(source, outputs, 'SELECT key, code, response, expires_at FROM idempotency_key',
+                          'INSERT INTO idempotency_key (key, code, response, expires_at) VALUES (?, ?, ?, ?)',
+                          lambda row: shard_index(row[1], len(targets)), batch_size)
+
+        # Gravando os shards de destino somente depois de copiar todos os cupons
+        for output in outputs:
+            output.commit()
+    return moved
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Redistribui os cupons entre shards SQLite')
+    parser.add_argument('--source', nargs='+', required=True, help='bancos de origem (um banco único ou os shards atuais)')
+    parser.add_argument('--target', nargs='+', required=True, help='novos shards, na ordem do índice')
+    args = parser.parse_args()
+
+    for path, count in zip(args.target, reshard(args.source, args.target)):
+        print(f'{path}: {count} cupons')
@@ -0,0 +1,81 @@
+# Importando as bibliotecas necessárias
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+# Perfis de configuração do SQLite, aplicados como PRAGMAs em cada nova conexão.
+# O perfil "default" mantém o comportamento padrão do SQLite (journal em modo rollback).
+PROFILES = {
+    'default': {},
+    'production': {
+        # Leitores não bloqueiam escritores e vice-versa
+        'journal_mode': 'WAL',
+        # Com WAL, NORMAL só sincroniza o disco nos checkpoints
+        'synchronous': 'NORMAL',
+        # Tempo (ms) esperando o lock de escrita antes de "database is locked"
+        'busy_timeout': 5000,
+        # Leitura do arquivo via mmap (bytes)
+        'mmap_size': 256 * 1024 * 1024,
+        # Cache de páginas por conexão (valor negativo = KiB)
+        'cache_size': -64 * 1024,
+        'temp_store': 'MEMORY',
+    },
+}
+
+
+# Aplicando os PRAGMAs de um perfil em cada nova conexão de uma engine. O listener fica na própria engine,
+# então aplicações e shards com perfis diferentes no mesmo processo não interferem umas nas outras.
+def install_pragmas(engine, profile):
+    pragmas = PROFILES[profile]
+    if not pragmas or engine.dialect.name != 'sqlite':
+        return
+
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+    event.listen(engine, 'connect', apply_pragmas)
+
+
+# Extensão do Flask-SQLAlchemy que aplica às engines criadas o perfil (SQLITE_PROFILE) da aplicação dona da engine
+class ProfiledSQLAlchemy(SQLAlchemy):
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        install_pragmas(engine, self.get_app().config.get('SQLITE_PROFILE', 'default'))
+        return engine
+
+
+# Verificando se a URI aponta para um banco em memória, que não pode usar um pool de várias conexões
+def is_memory_database(uri):
+    return uri in ('sqlite://', 'sqlite:///:memory:') or 'mode=memory' in uri
+
+
+# Montando as opções da engine para um perfil
+def engine_options(profile, uri, pool_size=5, max_overflow=10):
+    pragmas = PROFILES[profile]
+    if not pragmas or not uri.startswith('sqlite') or is_memory_database(uri):
+        return {}
+    return {
+        # Mantendo as conexões abertas, para não repetir os PRAGMAs a cada requisição
+        'poolclass': QueuePool,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'connect_args': {
+            'check_same_thread': False,
+            'timeout': pragmas.get('busy_timeout', 5000) / 1000,
+        },
+    }
+
+
+# Aplicando um perfil à aplicação Flask; deve ser chamado antes da criação da engine.
+# Os PRAGMAs são aplicados pela ProfiledSQLAlchemy (models.db) nas conexões da engine desta aplicação
+def configure_sqlite(app, profile='production'):
+    if profile not in PROFILES:
+        raise ValueError(f'Perfil SQLite desconhecido: {profile}')
+    app.config['SQLITE_PROFILE'] = profile
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(profile,
+                                                             app.config['SQLALCHEMY_DATABASE_URI'],
+                                                             app.config.get('SQLITE_POOL_SIZE', 5),
+                                                             app.config.get('SQLITE_MAX_OVERFLOW', 10))
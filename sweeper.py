@@ -0,0 +1,273 @@
+# Manutenção do banco: move os cupons expirados há mais de um período de carência, com os seus usos,
+# para um arquivo SQLite de arquivo morto, mantendo nas tabelas principais apenas os cupons em uso.
+# O arquivo morto guarda, por cupom, o total de usos e as datas do primeiro e do último uso.
+#
+# Cada lote é movido em transações curtas, para não segurar o lock de escrita por muito tempo, e o
+# espaço liberado é devolvido aos poucos com PRAGMA incremental_vacuum (quando auto_vacuum=INCREMENTAL).
+#
+# Executando manualmente:
+#     python sweeper.py coupons.db --archive coupons_archive.db --grace-days 30
+#     python sweeper.py coupons.db --archive coupons_archive.db --summary ABC123
+#     python sweeper.py coupons.db --enable-incremental-vacuum
+#     python sweeper.py coupons.db --purge-idempotency-keys
+# ou dentro da aplicação, com ARCHIVE_SWEEP_INTERVAL e IDEMPOTENCY_PURGE_INTERVAL em app.py.
+#
+# A remoção das chaves de idempotência expiradas não depende do arquivo morto: ela também roda sozinha,
+# pela opção --purge-idempotency-keys ou pela thread IdempotencyPurger.
+
+# Importando as bibliotecas necessárias
+import argparse
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from datetime import datetime, timedelta
+
+from idempotency import purge_expired
+
+logger = logging.getLogger(__name__)
+
+# Formato de data usado pelo SQLAlchemy nas colunas DateTime do SQLite
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# Páginas devolvidas ao sistema de arquivos por lote, quando auto_vacuum=INCREMENTAL
+VACUUM_PAGES = 256
+
+# Colunas copiadas da tabela de cupons para o arquivo morto
+COUPON_COLUMNS = ('code', 'expiration_date', 'max_uses', 'min_value_cents', 'discount_type', 'discount_amount_cents',
+                  'public', 'first_purchase', 'uses_count', 'max_uses_per_customer', 'rules')
+
+# Colunas incluídas no arquivo morto depois da sua criação, acrescentadas aos arquivos existentes: (tabela, coluna, tipo)
+ADDED_ARCHIVE_COLUMNS = (('coupon', 'max_uses_per_customer', 'INTEGER'), ('coupon', 'rules', 'TEXT'),
+                         ('use', 'customer_id', 'VARCHAR(64)'))
+
+
+# Criando as tabelas do arquivo morto, anexado como "archive"
+def create_archive_tables(connection):
+    connection.execute('CREATE TABLE IF NOT EXISTS archive.coupon ('
+                       'id INTEGER NOT NULL PRIMARY KEY, '
+                       'coupon_id INTEGER NOT NULL, '
+                       'code VARCHAR(20) NOT NULL, '
+                       'expiration_date DATETIME NOT NULL, '
+                       'max_uses INTEGER NOT NULL, '
+                       'min_value_cents INTEGER NOT NULL, '
+                       'discount_type VARCHAR(10) NOT NULL, '
+                       'discount_amount_cents INTEGER NOT NULL, '
+                       'public BOOLEAN NOT NULL, '
+                       'first_purchase BOOLEAN NOT NULL, '
+                       'uses_count INTEGER NOT NULL, '
+                       'max_uses_per_customer INTEGER, '
+                       'rules TEXT, '
+                       'first_use_date DATETIME, '
+                       'last_use_date DATETIME, '
+                       'archived_at DATETIME NOT NULL, '
+                       'UNIQUE (coupon_id, code))')
+    connection.execute('CREATE INDEX IF NOT EXISTS archive.ix_coupon_code ON coupon (code)')
+    # Histórico compacto: sem id próprio, ordenado pelo cupom arquivado e pela data
+    connection.execute('CREATE TABLE IF NOT EXISTS archive.use ('
+                       'coupon_id INTEGER NOT NULL, '
+                       'use_date DATETIME NOT NULL, '
+                       'seq INTEGER NOT NULL, '
+                       'customer_id VARCHAR(64), '
+                       'PRIMARY KEY (coupon_id, use_date, seq)) WITHOUT ROWID')
+    for table, name, column_type in ADDED_ARCHIVE_COLUMNS:
+        if name not in {row[1] for row in connection.execute(f'PRAGMA archive.table_info({table})')}:
+            connection.execute(f'ALTER TABLE archive.{table} ADD COLUMN {name} {column_type}')
+
+
+# Movendo um lote de cupons expirados antes de cutoff; retorna a quantidade de cupons movidos
+def archive_batch(connection, cutoff, batch_size, now):
+    archived_at = now.strftime(DATETIME_FORMAT)
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        # O cupom de maior id fica na tabela, mesmo expirado: sem AUTOINCREMENT, o SQLite atribui ao próximo cupom
+        # o maior id + 1, e removê-lo faria o cupom novo herdar o id (e os contadores e o filtro de códigos, que
+        # identificam os cupons pelo id) do cupom arquivado. Ele é arquivado depois que outro cupom for cadastrado.
+        ids = [row[0] for row in connection.execute('SELECT id FROM coupon WHERE expiration_date < ? '
+                                                    'AND id < (SELECT MAX(id) FROM coupon) ORDER BY id LIMIT ?',
+                                                    (cutoff.strftime(DATETIME_FORMAT), batch_size))]
+        if ids:
+            placeholders = ', '.join('?' * len(ids))
+            # Copiando somente os cupons que ainda não estão no arquivo morto, para que uma execução
+            # interrompida entre a cópia e a remoção possa ser repetida sem duplicar os usos
+            connection.execute(f'INSERT OR IGNORE INTO archive.coupon (coupon_id, {", ".join(COUPON_COLUMNS)}, '
+                               f'first_use_date, last_use_date, archived_at) '
+                               f'SELECT coupon.id, {", ".join("coupon." + name for name in COUPON_COLUMNS)}, '
+                               f'MIN(use.use_date), MAX(use.use_date), ? '
+                               f'FROM coupon LEFT JOIN use ON use.coupon_id = coupon.id '
+                               f'WHERE coupon.id IN ({placeholders}) GROUP BY coupon.id',
+                               [archived_at] + ids)
+            connection.execute(f'INSERT INTO archive.use (coupon_id, use_date, seq, customer_id) '
+                               f'SELECT archived.id, use.use_date, use.id, use.customer_id FROM use '
+                               f'JOIN coupon ON coupon.id = use.coupon_id '
+                               f'JOIN archive.coupon AS archived ON archived.coupon_id = coupon.id AND archived.code = coupon.code '
+                               f'WHERE use.coupon_id IN ({placeholders}) AND archived.archived_at = ?',
+                               ids + [archived_at])
+            connection.execute(f'DELETE FROM use WHERE coupon_id IN ({placeholders})', ids)
+            connection.execute(f'DELETE FROM coupon WHERE id IN ({placeholders})', ids)
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
+    return len(ids)
+
+
+# Devolvendo aos poucos o espaço liberado, sem reescrever o arquivo inteiro como o VACUUM
+def reclaim_space(connection, pages=VACUUM_PAGES):
+    if connection.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        connection.execute(f'PRAGMA incremental_vacuum({pages})').fetchall()
+    # Em modo WAL, transferindo as páginas gravadas para o banco sem bloquear leitores e escritores
+    connection.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+
+
+# Removendo as respostas guardadas por Idempotency-Key já expiradas, em lotes.
+# A conexão deve estar com isolation_level=None (ver purge_keys)
+def purge_idempotency_keys(connection, now, batch_size):
+    if not connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'idempotency_key'").fetchone():
+        return 0
+    purged = 0
+    while True:
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            removed = purge_expired(connection, now, batch_size)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        purged += removed
+        if removed < batch_size:
+            return purged
+
+
+# Removendo as chaves de idempotência expiradas sem arquivar cupons; retorna a quantidade removida
+def purge_keys(connection, batch_size=500, now=None):
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    try:
+        return purge_idempotency_keys(connection, now or datetime.now(), batch_size)
+    finally:
+        connection.isolation_level = isolation_level
+
+
+# Movendo para o arquivo morto todos os cupons expirados há mais de `grace`, em lotes, e removendo
+# as chaves de idempotência expiradas.
+# pause é o intervalo entre os lotes, para dar vez aos consumos que esperam o lock de escrita.
+def sweep(connection, archive_path, grace=timedelta(days=30), batch_size=500, pause=0.0, now=None):
+    now = now or datetime.now()
+    cutoff = now - grace
+    isolation_level = connection.isolation_level
+    # Controlando as transações manualmente, como nas migrações
+    connection.isolation_level = None
+    connection.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+    archived = 0
+    try:
+        create_archive_tables(connection)
+        while True:
+            moved = archive_batch(connection, cutoff, batch_size, now)
+            if not moved:
+                break
+            archived += moved
+            reclaim_space(connection)
+            if pause:
+                time.sleep(pause)
+        purge_idempotency_keys(connection, now, batch_size)
+    finally:
+        connection.execute('DETACH DATABASE archive')
+        connection.isolation_level = isolation_level
+    return archived
+
+
+# Consultando o total de usos de um código no arquivo morto (um código pode ter sido arquivado mais de uma vez)
+def archived_summary(archive_path, code):
+    with closing(sqlite3.connect(archive_path)) as connection:
+        return connection.execute('SELECT COUNT(*), COALESCE(SUM(uses_count), 0), MIN(first_use_date), '
+                                  'MAX(last_use_date) FROM coupon WHERE code = ?', (code,)).fetchone()
+
+
+# Ativando a devolução incremental de espaço. Reescreve o banco com VACUUM uma única vez: executar com a aplicação parada
+def enable_incremental_vacuum(connection):
+    connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    connection.execute('VACUUM')
+
+
+# Executando a limpeza periodicamente em uma thread da aplicação
+class Sweeper(threading.Thread):
+
+    def __init__(self, database_path, archive_path, grace, interval, batch_size=500, pause=0.05):
+        super().__init__(name='sweeper', daemon=True)
+        self.database_path = database_path
+        self.archive_path = archive_path
+        self.grace = grace
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                with closing(sqlite3.connect(self.database_path, timeout=30)) as connection:
+                    archived = sweep(connection, self.archive_path, self.grace, self.batch_size, self.pause)
+                if archived:
+                    logger.info('%d cupons expirados movidos para %s', archived, self.archive_path)
+            except Exception:
+                logger.exception('Falha na limpeza dos cupons expirados')
+
+    def stop(self):
+        self.stopped.set()
+
+
+# Removendo periodicamente as chaves de idempotência expiradas em uma thread da aplicação,
+# independentemente da limpeza dos cupons expirados
+class IdempotencyPurger(threading.Thread):
+
+    def __init__(self, database_path, interval, batch_size=500):
+        super().__init__(name='idempotency-purger', daemon=True)
+        self.database_path = database_path
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                with closing(sqlite3.connect(self.database_path, timeout=30)) as connection:
+                    purged = purge_keys(connection, self.batch_size)
+                if purged:
+                    logger.info('%d chaves de idempotência expiradas removidas', purged)
+            except Exception:
+                logger.exception('Falha na remoção das chaves de idempotência expiradas')
+
+    def stop(self):
+        self.stopped.set()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move os cupons expirados e os seus usos para o arquivo morto')
+    parser.add_argument('database', nargs='?', default='coupons.db')
+    parser.add_argument('--archive', default='coupons_archive.db')
+    parser.add_argument('--grace-days', type=float, default=30, help='dias após a expiração antes de arquivar')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--pause', type=float, default=0.05, help='segundos entre os lotes')
+    parser.add_argument('--summary', metavar='CODE', help='mostrar os usos arquivados de um código')
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help='ativar auto_vacuum=INCREMENTAL (reescreve o banco uma vez)')
+    parser.add_argument('--purge-idempotency-keys', action='store_true',
+                        help='somente remover as chaves de idempotência expiradas, sem arquivar cupons')
+    args = parser.parse_args()
+
+    if args.summary:
+        coupons, uses, first_use, last_use = archived_summary(args.archive, args.summary)
+        print(f'{args.summary}: {coupons} cupons arquivados, {uses} usos (de {first_use} a {last_use})')
+    elif args.purge_idempotency_keys:
+        with closing(sqlite3.connect(args.database, timeout=30)) as connection:
+            purged = purge_keys(connection, args.batch_size)
+        print(f'{purged} chaves de idempotência expiradas removidas de {args.database}')
+    else:
+        with closing(sqlite3.connect(args.database, timeout=30)) as connection:
+            if args.enable_incremental_vacuum:
+                enable_incremental_vacuum(connection)
+                print(f'auto_vacuum=INCREMENTAL ativado em {args.database}')
+            archived = sweep(connection, args.archive, timedelta(days=args.grace_days), args.batch_size, args.pause)
+        print(f'{archived} cupons expirados movidos para {args.archive}')
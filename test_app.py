@@ -1,27 +1,129 @@
 # Importando as bibliotecas necessárias
+import asyncio
+import importlib
+import json
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
-from app import app, db, Coupon, Use
-from datetime import datetime
+from app import create_app
+from models import db, Coupon, Customer, IdempotencyKey, Use
+import app_async
+import fakeredis
+import app_sharded
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from contextlib import closing
+from migrations import backfill_uses_count, current_version, upgrade_connection, LATEST_VERSION
+from sqlite_profile import engine_options
+from counters import MemoryCounterBackend, RedisCounterBackend, reconcile, sql_customer_loader, sql_limits_loader
+from sharding import reshard, shard_index
+from sweeper import archived_summary, purge_keys, sweep
+
+
+# Consumindo um cupom várias vezes em um processo separado, simulando um worker do gunicorn
+def redeem_in_process(module_name, database_uri, code, attempts):
+    app = importlib.import_module(module_name).create_app({'SQLALCHEMY_DATABASE_URI': database_uri,
+                                                           'SQLALCHEMY_ENGINE_OPTIONS': {'connect_args': {'timeout': 60}}})
+    client = app.test_client()
+    data = {"total_value": 150, "first_purchase": False}
+    return [client.post(f'/coupons/{code}', json=data).status_code for _ in range(attempts)]
+
+
+# Cadastrando direto no banco um cupom cumulativo só para livros (LIVROS) e um cupom sem regras (SOZINHO),
+# para testar as regras nas versões que não cadastram regras
+def insert_rule_coupons(path):
+    with closing(sqlite3.connect(path)) as connection:
+        upgrade_connection(connection)
+        for code, rules in (("LIVROS", '{"categories": ["livros"], "stackable": true}'), ("SOZINHO", None)):
+            connection.execute("INSERT INTO coupon (code, expiration_date, max_uses, min_value_cents, discount_type, discount_amount_cents, public, first_purchase, rules) VALUES (?, ?, 10, 10000, 'fixo', 1000, 1, 0, ?)",
+                               (code, (datetime.now() + timedelta(days=30)).isoformat(' '), rules))
+        connection.commit()
+
+
+# Respostas esperadas das regras dos cupons de insert_rule_coupons: (código, dados da compra, status, erro)
+RULE_CASES = [("LIVROS", {"categories": ["livros"]}, 200, None),
+              ("LIVROS", {"categories": ["games"]}, 400, 'Cupom não é válido para as categorias da compra'),
+              ("LIVROS", {}, 400, 'Cupom não é válido para as categorias da compra'),
+              ("SOZINHO", {"applied_coupons": ["LIVROS"]}, 400, 'Cupom não é cumulativo'),
+              ("LIVROS", {"categories": ["livros"], "applied_coupons": ["SOZINHO"]}, 400, 'Cupom aplicado não é cumulativo'),
+              ("LIVROS", {"categories": ["livros"], "applied_coupons": ["NAOEXISTE"]}, 400, 'Cupom aplicado não encontrado'),
+              ("LIVROS", {"categories": ["livros"], "applied_coupons": [1]}, 400, 'Cupons aplicados inválidos'),
+              ("SOZINHO", {"categories": "livros"}, 400, 'Categorias inválidas'),
+              ("SOZINHO", {"applied_coupons": ["SOZINHO"]}, 200, None)]
+
+
+# Tamanho máximo dos lotes e número de threads nos testes de queda do commit em grupo
+GROUP_COMMIT_BATCH_SIZE = 32
+GROUP_COMMIT_THREADS = 8
+
+
+# Consumindo o cupom em modo de commit em grupo, com várias threads, e derrubando o processo
+# sem encerramento normal depois de `acknowledged` respostas de sucesso, gravadas em ack_path.
+# Com drain, as threads param de enviar consumos e o processo só cai depois que as respostas pendentes
+# chegaram e o registro de commit em grupo foi fechado, gravando o último lote
+def redeem_until_crash(database_uri, code, durability, acknowledged, ack_path, drain=False):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_uri,
+                      'REDEMPTION_GROUP_COMMIT': True,
+                      'REDEMPTION_DURABILITY': durability,
+                      'REDEMPTION_BATCH_SIZE': GROUP_COMMIT_BATCH_SIZE,
+                      'REDEMPTION_BATCH_DELAY': 0.05})
+    lock = threading.Lock()
+    successes = []
+    stopped = threading.Event()
+
+    def redeem():
+        client = app.test_client()
+        while not stopped.is_set():
+            if client.post(f'/coupons/{code}', json={"total_value": 150, "first_purchase": False}).status_code == 200:
+                with lock:
+                    successes.append(1)
+
+    threads = [threading.Thread(target=redeem, daemon=True) for _ in range(GROUP_COMMIT_THREADS)]
+    for thread in threads:
+        thread.start()
+    while True:
+        with lock:
+            reached = len(successes) >= acknowledged
+        if reached and drain:
+            stopped.set()
+            for thread in threads:
+                thread.join()
+            app.extensions['redemption_log'].close()
+        with lock:
+            if reached:
+                with open(ack_path, 'w') as file:
+                    file.write(str(len(successes)))
+                    file.flush()
+                    os.fsync(file.fileno())
+                os._exit(1)
+        time.sleep(0.001)
 
 
 # Criando a classe de testes
 class TestApp(unittest.TestCase):
 
-    # Configurando o banco de dados de teste
+    # Criando uma aplicação para cada teste, com um banco SQLite em memória
     def setUp(self):
-        app.config['TESTING'] = True
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///test.db'
-        self.client = app.test_client()
+        self.app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.client = self.app.test_client()
+        self.coupon_cache = self.app.extensions['coupon_cache']
         db.create_all()
 
-    # Removendo o banco de dados de teste
+    # Descartando o banco em memória junto com a conexão
     def tearDown(self):
         db.session.remove()
-        db.drop_all()
+        db.engine.dispose()
+        self.app_context.pop()
 
     # Testando o cadastro de um cupom válido
     def test_create_coupon_valid(self):
-        data = {"code": "ABC123", "expiration_date": "2023-12-31T23:59:59", "max_uses": 500, "min_value": 100, "discount_type": "percentual", "discount_amount": 30, "public": True, "first_purchase": False}
+        data = {"code": "ABC123", "expiration_date": (datetime.now() + timedelta(days=30)).replace(microsecond=0).isoformat(), "max_uses": 500, "min_value": 100, "discount_type": "percentual", "discount_amount": 30, "public": True, "first_purchase": False}
         response = self.client.post('/coupons', json=data)
         self.assertEqual(response.status_code, 201)
         self.assertEqual(response.json['code'], data['code'])
@@ -35,12 +137,12 @@ class TestApp(unittest.TestCase):
 
     # Testando o cadastro de um cupom inválido (código já existente)
     def test_create_coupon_invalid_code(self):
-        coupon = Coupon(code="ABC123", expiration_date=datetime(2023, 12, 31, 23, 59, 59), max_uses=500, min_value=100, discount_type="percentual", discount_amount=30, public=True, first_purchase=False)
+        coupon = Coupon(code="ABC123", expiration_date=datetime.now() + timedelta(days=30), max_uses=500, min_value=100, discount_type="percentual", discount_amount=30, public=True, first_purchase=False)
 
         db.session.add(coupon)
         db.session.commit()
 
-        data = {"code": "ABC123", "expiration_date": "2023-12-31T23:59:59", "max_uses": 500, "min_value": 100, "discount_type": "percentual", "discount_amount": 30, "public": True, "first_purchase": False}
+        data = {"code": "ABC123", "expiration_date": (datetime.now() + timedelta(days=30)).replace(microsecond=0).isoformat(), "max_uses": 500, "min_value": 100, "discount_type": "percentual", "discount_amount": 30, "public": True, "first_purchase": False}
 
         response = self.client.post('/coupons', json=data)
         self.assertEqual(response.status_code, 400)
@@ -72,7 +174,7 @@ class TestApp(unittest.TestCase):
 
     # Testando o consumo de um cupom válido (desconto percentual para público geral)
     def test_use_coupon_valid_percentual_public(self):
-        coupon = Coupon(code="ABC123", expiration_date=datetime(2023, 12, 31, 23, 59, 59), max_uses=500, min_value=100, discount_type="percentual", discount_amount=30, public=True, first_purchase=False)
+        coupon = Coupon(code="ABC123", expiration_date=datetime.now() + timedelta(days=30), max_uses=500, min_value=100, discount_type="percentual", discount_amount=30, public=True, first_purchase=False)
 
         db.session.add(coupon)
         db.session.commit()
@@ -86,7 +188,7 @@ class TestApp(unittest.TestCase):
 
     # Testando o consumo de um cupom válido (desconto fixo para primeira compra)
     def test_use_coupon_valid_fixo_first(self):
-        coupon = Coupon(code="ABC123", expiration_date=datetime(2023, 12, 31, 23, 59, 59), max_uses=500, min_value=100, discount_type="fixo", discount_amount=10, public=False, first_purchase=True)
+        coupon = Coupon(code="ABC123", expiration_date=datetime.now() + timedelta(days=30), max_uses=500, min_value=100, discount_type="fixo", discount_amount=10, public=False, first_purchase=True)
 
         db.session.add(coupon)
         db.session.commit()
@@ -121,12 +223,12 @@ class TestApp(unittest.TestCase):
 
     # Testando o consumo de um cupom inválido (cupom esgotado)
     def test_use_coupon_invalid_exhausted(self):
-        coupon = Coupon(code="ABC123", expiration_date=datetime(2023, 12, 31, 23, 59, 59), max_uses=1, min_value=100, discount_type="percentual", discount_amount=30, public=True, first_purchase=False)
+        coupon = Coupon(code="ABC123", expiration_date=datetime.now() + timedelta(days=30), max_uses=1, min_value=100, discount_type="percentual", discount_amount=30, public=True, first_purchase=False)
 
-        use = Use(coupon_id=coupon.id, use_date=datetime.now())
+        # O cupom já foi usado: o contador de usos chegou ao limite
+        coupon.uses_count = coupon.max_uses
 
         db.session.add(coupon)
-        db.session.add(use)
         db.session.commit()
 
         data = {"total_value": 150, "first_purchase": False}
@@ -137,7 +239,7 @@ class TestApp(unittest.TestCase):
 
     # Testando o consumo de um cupom inválido (valor mínimo não atingido)
     def test_use_coupon_invalid_min_value(self):
-        coupon = Coupon(code="ABC123", expiration_date=datetime(2023, 12, 31, 23, 59, 59), max_uses=500, min_value=100, discount_type="percentual", discount_amount=30, public=True, first_purchase=False)
+        coupon = Coupon(code="ABC123", expiration_date=datetime.now() + timedelta(days=30), max_uses=500, min_value=100, discount_type="percentual", discount_amount=30, public=True, first_purchase=False)
 
         db.session.add(coupon)
         db.session.commit()
@@ -150,3 +252,1028 @@ class TestApp(unittest.TestCase):
 
     # Testando o consumo de um cupom inválido (cupom não destinado ao público geral)
     def test_use_coupon_invalid_not_public(self):
+        coupon = Coupon(code="ABC123", expiration_date=datetime.now() + timedelta(days=30), max_uses=500, min_value=100, discount_type="percentual", discount_amount=30, public=False, first_purchase=False)
+
+        db.session.add(coupon)
+        db.session.commit()
+
+        data = {"total_value": 150, "first_purchase": False}
+
+        response = self.client.post('/coupons/ABC123', json=data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['error'], 'Cupom não é destinado ao público geral')
+
+    # Testando se o contador de usos acompanha os registros da tabela Use
+    def test_use_coupon_updates_uses_count(self):
+        coupon = Coupon(code="ABC123", expiration_date=datetime.now() + timedelta(days=30), max_uses=2, min_value=100, discount_type="percentual", discount_amount=30, public=True, first_purchase=False)
+
+        db.session.add(coupon)
+        db.session.commit()
+
+        data = {"total_value": 150, "first_purchase": False}
+
+        self.assertEqual(self.client.post('/coupons/ABC123', json=data).status_code, 200)
+        self.assertEqual(self.client.post('/coupons/ABC123', json=data).status_code, 200)
+
+        response = self.client.post('/coupons/ABC123', json=data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['error'], 'Cupom esgotado')
+
+        coupon = Coupon.query.filter_by(code="ABC123").first()
+        self.assertEqual(coupon.uses_count, 2)
+        self.assertEqual(Use.query.filter_by(coupon_id=coupon.id).count(), 2)
+
+    # Testando o preenchimento do contador de usos a partir do histórico existente
+    def test_backfill_uses_count(self):
+        coupon = Coupon(code="ABC123", expiration_date=datetime.now() + timedelta(days=30), max_uses=500, min_value=100, discount_type="percentual", discount_amount=30, public=True, first_purchase=False)
+
+        db.session.add(coupon)
+        db.session.commit()
+
+        db.session.add_all([Use(coupon_id=coupon.id, use_date=datetime.now()) for _ in range(3)])
+        db.session.commit()
+
+        connection = db.engine.raw_connection()
+        try:
+            backfill_uses_count(connection.cursor())
+            connection.commit()
+        finally:
+            connection.close()
+
+        db.session.refresh(coupon)
+        self.assertEqual(coupon.uses_count, 3)
+
+    # Testando o cache de cupons: o segundo consumo não consulta o cupom no banco
+    def test_use_coupon_cached_lookup(self):
+        coupon = Coupon(code="ABC123", expiration_date=datetime.now() + timedelta(days=30), max_uses=500, min_value=100, discount_type="percentual", discount_amount=30, public=True, first_purchase=False)
+
+        db.session.add(coupon)
+        db.session.commit()
+
+        data = {"total_value": 150, "first_purchase": False}
+
+        self.assertEqual(self.client.post('/coupons/ABC123', json=data).status_code, 200)
+        self.assertEqual(self.client.post('/coupons/ABC123', json=data).status_code, 200)
+        self.assertEqual(self.coupon_cache.misses, 1)
+        self.assertEqual(self.coupon_cache.hits, 1)
+
+    # Testando o cache negativo, invalidado pelo cadastro do cupom
+    def test_use_coupon_negative_cache_invalidated_on_create(self):
+        data = {"total_value": 150, "first_purchase": False}
+
+        self.assertEqual(self.client.post('/coupons/XYZ789', json=data).status_code, 404)
+        self.assertEqual(self.client.post('/coupons/XYZ789', json=data).status_code, 404)
+        self.assertEqual(self.coupon_cache.misses, 1)
+
+        coupon_data = {"code": "XYZ789", "expiration_date": (datetime.now() + timedelta(days=30)).isoformat(), "max_uses": 500, "min_value": 100, "discount_type": "fixo", "discount_amount": 10, "public": True, "first_purchase": False}
+        self.assertEqual(self.client.post('/coupons', json=coupon_data).status_code, 201)
+
+        response = self.client.post('/coupons/XYZ789', json=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['discount_value'], 10)
+
+    # Testando o cadastro em lote com itens válidos, repetidos, já existentes e inválidos
+    def test_create_coupons_bulk(self):
+        coupon = Coupon(code="EXISTE", expiration_date=datetime.now() + timedelta(days=30), max_uses=500, min_value=100, discount_type="percentual", discount_amount=30, public=True, first_purchase=False)
+
+        db.session.add(coupon)
+        db.session.commit()
+
+        expiration_date = (datetime.now() + timedelta(days=30)).isoformat()
+        base = {"expiration_date": expiration_date, "max_uses": 500, "min_value": 100, "discount_type": "fixo", "discount_amount": 10, "public": True, "first_purchase": False}
+        data = [dict(base, code="LOTE1"), dict(base, code="LOTE2"), dict(base, code="LOTE1"), dict(base, code="EXISTE"), dict(base, code="LOTE3", discount_type="outro"), dict(base, code="LOTE4", max_uses=-1)]
+
+        response = self.client.post('/coupons/bulk', json=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['created'], 2)
+        self.assertEqual(response.json['errors'], 4)
+        self.assertEqual([result['status'] for result in response.json['results']], [201, 201, 400, 400, 400, 400])
+        self.assertEqual([result.get('error') for result in response.json['results'][2:]], ['Código já existe', 'Código já existe', 'Tipo de desconto inválido', 'Valores inválidos'])
+        self.assertEqual(Coupon.query.count(), 3)
+
+    # Testando o cadastro em lote a partir de um corpo NDJSON, dividido em várias transações
+    def test_create_coupons_bulk_ndjson(self):
+        expiration_date = (datetime.now() + timedelta(days=30)).isoformat()
+        base = {"expiration_date": expiration_date, "max_uses": 500, "min_value": 100, "discount_type": "fixo", "discount_amount": 10, "public": True, "first_purchase": False}
+        lines = [json.dumps(dict(base, code=f"NDJ{index}")) for index in range(25)] + ["{invalido"]
+
+        self.app.config['BULK_BATCH_SIZE'] = 10
+        try:
+            response = self.client.post('/coupons/bulk', data='\n'.join(lines), content_type='application/x-ndjson')
+        finally:
+            self.app.config['BULK_BATCH_SIZE'] = 5000
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['created'], 25)
+        self.assertEqual(response.json['results'][-1]['error'], 'Dados incompletos')
+        self.assertEqual(Coupon.query.count(), 25)
+
+    # Testando a geração de códigos aleatórios no servidor
+    def test_create_coupons_bulk_generate(self):
+        coupon = {"expiration_date": (datetime.now() + timedelta(days=30)).isoformat(), "max_uses": 1, "min_value": 100, "discount_type": "fixo", "discount_amount": 10, "public": True, "first_purchase": False}
+
+        response = self.client.post('/coupons/bulk', json={"generate": 50, "code_prefix": "BF", "code_length": 8, "coupon": coupon})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json['created'], 50)
+        self.assertEqual(len(set(response.json['codes'])), 50)
+        self.assertTrue(all(code.startswith("BF") and len(code) == 10 for code in response.json['codes']))
+        self.assertEqual(Coupon.query.count(), 50)
+
+        response = self.client.post('/coupons/bulk', json={"generate": 50, "code_length": 1, "coupon": coupon})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['error'], 'Tamanho de código insuficiente')
+
+    # Testando a cotação de vários cupons para um carrinho, sem consumir nenhum deles
+    def test_quote_coupons(self):
+        expiration_date = datetime.now() + timedelta(days=30)
+        db.session.add_all([
+            Coupon(code="PERC30", expiration_date=expiration_date, max_uses=500, min_value=100, discount_type="percentual", discount_amount=30, public=True, first_purchase=False),
+            Coupon(code="FIXO10", expiration_date=expiration_date, max_uses=500, min_value=100, discount_type="fixo", discount_amount=10, public=True, first_purchase=False),
+            Coupon(code="MINIMO", expiration_date=expiration_date, max_uses=500, min_value=1000, discount_type="fixo", discount_amount=50, public=True, first_purchase=False),
+            Coupon(code="ESGOTADO", expiration_date=expiration_date, max_uses=1, uses_count=1, min_value=100, discount_type="fixo", discount_amount=90, public=True, first_purchase=False),
+            Coupon(code="VENCIDO", expiration_date=datetime(2020, 12, 31, 23, 59, 59), max_uses=500, min_value=100, discount_type="fixo", discount_amount=90, public=True, first_purchase=False),
+        ])
+        db.session.commit()
+
+        data = {"total_value": 150, "first_purchase": False, "codes": ["FIXO10", "PERC30", "MINIMO", "ESGOTADO", "VENCIDO", "NAOEXISTE"]}
+
+        response = self.client.post('/coupons/quote', json=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([quote['code'] for quote in response.json['quotes']], ["PERC30", "FIXO10"])
+        self.assertEqual(response.json['best']['discount_value'], 45)
+        errors = {rejected['code']: rejected['error'] for rejected in response.json['rejected']}
+        self.assertEqual(errors, {"MINIMO": 'Valor mínimo não atingido', "ESGOTADO": 'Cupom esgotado', "VENCIDO": 'Cupom expirado', "NAOEXISTE": 'Cupom não encontrado'})
+        self.assertEqual(Use.query.count(), 0)
+
+        # Considerando todos os cupons públicos não expirados
+        response = self.client.post('/coupons/quote', json={"total_value": 150, "first_purchase": False, "all_public": True})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['best']['code'], "PERC30")
+        self.assertNotIn("VENCIDO", [rejected['code'] for rejected in response.json['rejected']])
+
+    # Testando as regras compiladas dos cupons (categorias, janelas de horário, acúmulo e o tipo 'primeira')
+    # no cadastro, no consumo e na cotação
+    def test_coupon_rules(self):
+        expiration_date = (datetime.now() + timedelta(days=30)).isoformat()
+        base = {"expiration_date": expiration_date, "max_uses": 10, "min_value": 100, "discount_type": "fixo", "discount_amount": 10, "public": True, "first_purchase": False}
+        now = datetime.now()
+        window = {"weekdays": [now.weekday()], "start": "00:00", "end": "24:00"}
+        closed = {"weekdays": [(now.weekday() + 1) % 7], "start": "00:00", "end": "24:00"}
+        coupons = {"LIVROS": {"rules": {"categories": ["livros"], "stackable": True}},
+                   "HOJE": {"rules": {"time_windows": [window], "stackable": True}, "discount_amount": 20},
+                   "AMANHA": {"rules": {"time_windows": [closed]}},
+                   "PRIMEIRA": {"discount_type": "primeira"},
+                   "SOZINHO": {"discount_amount": 25}}
+        for code, values in coupons.items():
+            response = self.client.post('/coupons', json=dict(base, code=code, **values))
+            self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json['rules'], None)
+        response = self.client.post('/coupons', json=dict(base, code="INVALIDA", rules={"time_windows": [{"start": "25:00", "end": "10:00"}]}))
+        self.assertEqual(response.json['error'], 'Regras inválidas')
+
+        data = {"total_value": 150, "first_purchase": False}
+        self.assertEqual(self.client.post('/coupons/LIVROS', json=dict(data, categories=["games"])).json['error'], 'Cupom não é válido para as categorias da compra')
+        self.assertEqual(self.client.post('/coupons/AMANHA', json=data).json['error'], 'Cupom fora do horário de validade')
+        self.assertEqual(self.client.post('/coupons/PRIMEIRA', json=data).json['error'], 'Cupom é válido apenas para a primeira compra')
+        self.assertEqual(self.client.post('/coupons/PRIMEIRA', json=dict(data, first_purchase=True)).json['discount_value'], 10)
+        self.assertEqual(self.client.post('/coupons/SOZINHO', json=dict(data, applied_coupons=["HOJE"])).json['error'], 'Cupom não é cumulativo')
+        self.assertEqual(self.client.post('/coupons/HOJE', json=dict(data, applied_coupons=["LIVROS"])).status_code, 200)
+        self.assertEqual(self.client.post('/coupons/HOJE', json=dict(data, applied_coupons=["SOZINHO"])).json['error'], 'Cupom aplicado não é cumulativo')
+        self.assertEqual(self.client.post('/coupons/HOJE', json=dict(data, applied_coupons=["NAOEXISTE"])).json['error'], 'Cupom aplicado não encontrado')
+        self.assertEqual(self.client.post('/coupons/HOJE', json=dict(data, applied_coupons=[1])).json['error'], 'Cupons aplicados inválidos')
+        self.assertEqual(self.client.post('/coupons/SOZINHO', json=dict(data, applied_coupons=["SOZINHO"])).status_code, 200)
+
+        # Na cotação, os cupons cumulativos válidos (LIVROS e HOJE) superam o melhor cupom sozinho (SOZINHO)
+        response = self.client.post('/coupons/quote', json=dict(data, categories=["livros"], codes=list(coupons)))
+        self.assertEqual(response.json['best']['code'], "SOZINHO")
+        self.assertEqual(response.json['best_combination'], {'codes': ["HOJE", "LIVROS"], 'discount_value': 30})
+        errors = {rejected['code']: rejected['error'] for rejected in response.json['rejected']}
+        self.assertEqual(set(errors), {"AMANHA", "PRIMEIRA"})
+
+    # Testando a listagem com filtros e paginação por cursor, e a exportação em NDJSON e CSV
+    def test_list_and_export_coupons(self):
+        expiration_date = datetime.now() + timedelta(days=30)
+        db.session.add_all([Coupon(code=f"LISTA{index}", expiration_date=expiration_date, max_uses=10, min_value=100, discount_type="fixo" if index % 2 else "percentual", discount_amount=10, public=True, first_purchase=False) for index in range(5)])
+        db.session.add(Coupon(code="VENCIDO", expiration_date=datetime(2020, 12, 31, 23, 59, 59), max_uses=10, min_value=100, discount_type="fixo", discount_amount=10, public=False, first_purchase=False))
+        db.session.commit()
+
+        response = self.client.get('/coupons?status=active&limit=2')
+        self.assertEqual(response.status_code, 200)
+        codes = [coupon['code'] for coupon in response.json['coupons']]
+        while response.json['next_cursor']:
+            response = self.client.get(f"/coupons?status=active&limit=2&after={response.json['next_cursor']}")
+            codes.extend(coupon['code'] for coupon in response.json['coupons'])
+        self.assertEqual(codes, [f"LISTA{index}" for index in range(5)])
+
+        response = self.client.get('/coupons?status=expired&public=false')
+        self.assertEqual([coupon['code'] for coupon in response.json['coupons']], ["VENCIDO"])
+        self.assertEqual(len(self.client.get('/coupons?discount_type=fixo').json['coupons']), 3)
+        self.assertEqual(self.client.get('/coupons?public=talvez').status_code, 400)
+
+        response = self.client.get('/coupons?format=ndjson&status=active')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([line['code'] for line in lines], [f"LISTA{index}" for index in range(5)])
+        self.assertEqual(lines[0]['min_value'], 100)
+
+        response = self.client.get('/coupons?format=csv')
+        rows = response.get_data(as_text=True).splitlines()
+        self.assertEqual(rows[0], 'id,code,expiration_date,max_uses,uses_count,min_value,discount_type,discount_amount,public,first_purchase')
+        self.assertEqual(len(rows), 7)
+
+    # Testando que uma nova tentativa com a mesma Idempotency-Key devolve a resposta gravada sem consumir outro uso
+    def test_use_coupon_idempotency_key(self):
+        expiration_date = datetime.now() + timedelta(days=30)
+        db.session.add_all([Coupon(code="RETRY", expiration_date=expiration_date, max_uses=2, min_value=100, discount_type="fixo", discount_amount=10, public=True, first_purchase=False),
+                            Coupon(code="OUTRO", expiration_date=expiration_date, max_uses=2, min_value=100, discount_type="fixo", discount_amount=10, public=True, first_purchase=False)])
+        db.session.commit()
+        data = {"total_value": 150, "first_purchase": False}
+
+        first = self.client.post('/coupons/RETRY', json=data, headers={'Idempotency-Key': 'pedido-1'})
+        retry = self.client.post('/coupons/RETRY', json=data, headers={'Idempotency-Key': 'pedido-1'})
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.json, first.json)
+        self.assertEqual(retry.headers['Idempotency-Replayed'], 'true')
+        self.assertEqual(Coupon.query.filter_by(code="RETRY").first().uses_count, 1)
+        self.assertEqual(self.client.post('/coupons/OUTRO', json=data, headers={'Idempotency-Key': 'pedido-1'}).status_code, 422)
+
+        # No modo de commit em grupo a chave é gravada no mesmo lote que o uso
+        self.app.config['REDEMPTION_GROUP_COMMIT'] = True
+        try:
+            self.assertEqual(self.client.post('/coupons/RETRY', json=data, headers={'Idempotency-Key': 'pedido-2'}).status_code, 200)
+            retry = self.client.post('/coupons/RETRY', json=data, headers={'Idempotency-Key': 'pedido-2'})
+            self.assertEqual(retry.headers['Idempotency-Replayed'], 'true')
+            self.assertEqual(self.client.post('/coupons/RETRY', json=data, headers={'Idempotency-Key': 'pedido-3'}).json['error'], 'Cupom esgotado')
+        finally:
+            self.app.config['REDEMPTION_GROUP_COMMIT'] = False
+            self.app.extensions.pop('redemption_log').close()
+        db.session.remove()
+        self.assertEqual(Coupon.query.filter_by(code="RETRY").first().uses_count, 2)
+        self.assertEqual(IdempotencyKey.query.count(), 2)
+
+    # Testando o limite por cliente e a primeira compra nos backends memory e redis, antes da reconciliação
+    def test_counter_backends_per_customer(self):
+        expiration_date = datetime.now() + timedelta(days=30)
+        backends = [('memory', lambda: MemoryCounterBackend(sql_limits_loader(db.engine), sql_customer_loader(db.engine), shards=4)),
+                    ('redis', lambda: RedisCounterBackend(fakeredis.FakeRedis(), sql_limits_loader(db.engine), sql_customer_loader(db.engine)))]
+        for name, create_backend in backends:
+            with self.subTest(backend=name):
+                for code, values in ((f"LIMITE{name}", {'max_uses_per_customer': 1, 'first_purchase': False}),
+                                     (f"PRIMEIRA{name}", {'first_purchase': True}), (f"PRIMEIRA2{name}", {'first_purchase': True})):
+                    db.session.add(Coupon(code=code, expiration_date=expiration_date, max_uses=10, min_value=100, discount_type="fixo", discount_amount=10, public=True, **values))
+                db.session.commit()
+                backend = create_backend()
+                self.app.config['COUNTER_BACKEND'] = name
+                self.app.extensions['counter_backend'] = backend
+                try:
+                    ana, bia, carla = f"ana-{name}", f"bia-{name}", f"carla-{name}"
+                    purchase = {"total_value": 150}
+                    statuses = [self.client.post(f'/coupons/LIMITE{name}', json=dict(purchase, customer_id=ana)).status_code for _ in range(4)]
+                    self.assertEqual(statuses, [200, 400, 400, 400])
+                    response = self.client.post(f'/coupons/LIMITE{name}', json=dict(purchase, customer_id=ana))
+                    self.assertEqual(response.json['error'], 'Limite de usos por cliente atingido')
+
+                    statuses = [self.client.post(f'/coupons/{code}', json=dict(purchase, customer_id=bia)).status_code
+                                for code in (f"PRIMEIRA{name}", f"PRIMEIRA{name}", f"PRIMEIRA2{name}", f"PRIMEIRA2{name}")]
+                    self.assertEqual(statuses, [200, 400, 400, 400])
+                    response = self.client.post(f'/coupons/PRIMEIRA2{name}', json=dict(purchase, customer_id=bia))
+                    self.assertEqual(response.json['error'], 'Cupom é válido apenas para a primeira compra')
+
+                    # Um pedido registrado fora dos consumos também conta para um cliente já carregado no backend
+                    coupon_id, reserved = Coupon.query.filter_by(code=f"LIMITE{name}").first().id, datetime.now()
+                    self.assertTrue(backend.reserve(coupon_id, reserved, carla))
+                    backend.release(coupon_id, reserved, carla)
+                    self.assertEqual(self.client.post(f'/customers/{carla}/orders').status_code, 201)
+                    self.assertEqual(self.client.post(f'/coupons/PRIMEIRA{name}', json=dict(purchase, customer_id=carla)).status_code, 400)
+
+                    # Depois da reconciliação, o banco tem apenas os usos aceitos
+                    db.session.remove()
+                    reconcile(backend, db.engine)
+                    self.assertEqual(Use.query.filter_by(customer_id=ana).count(), 1)
+                    self.assertEqual(Use.query.filter_by(customer_id=bia).count(), 1)
+                    self.assertEqual(db.session.get(Customer, bia).orders_count, 1)
+                    self.assertEqual(db.session.get(Customer, carla).orders_count, 1)
+                finally:
+                    self.app.config['COUNTER_BACKEND'] = 'sql'
+                    self.app.extensions.pop('counter_backend')
+
+    # Testando os backends de contadores em memória e Redis (fakeredis) e a reconciliação na tabela Use
+    def test_counter_backends(self):
+        expiration_date = datetime.now() + timedelta(days=30)
+        data = {"total_value": 150, "first_purchase": False}
+        backends = [('memory', lambda: MemoryCounterBackend(sql_limits_loader(db.engine), shards=4)),
+                    ('redis', lambda: RedisCounterBackend(fakeredis.FakeRedis(), sql_limits_loader(db.engine)))]
+        for name, create_backend in backends:
+            with self.subTest(backend=name):
+                coupon = Coupon(code=f"CONTADOR{name}", expiration_date=expiration_date, max_uses=3, min_value=100, discount_type="fixo", discount_amount=10, public=True, first_purchase=False)
+                db.session.add(coupon)
+                db.session.commit()
+                coupon_id = coupon.id
+                backend = create_backend()
+                self.app.config['COUNTER_BACKEND'] = name
+                self.app.extensions['counter_backend'] = backend
+                try:
+                    # Uma reserva devolvida libera o uso para outro consumo
+                    reserved = datetime.now()
+                    self.assertTrue(backend.reserve(coupon_id, reserved))
+                    backend.release(coupon_id, reserved)
+                    statuses = [self.client.post(f'/coupons/CONTADOR{name}', json=data).status_code for _ in range(5)]
+                    self.assertEqual(statuses, [200, 200, 200, 400, 400])
+
+                    # Os usos ficam pendentes no backend até a reconciliação
+                    db.session.remove()
+                    self.assertEqual(Use.query.filter_by(coupon_id=coupon_id).count(), 0)
+                    self.assertEqual(reconcile(backend, db.engine, batch_size=2), 5)
+                    self.assertEqual(Coupon.query.get(coupon_id).uses_count, 3)
+                    self.assertEqual(Use.query.filter_by(coupon_id=coupon_id).count(), 3)
+
+                    # Devolvendo um uso já gravado no banco
+                    backend.release(coupon_id, Use.query.filter_by(coupon_id=coupon_id).first().use_date)
+                    db.session.remove()
+                    self.assertEqual(reconcile(backend, db.engine), 1)
+                    self.assertEqual(Coupon.query.get(coupon_id).uses_count, 2)
+                    self.assertEqual(Use.query.filter_by(coupon_id=coupon_id).count(), 2)
+                    self.assertEqual(self.client.post(f'/coupons/CONTADOR{name}', json=data).status_code, 200)
+                finally:
+                    self.app.config['COUNTER_BACKEND'] = 'sql'
+                    self.app.extensions.pop('counter_backend')
+
+    # Testando que a reconciliação interrompida depois de gravar no banco, antes de retirar os eventos do Redis,
+    # não grava os mesmos usos de novo, e que os eventos de um Redis reiniciado não são descartados
+    def test_redis_reconcile_replay(self):
+        coupon = Coupon(code="REPETIDO", expiration_date=datetime.now() + timedelta(days=30), max_uses=10, min_value=100, discount_type="fixo", discount_amount=10, public=True, first_purchase=False)
+        db.session.add(coupon)
+        db.session.commit()
+        coupon_id = coupon.id
+        client = fakeredis.FakeRedis()
+        backend = RedisCounterBackend(client, sql_limits_loader(db.engine), sql_customer_loader(db.engine))
+        for _ in range(3):
+            self.assertTrue(backend.reserve(coupon_id, datetime.now(), 'ana'))
+        reserved = datetime.now()
+        self.assertTrue(backend.reserve(coupon_id, reserved))
+        backend.release(coupon_id, reserved)
+
+        # O processo cai depois de gravar o primeiro lote no banco, antes de retirá-lo da lista de pendentes
+        def crash(items):
+            raise ConnectionError
+        backend.complete = crash
+        with self.assertRaises(ConnectionError):
+            reconcile(backend, db.engine, batch_size=2)
+        del backend.complete
+        # O lock do processo que caiu expira
+        client.delete(backend.lock_key)
+        self.assertEqual(reconcile(backend, db.engine, batch_size=2), 5)
+        self.assertEqual(client.llen(backend.pending_key), 0)
+        db.session.remove()
+        self.assertEqual(Use.query.filter_by(coupon_id=coupon_id).count(), 3)
+        self.assertEqual(db.session.get(Coupon, coupon_id).uses_count, 3)
+        self.assertEqual(db.session.get(Customer, 'ana').orders_count, 3)
+
+        # Depois de um Redis vazio, a sequência recomeça em outra época e os eventos novos são gravados
+        client.flushall()
+        self.assertTrue(backend.reserve(coupon_id, datetime.now()))
+        self.assertEqual(reconcile(backend, db.engine), 1)
+        db.session.remove()
+        self.assertEqual(Use.query.filter_by(coupon_id=coupon_id).count(), 4)
+
+    # Testando o limite de usos por cliente e a primeira compra obtida do histórico do cliente, com e sem o filtro de clientes
+    def test_use_coupon_per_customer(self):
+        expiration_date = datetime.now() + timedelta(days=30)
+        for capacity in (0, 1000):
+            with self.subTest(filter_capacity=capacity):
+                self.app.config['CUSTOMER_FILTER_CAPACITY'] = capacity
+                self.app.extensions.pop('customer_filter', None)
+                db.session.add_all([Coupon(code=f"LIMITE{capacity}", expiration_date=expiration_date, max_uses=10, min_value=100, discount_type="fixo", discount_amount=10, public=True, first_purchase=False, max_uses_per_customer=2),
+                                    Coupon(code=f"BOASVINDAS{capacity}", expiration_date=expiration_date, max_uses=10, min_value=100, discount_type="fixo", discount_amount=10, public=True, first_purchase=True)])
+                db.session.commit()
+                ana, bia = f"ana{capacity}", f"bia{capacity}"
+
+                # Cada cliente usa o cupom até o próprio limite
+                responses = [self.client.post(f'/coupons/LIMITE{capacity}', json={"total_value": 150, "customer_id": ana}) for _ in range(3)]
+                self.assertEqual([response.status_code for response in responses], [200, 200, 400])
+                self.assertEqual(responses[2].json['error'], 'Limite de usos por cliente atingido')
+                self.assertEqual(self.client.post(f'/coupons/LIMITE{capacity}', json={"total_value": 150, "customer_id": bia}).status_code, 200)
+                response = self.client.post(f'/coupons/LIMITE{capacity}', json={"total_value": 150, "first_purchase": False})
+                self.assertEqual(response.json['error'], 'Cliente não informado')
+
+                # A primeira compra vem do histórico, e não do corpo da requisição
+                response = self.client.post(f'/coupons/BOASVINDAS{capacity}', json={"total_value": 150, "first_purchase": True, "customer_id": ana})
+                self.assertEqual(response.json['error'], 'Cupom é válido apenas para a primeira compra')
+                carla = f"carla{capacity}"
+                response = self.client.post(f'/customers/{carla}/orders')
+                self.assertEqual(response.status_code, 201)
+                self.assertEqual(response.json, {'customer_id': carla, 'orders_count': 1})
+                response = self.client.post(f'/coupons/BOASVINDAS{capacity}', json={"total_value": 150, "customer_id": carla})
+                self.assertEqual(response.json['error'], 'Cupom é válido apenas para a primeira compra')
+                self.assertEqual(self.client.post(f'/coupons/BOASVINDAS{capacity}', json={"total_value": 150, "customer_id": f"novo{capacity}"}).status_code, 200)
+
+                self.assertEqual(Use.query.filter_by(customer_id=ana).count(), 2)
+                self.assertEqual(db.session.get(Customer, ana).orders_count, 2)
+        self.app.config['CUSTOMER_FILTER_CAPACITY'] = 0
+
+    # Testando o limite de requisições por cliente e o filtro de códigos, que recusa códigos inexistentes sem consultar o banco
+    def test_rate_limit_and_code_filter(self):
+        self.app.config.update({'RATE_LIMIT_PER_SECOND': 0.001, 'RATE_LIMIT_BURST': 10, 'RATE_LIMIT_MISS_COST': 5,
+                                'RATE_LIMIT_API_KEYS': {'parceiro'}, 'CODE_FILTER_CAPACITY': 1000,
+                                'CODE_FILTER_SYNC_INTERVAL': 3600})
+        expiration_date = (datetime.now() + timedelta(days=30)).isoformat()
+        response = self.client.post('/coupons', json={"code": "FILTRO", "expiration_date": expiration_date, "max_uses": 10, "min_value": 100, "discount_type": "fixo", "discount_amount": 10, "public": True, "first_purchase": False})
+        self.assertEqual(response.status_code, 201)
+        data = {"total_value": 150, "first_purchase": False}
+
+        # Um código certamente inexistente é recusado sem nenhum comando SQL
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            self.assertEqual(self.client.post('/coupons/ADIVINHA1', json=data).status_code, 404)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        self.assertEqual(statements, [])
+
+        # Cada código não encontrado custa 5 fichas: o cliente fica sem fichas depois de dois palpites
+        self.assertEqual(self.client.post('/coupons/ADIVINHA2', json=data).status_code, 404)
+        response = self.client.post('/coupons/FILTRO', json=data)
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+        self.assertEqual(self.client.post('/coupons/quote', json=dict(data, codes=["FILTRO"])).status_code, 429)
+
+        # Uma chave de API conhecida tem o seu próprio limite; uma chave desconhecida não escapa do limite do IP
+        self.assertEqual(self.client.post('/coupons/FILTRO', json=data, headers={'X-API-Key': 'parceiro'}).status_code, 200)
+        self.assertEqual(self.client.post('/coupons/FILTRO', json=data, headers={'X-API-Key': 'outra'}).status_code, 429)
+        self.app.config['RATE_LIMIT_PER_SECOND'] = 0
+
+        # Um cupom gravado por outro processo (aqui, direto no banco) entra no filtro na próxima sincronização
+        db.session.add(Coupon(code="OUTRO", expiration_date=datetime.now() + timedelta(days=30), max_uses=10, min_value=100, discount_type="fixo", discount_amount=10, public=True, first_purchase=False))
+        db.session.commit()
+        self.assertEqual(self.client.post('/coupons/OUTRO', json=data).status_code, 404)
+        self.app.extensions['code_filter'].sync_interval = 0
+        self.assertEqual(self.client.post('/coupons/OUTRO', json=data).status_code, 200)
+
+        # O próximo cupom, com id maior que o do último sincronizado, entra no filtro na sincronização incremental
+        db.session.add(Coupon(code="DEPOIS", expiration_date=datetime.now() + timedelta(days=30), max_uses=10, min_value=100, discount_type="fixo", discount_amount=10, public=True, first_purchase=False))
+        db.session.commit()
+        self.assertEqual(self.client.post('/coupons/DEPOIS', json=data).status_code, 200)
+        self.app.config['CODE_FILTER_CAPACITY'] = 0
+
+    # Testando as métricas no formato do Prometheus e o profiler das requisições mais lentas
+    def test_metrics(self):
+        self.app.extensions['metrics'].clear()
+        self.app.extensions['metrics_profiler'].clear()
+        self.app.config['METRICS_PROFILE_SAMPLE_RATE'] = 1.0
+        coupon = Coupon(code="VENCIDO", expiration_date=datetime(2020, 12, 31, 23, 59, 59), max_uses=500, min_value=100, discount_type="fixo", discount_amount=10, public=True, first_purchase=False)
+        db.session.add(coupon)
+        db.session.commit()
+
+        try:
+            data = {"total_value": 150, "first_purchase": False}
+            self.client.post('/coupons/VENCIDO', json=data)
+            self.client.post('/coupons/NAOEXISTE', json=data)
+            self.client.post('/coupons/NAOEXISTE', json=data)
+        finally:
+            self.app.config['METRICS_PROFILE_SAMPLE_RATE'] = 0.0
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.get_data(as_text=True)
+        self.assertIn('coupon_rejections_total{endpoint="/coupons/<code>",reason="Cupom expirado"} 1\n', text)
+        self.assertIn('coupon_rejections_total{endpoint="/coupons/<code>",reason="Cupom não encontrado"} 2\n', text)
+        self.assertIn('coupon_http_request_duration_seconds_count{endpoint="/coupons/<code>",method="POST"} 3\n', text)
+        self.assertIn('coupon_sql_statements_total{endpoint="/coupons/<code>",statement="SELECT"}', text)
+
+        response = self.client.get('/metrics/slowest')
+        self.assertIn('POST /coupons/NAOEXISTE 404', response.get_data(as_text=True))
+        self.assertIn('use_coupon', response.get_data(as_text=True))
+
+
+# Testando as migrações versionadas do esquema
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    # Testando a criação de um banco novo, com colunas em centavos do tipo INTEGER
+    def test_upgrade_new_database(self):
+        with closing(sqlite3.connect(self.path)) as connection:
+            applied = upgrade_connection(connection)
+            self.assertEqual([version for version, _ in applied], [1, 2, 3, 4, 5, 6, 7, 8])
+            self.assertEqual(current_version(connection), LATEST_VERSION)
+            columns = {row[1]: row[2] for row in connection.execute('PRAGMA table_info(coupon)')}
+            self.assertEqual(columns['min_value_cents'], 'INTEGER')
+            self.assertEqual(columns['discount_amount_cents'], 'INTEGER')
+            self.assertEqual(upgrade_connection(connection), [])
+
+    # Testando que o id do último cupom não é reaproveitado depois que ele vai para o arquivo morto
+    def test_coupon_ids_not_reused(self):
+        now = datetime.now()
+        archive = self.path + '.archive'
+        with closing(sqlite3.connect(self.path)) as connection:
+            upgrade_connection(connection)
+            insert = "INSERT INTO coupon (code, expiration_date, max_uses, min_value_cents, discount_type, discount_amount_cents, public, first_purchase) VALUES (?, ?, 10, 0, 'fixo', 1000, 1, 0)"
+            connection.execute(insert, ("ATIVO", (now + timedelta(days=30)).isoformat(' ')))
+            expired_id = connection.execute(insert, ("ANTIGO", (now - timedelta(days=90)).isoformat(' '))).lastrowid
+            connection.commit()
+            # O cupom expirado de maior id fica na tabela até que outro cupom seja cadastrado
+            self.assertEqual(sweep(connection, archive, timedelta(days=30), now=now), 0)
+            new_id = connection.execute(insert, ("NOVO", (now + timedelta(days=30)).isoformat(' '))).lastrowid
+            connection.commit()
+            self.assertEqual(sweep(connection, archive, timedelta(days=30), now=now), 1)
+            self.assertEqual(connection.execute('SELECT code FROM coupon ORDER BY id').fetchall(), [("ATIVO",), ("NOVO",)])
+        os.remove(archive)
+        self.assertGreater(new_id, expired_id)
+
+    # Testando a atualização no lugar de um banco criado pela primeira versão da aplicação
+    def test_upgrade_legacy_database(self):
+        with closing(sqlite3.connect(self.path)) as connection:
+            connection.execute('CREATE TABLE coupon (id INTEGER NOT NULL, code VARCHAR(20) NOT NULL, expiration_date DATETIME NOT NULL, max_uses INTEGER NOT NULL, min_value FLOAT NOT NULL, discount_type VARCHAR(10) NOT NULL, discount_amount FLOAT NOT NULL, public BOOLEAN NOT NULL, first_purchase BOOLEAN NOT NULL, PRIMARY KEY (id), UNIQUE (code))')
+            connection.execute('CREATE TABLE use (id INTEGER NOT NULL, coupon_id INTEGER NOT NULL, use_date DATETIME NOT NULL, PRIMARY KEY (id), FOREIGN KEY(coupon_id) REFERENCES coupon (id))')
+            connection.execute("INSERT INTO coupon VALUES (1, 'ABC123', '2030-12-31 23:59:59.000000', 500, 99.9, 'fixo', 10.1, 1, 0)")
+            connection.executemany("INSERT INTO use (coupon_id, use_date) VALUES (1, ?)", [('2023-01-01 00:00:00.000000',)] * 3)
+            connection.commit()
+
+            upgrade_connection(connection)
+
+            self.assertEqual(current_version(connection), LATEST_VERSION)
+            row = connection.execute('SELECT min_value_cents, discount_amount_cents, uses_count FROM coupon').fetchone()
+            self.assertEqual(row, (9990, 1010, 3))
+            indexes = {row[1] for row in connection.execute("SELECT type, name FROM sqlite_master WHERE type = 'index'")}
+            self.assertTrue({'ix_use_coupon_id_use_date', 'ix_use_use_date', 'ix_coupon_expiration_date', 'ix_coupon_public_expiration_date'} <= indexes)
+
+        # Lendo o banco migrado pelo modelo, em uma aplicação apontando para ele
+        with create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.path}'}).app_context():
+            coupon = Coupon.query.filter_by(code='ABC123').first()
+            self.assertEqual((coupon.min_value_cents, coupon.min_value, coupon.discount_amount), (9990, 99.9, 10.1))
+            db.session.remove()
+            db.engine.dispose()
+
+
+# Testando a versão assíncrona da API, que deve ter o mesmo comportamento de app.py
+class TestAsyncApp(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        with closing(sqlite3.connect(self.path)) as connection:
+            upgrade_connection(connection)
+        app_async.app.config['DATABASE_PATH'] = self.path
+        app_async.coupon_cache.clear()
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    async def test_create_and_use_coupon(self):
+        async with app_async.app.test_app() as test_app:
+            client = test_app.test_client()
+            coupon = {"code": "ASYNC1", "expiration_date": (datetime.now() + timedelta(days=30)).isoformat(), "max_uses": 2, "min_value": 100, "discount_type": "percentual", "discount_amount": 30, "public": True, "first_purchase": False}
+
+            response = await client.post('/coupons', json=coupon)
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual((await response.get_json())['min_value'], 100)
+
+            response = await client.post('/coupons', json=coupon)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual((await response.get_json())['error'], 'Código já existe')
+
+            data = {"total_value": 150, "first_purchase": False}
+            results = await asyncio.gather(*[client.post('/coupons/ASYNC1', json=data) for _ in range(5)])
+            self.assertEqual(sorted(response.status_code for response in results), [200, 200, 400, 400, 400])
+            self.assertEqual((await results[0].get_json())['discount_value'], 45)
+
+            response = await client.post('/coupons/ASYNC1', json={"total_value": 50, "first_purchase": False})
+            self.assertEqual((await response.get_json())['error'], 'Valor mínimo não atingido')
+
+            response = await client.post('/coupons/NAOEXISTE', json=data)
+            self.assertEqual(response.status_code, 404)
+
+        with closing(sqlite3.connect(self.path)) as connection:
+            self.assertEqual(connection.execute('SELECT uses_count FROM coupon').fetchone()[0], 2)
+            self.assertEqual(connection.execute('SELECT COUNT(*) FROM use').fetchone()[0], 2)
+
+
+    # Testando novas tentativas com a mesma Idempotency-Key, como em app.py
+    async def test_use_coupon_idempotency_key(self):
+        async with app_async.app.test_app() as test_app:
+            client = test_app.test_client()
+            expiration_date = (datetime.now() + timedelta(days=30)).isoformat()
+            for code in ("RETRY", "OUTRO"):
+                response = await client.post('/coupons', json={"code": code, "expiration_date": expiration_date, "max_uses": 5, "min_value": 100, "discount_type": "fixo", "discount_amount": 10, "public": True, "first_purchase": False})
+                self.assertEqual(response.status_code, 201)
+
+            data = {"total_value": 150, "first_purchase": False}
+            results = await asyncio.gather(*[client.post('/coupons/RETRY', json=data, headers={'Idempotency-Key': 'pedido-1'}) for _ in range(3)])
+            self.assertEqual([response.status_code for response in results], [200, 200, 200])
+            retry = await client.post('/coupons/RETRY', json=data, headers={'Idempotency-Key': 'pedido-1'})
+            self.assertEqual(retry.headers['Idempotency-Replayed'], 'true')
+            self.assertEqual(await retry.get_json(), {'discount_value': 10, 'coupon_id': 1})
+            response = await client.post('/coupons/OUTRO', json=data, headers={'Idempotency-Key': 'pedido-1'})
+            self.assertEqual(response.status_code, 422)
+
+        with closing(sqlite3.connect(self.path)) as connection:
+            self.assertEqual(connection.execute("SELECT uses_count FROM coupon WHERE code = 'RETRY'").fetchone()[0], 1)
+            self.assertEqual(connection.execute('SELECT COUNT(*) FROM use').fetchone()[0], 1)
+
+    # Testando que uma falha depois de gravar a chave de idempotência não deixa a chave na conexão do pool:
+    # a nova tentativa é avaliada novamente, sem devolver uma resposta de um consumo que não aconteceu
+    async def test_use_coupon_failure_after_idempotency_key(self):
+        self.addCleanup(app_async.app.config.__setitem__, 'DATABASE_POOL_SIZE', app_async.app.config['DATABASE_POOL_SIZE'])
+        app_async.app.config['DATABASE_POOL_SIZE'] = 1
+        async with app_async.app.test_app() as test_app:
+            client = test_app.test_client()
+            expiration_date = (datetime.now() + timedelta(days=30)).isoformat()
+            response = await client.post('/coupons', json={"code": "FALHA", "expiration_date": expiration_date, "max_uses": 5, "min_value": 100, "discount_type": "fixo", "discount_amount": 10, "public": True, "first_purchase": False})
+            self.assertEqual(response.status_code, 201)
+
+            async def failing_reserve(*args):
+                raise sqlite3.OperationalError('database is locked')
+
+            data = {"total_value": 150, "first_purchase": False}
+            reserve = app_async.reserve
+            app_async.reserve = failing_reserve
+            try:
+                response = await client.post('/coupons/FALHA', json=data, headers={'Idempotency-Key': 'pedido-2'})
+                self.assertEqual(response.status_code, 500)
+            finally:
+                app_async.reserve = reserve
+            # Outra requisição na mesma conexão não confirma a chave deixada pela requisição que falhou
+            self.assertEqual((await client.post('/coupons/FALHA', json=data)).status_code, 200)
+
+            response = await client.post('/coupons/FALHA', json=data, headers={'Idempotency-Key': 'pedido-2'})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('Idempotency-Replayed', response.headers)
+
+        with closing(sqlite3.connect(self.path)) as connection:
+            self.assertEqual(connection.execute("SELECT uses_count FROM coupon WHERE code = 'FALHA'").fetchone()[0], 2)
+            self.assertEqual(connection.execute('SELECT COUNT(*) FROM idempotency_key').fetchone()[0], 1)
+
+    # Testando as regras dos cupons (categorias e acúmulo), com o mesmo contrato de app.py
+    async def test_use_coupon_rules(self):
+        insert_rule_coupons(self.path)
+        async with app_async.app.test_app() as test_app:
+            client = test_app.test_client()
+            for code, values, status, error in RULE_CASES:
+                response = await client.post(f'/coupons/{code}', json=dict({"total_value": 150, "first_purchase": False}, **values))
+                self.assertEqual((response.status_code, (await response.get_json()).get('error')), (status, error), (code, values))
+
+    # Testando o limite de usos por cliente e a primeira compra pelo histórico, como em app.py
+    async def test_use_coupon_per_customer(self):
+        async with app_async.app.test_app() as test_app:
+            client = test_app.test_client()
+            expiration_date = (datetime.now() + timedelta(days=30)).isoformat()
+            coupon = {"code": "CLIENTE", "expiration_date": expiration_date, "max_uses": 10, "min_value": 100, "discount_type": "fixo", "discount_amount": 10, "public": True, "first_purchase": False, "max_uses_per_customer": 1}
+            response = await client.post('/coupons', json=coupon)
+            self.assertEqual((await response.get_json())['max_uses_per_customer'], 1)
+            response = await client.post('/coupons', json=dict(coupon, code="PRIMEIRA", discount_type="primeira", max_uses_per_customer=None))
+            self.assertEqual(response.status_code, 201)
+
+            statuses = [(await client.post('/coupons/CLIENTE', json={"total_value": 150, "customer_id": "ana"})).status_code for _ in range(3)]
+            self.assertEqual(statuses, [200, 400, 400])
+            response = await client.post('/coupons/CLIENTE', json={"total_value": 150, "customer_id": "ana"})
+            self.assertEqual((await response.get_json())['error'], 'Limite de usos por cliente atingido')
+            response = await client.post('/coupons/CLIENTE', json={"total_value": 150, "first_purchase": False})
+            self.assertEqual((await response.get_json())['error'], 'Cliente não informado')
+
+            response = await client.post('/coupons/PRIMEIRA', json={"total_value": 150, "first_purchase": True, "customer_id": "ana"})
+            self.assertEqual((await response.get_json())['error'], 'Cupom é válido apenas para a primeira compra')
+            response = await client.post('/coupons/PRIMEIRA', json={"total_value": 150, "customer_id": "bia"})
+            self.assertEqual(response.status_code, 200)
+
+        with closing(sqlite3.connect(self.path)) as connection:
+            self.assertEqual(connection.execute("SELECT COUNT(*) FROM use WHERE customer_id = 'ana'").fetchone()[0], 1)
+
+
+# Testando o perfil de ajustes do SQLite
+class TestSqliteProfile(unittest.TestCase):
+
+    # Testando se o perfil de produção foi aplicado às conexões da aplicação
+    def test_production_pragmas(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{directory}/coupons.db', 'SQLITE_PROFILE': 'production'})
+            with app.app_context(), db.engine.connect() as connection:
+                self.assertEqual(connection.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+                self.assertEqual(connection.exec_driver_sql('PRAGMA synchronous').scalar(), 1)
+                self.assertEqual(connection.exec_driver_sql('PRAGMA busy_timeout').scalar(), 5000)
+            with app.app_context():
+                db.engine.dispose()
+
+    # Testando perfis diferentes em duas aplicações do mesmo processo: cada engine mantém o perfil da sua aplicação
+    def test_profiles_per_app(self):
+        with tempfile.TemporaryDirectory() as directory:
+            production = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{directory}/a.db', 'SQLITE_PROFILE': 'production'})
+            default = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{directory}/b.db', 'SQLITE_PROFILE': 'default'})
+            for app, journal_mode in ((production, 'wal'), (default, 'delete')):
+                with app.app_context():
+                    with db.engine.connect() as connection:
+                        self.assertEqual(connection.exec_driver_sql('PRAGMA journal_mode').scalar(), journal_mode)
+                    db.engine.dispose()
+
+    # Testando as opções da engine: sem pool para o perfil padrão e para bancos em memória
+    def test_engine_options(self):
+        self.assertEqual(engine_options('default', 'sqlite:///coupons.db'), {})
+        self.assertEqual(engine_options('production', 'sqlite://'), {})
+        self.assertEqual(engine_options('production', 'sqlite:///coupons.db', pool_size=3)['pool_size'], 3)
+
+
+# Testando o limite de usos com consumos concorrentes em vários processos
+class TestConcurrentRedemption(unittest.TestCase):
+    processes = 8
+    attempts = 40
+    max_uses = 100
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.database_uri = f'sqlite:///{self.path}'
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    # Criando o cupom no banco compartilhado e disparando os consumos em paralelo
+    def redeem_concurrently(self, module_name):
+        app = importlib.import_module(module_name).create_app({'SQLALCHEMY_DATABASE_URI': self.database_uri})
+        with app.app_context():
+            db.create_all()
+            coupon = Coupon(code="STRESS", expiration_date=datetime.now() + timedelta(days=30), max_uses=self.max_uses, min_value=100, discount_type="percentual", discount_amount=30, public=True, first_purchase=False)
+            db.session.add(coupon)
+            db.session.commit()
+            db.session.remove()
+
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(self.processes) as pool:
+            results = pool.starmap(redeem_in_process, [(module_name, self.database_uri, "STRESS", self.attempts)] * self.processes)
+        statuses = [status for result in results for status in result]
+        return app, statuses
+
+    def test_app_never_exceeds_max_uses(self):
+        app, statuses = self.redeem_concurrently('app')
+
+        self.assertEqual(statuses.count(200), self.max_uses)
+        self.assertEqual(statuses.count(400), self.processes * self.attempts - self.max_uses)
+        with app.app_context():
+            coupon = Coupon.query.filter_by(code="STRESS").first()
+            self.assertEqual(coupon.uses_count, self.max_uses)
+            self.assertEqual(Use.query.filter_by(coupon_id=coupon.id).count(), self.max_uses)
+            db.session.remove()
+            db.engine.dispose()
+
+    def test_app2_never_exceeds_max_uses(self):
+        app, statuses = self.redeem_concurrently('app2')
+
+        self.assertEqual(statuses.count(200), self.max_uses)
+        self.assertEqual(statuses.count(400), self.processes * self.attempts - self.max_uses)
+        with app.app_context():
+            coupon = Coupon.query.filter_by(code="STRESS").first()
+            self.assertEqual(coupon.max_uses, self.max_uses)
+            self.assertEqual(coupon.uses_count, self.max_uses)
+            self.assertEqual(Use.query.filter_by(coupon_id=coupon.id).count(), self.max_uses)
+            db.session.remove()
+            db.engine.dispose()
+
+
+    # Testando as regras dos cupons (categorias e acúmulo) em app2.py, com o mesmo contrato de app.py
+    def test_app2_coupon_rules(self):
+        insert_rule_coupons(self.path)
+        app = importlib.import_module('app2').create_app({'SQLALCHEMY_DATABASE_URI': self.database_uri})
+        client = app.test_client()
+        for code, values, status, error in RULE_CASES:
+            response = client.post(f'/coupons/{code}', json=dict({"total_value": 150, "first_purchase": False}, **values))
+            self.assertEqual((response.status_code, response.json.get('error')), (status, error), (code, values))
+        with app.app_context():
+            db.engine.dispose()
+
+    # Testando consumos do mesmo cupom por app.py e app2.py no mesmo banco: ambos controlam o uses_count e registram os usos
+    def test_app_and_app2_share_uses_count(self):
+        apps = [importlib.import_module(name).create_app({'SQLALCHEMY_DATABASE_URI': self.database_uri}) for name in ('app', 'app2')]
+        with apps[0].app_context():
+            db.create_all()
+            db.session.add(Coupon(code="MISTO", expiration_date=datetime.now() + timedelta(days=30), max_uses=3, min_value=100, discount_type="fixo", discount_amount=10, public=True, first_purchase=False))
+            db.session.commit()
+            db.session.remove()
+
+        data = {"total_value": 150, "first_purchase": False}
+        statuses = [app.test_client().post('/coupons/MISTO', json=data).status_code for app in apps for _ in range(2)]
+        self.assertEqual(statuses, [200, 200, 200, 400])
+        with apps[1].app_context():
+            coupon = Coupon.query.filter_by(code="MISTO").first()
+            self.assertEqual((coupon.max_uses, coupon.uses_count), (3, 3))
+            self.assertEqual(Use.query.filter_by(coupon_id=coupon.id).count(), 3)
+            db.session.remove()
+        for app in apps:
+            with app.app_context():
+                db.engine.dispose()
+
+
+class TestGroupCommitRecovery(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        with closing(sqlite3.connect(self.path)) as connection:
+            upgrade_connection(connection)
+            connection.execute("INSERT INTO coupon (code, expiration_date, max_uses, min_value_cents, discount_type, discount_amount_cents, public, first_purchase) VALUES ('CRASH', ?, 1000000, 10000, 'percentual', 3000, 1, 0)",
+                               ((datetime.now() + timedelta(days=30)).isoformat(' '),))
+            connection.commit()
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm', '.ack'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    # Derrubando o processo no meio dos consumos e lendo o banco como ficou após a queda
+    def crash(self, durability, drain=False):
+        process = multiprocessing.get_context('spawn').Process(
+            target=redeem_until_crash, args=(f'sqlite:///{self.path}', 'CRASH', durability, 200, self.path + '.ack', drain))
+        process.start()
+        process.join(120)
+        with open(self.path + '.ack') as file:
+            acknowledged = int(file.read())
+        with closing(sqlite3.connect(self.path)) as connection:
+            uses_count = connection.execute("SELECT uses_count FROM coupon WHERE code = 'CRASH'").fetchone()[0]
+            uses = connection.execute("SELECT COUNT(*) FROM use").fetchone()[0]
+        return acknowledged, uses_count, uses
+
+    def test_commit_durability_keeps_every_acknowledged_use(self):
+        acknowledged, uses_count, uses = self.crash('commit')
+
+        # Todo consumo confirmado ao cliente está no contador, e o contador bate com o histórico
+        self.assertGreaterEqual(acknowledged, 200)
+        self.assertGreaterEqual(uses_count, acknowledged)
+        self.assertLessEqual(uses_count, acknowledged + GROUP_COMMIT_THREADS)
+        self.assertEqual(uses_count, uses)
+
+    def test_reserve_durability_keeps_count_and_history_consistent(self):
+        acknowledged, uses_count, uses = self.crash('reserve')
+
+        # A reserva é confirmada antes da resposta: todo consumo confirmado está no contador. Somente os
+        # registros da tabela Use ainda não gravados podem faltar, nunca sobrar. O contador pode ter alguns usos
+        # a mais: respostas que não chegaram às threads antes da queda
+        self.assertGreaterEqual(acknowledged, 200)
+        self.assertGreaterEqual(uses_count, acknowledged)
+        self.assertLessEqual(uses_count, acknowledged + GROUP_COMMIT_THREADS)
+        self.assertLessEqual(uses, uses_count)
+
+    def test_reserve_durability_keeps_every_use_after_the_last_batch(self):
+        acknowledged, uses_count, uses = self.crash('reserve', drain=True)
+
+        # Com o registro fechado antes da queda, exatamente os consumos confirmados estão no contador e na tabela Use
+        self.assertGreaterEqual(acknowledged, 200)
+        self.assertEqual(uses_count, acknowledged)
+        self.assertEqual(uses, acknowledged)
+
+
+# Testando o armazenamento particionado em vários arquivos SQLite
+class TestShardedApp(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.apps = []
+        self.client = self.create_client(3, 'shard{}.db')
+        self.store.upgrade()
+
+    def tearDown(self):
+        for app in self.apps:
+            app.extensions['shard_store'].dispose()
+        self.directory.cleanup()
+
+    def create_client(self, shards, template):
+        app = app_sharded.create_app({'COUPON_SHARDS': shards,
+                                      'COUPON_SHARD_PATH': os.path.join(self.directory.name, template)})
+        self.apps.append(app)
+        self.store = app.extensions['shard_store']
+        return app.test_client()
+
+    def count_coupons(self, path):
+        with closing(sqlite3.connect(path)) as connection:
+            return connection.execute('SELECT COUNT(*), COALESCE(SUM(uses_count), 0) FROM coupon').fetchone()
+
+    def test_create_and_use_coupons_across_shards(self):
+        expiration_date = (datetime.now() + timedelta(days=30)).isoformat()
+        codes = [f"SHARD{index}" for index in range(12)]
+        for code in codes:
+            data = {"code": code, "expiration_date": expiration_date, "max_uses": 1, "min_value": 100, "discount_type": "percentual", "discount_amount": 30, "public": True, "first_purchase": False}
+            self.assertEqual(self.client.post('/coupons', json=data).status_code, 201)
+        self.assertEqual(self.client.post('/coupons', json=data).json['error'], 'Código já existe')
+        # O limite por cliente não é verificado entre shards, então o cadastro é recusado
+        response = self.client.post('/coupons', json=dict(data, code="PORCLIENTE", max_uses_per_customer=1))
+        self.assertEqual(response.json['error'], 'Limite por cliente não suportado')
+
+        purchase = {"total_value": 150, "first_purchase": False}
+        response = self.client.post(f'/coupons/{codes[0]}', json=purchase)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['discount_value'], 45)
+        self.assertEqual(self.client.post(f'/coupons/{codes[0]}', json=purchase).json['error'], 'Cupom esgotado')
+        self.assertEqual(self.client.post('/coupons/NAOEXISTE', json=purchase).status_code, 404)
+
+        # Cada cupom fica somente no shard escolhido pelo hash do código
+        paths = self.store.paths
+        expected = [sum(1 for code in codes if shard_index(code, 3) == index) for index in range(3)]
+        self.assertEqual([self.count_coupons(path)[0] for path in paths], expected)
+
+        # Clientes e chaves de idempotência gravados nos shards (por exemplo, redistribuídos de um banco de app.py)
+        customers = [("ana", 2, '2024-01-01 00:00:00.000000'), ("bia", 1, '2024-02-01 00:00:00.000000')]
+        for path, customer in zip(paths, customers + [("ana", 3, '2023-06-01 00:00:00.000000')]):
+            with closing(sqlite3.connect(path)) as connection:
+                connection.execute("INSERT INTO customer (customer_id, orders_count, first_order_date) VALUES (?, ?, ?)", customer)
+                connection.commit()
+        for code in codes[:4]:
+            with closing(sqlite3.connect(paths[shard_index(code, 3)])) as connection:
+                connection.execute("INSERT INTO idempotency_key (key, code, response, expires_at) VALUES (?, ?, '{}', '2030-01-01 00:00:00.000000')",
+                                   (code.encode().ljust(16, b'-'), code))
+                connection.commit()
+
+        # Redistribuindo os cupons em 2 shards e consumindo pela nova configuração
+        targets = [os.path.join(self.directory.name, f'novo{index}.db') for index in range(2)]
+        self.assertEqual(sum(reshard(paths, targets)), len(codes))
+        self.assertEqual(sum(self.count_coupons(path)[1] for path in targets), 1)
+        for index, path in enumerate(targets):
+            with closing(sqlite3.connect(path)) as connection:
+                # O histórico de um cliente presente em mais de uma origem é somado no shard do customer_id
+                self.assertEqual(connection.execute("SELECT customer_id, orders_count, first_order_date FROM customer ORDER BY customer_id").fetchall(),
+                                 [(customer_id, orders, date) for customer_id, orders, date in
+                                  [("ana", 5, '2023-06-01 00:00:00.000000'), ("bia", 1, '2024-02-01 00:00:00.000000')]
+                                  if shard_index(customer_id, 2) == index])
+                # Cada chave de idempotência fica no shard do código, junto com o cupom
+                self.assertEqual(sorted(row[0] for row in connection.execute("SELECT code FROM idempotency_key")),
+                                 sorted(code for code in codes[:4] if shard_index(code, 2) == index))
+        self.client = self.create_client(2, 'novo{}.db')
+        self.assertEqual(self.client.post(f'/coupons/{codes[0]}', json=purchase).json['error'], 'Cupom esgotado')
+        self.assertEqual(self.client.post(f'/coupons/{codes[1]}', json=purchase).status_code, 200)
+
+
+# Testando a limpeza dos cupons expirados e o arquivo morto
+class TestSweeper(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'coupons.db')
+        self.archive = os.path.join(self.directory.name, 'archive.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_sweep_moves_expired_coupons_and_uses(self):
+        now = datetime.now()
+        coupons = [("ANTIGO", now - timedelta(days=90), 3), ("VENCIDO2", now - timedelta(days=60), 0),
+                   ("CARENCIA", now - timedelta(days=5), 1), ("ATIVO", now + timedelta(days=30), 2)]
+        with closing(sqlite3.connect(self.path)) as connection:
+            upgrade_connection(connection)
+            for code, expiration_date, uses in coupons:
+                coupon_id = connection.execute("INSERT INTO coupon (code, expiration_date, max_uses, min_value_cents, discount_type, discount_amount_cents, public, first_purchase, uses_count) VALUES (?, ?, 10, 10000, 'fixo', 1000, 1, 0, ?)",
+                                               (code, expiration_date.isoformat(' '), uses)).lastrowid
+                connection.executemany("INSERT INTO use (coupon_id, use_date) VALUES (?, ?)",
+                                       [(coupon_id, (expiration_date - timedelta(days=day + 1)).isoformat(' ')) for day in range(uses)])
+            connection.commit()
+
+            # Um cupom por lote, com carência de 30 dias: somente ANTIGO e VENCIDO2 são arquivados
+            self.assertEqual(sweep(connection, self.archive, timedelta(days=30), batch_size=1, now=now), 2)
+            self.assertEqual(sweep(connection, self.archive, timedelta(days=30), batch_size=1, now=now), 0)
+            self.assertEqual([row[0] for row in connection.execute("SELECT code FROM coupon ORDER BY code")], ["ATIVO", "CARENCIA"])
+            self.assertEqual(connection.execute("SELECT COUNT(*) FROM use").fetchone()[0], 3)
+
+        with closing(sqlite3.connect(self.archive)) as connection:
+            self.assertEqual(connection.execute("SELECT COUNT(*) FROM use").fetchone()[0], 3)
+        coupons_archived, uses, first_use, last_use = archived_summary(self.archive, "ANTIGO")
+        self.assertEqual((coupons_archived, uses), (1, 3))
+        self.assertLess(first_use, last_use)
+        self.assertEqual(archived_summary(self.archive, "VENCIDO2")[:2], (1, 0))
+
+    # Testando que o limite por cliente, as regras e o cliente de cada uso vão para o arquivo morto, inclusive
+    # em um arquivo criado antes dessas colunas
+    def test_sweep_archives_rules_and_customer_limit(self):
+        now = datetime.now()
+        with closing(sqlite3.connect(self.archive)) as connection:
+            connection.execute('CREATE TABLE use (coupon_id INTEGER NOT NULL, use_date DATETIME NOT NULL, seq INTEGER NOT NULL, PRIMARY KEY (coupon_id, use_date, seq)) WITHOUT ROWID')
+            connection.execute('CREATE TABLE coupon (id INTEGER NOT NULL PRIMARY KEY, coupon_id INTEGER NOT NULL, code VARCHAR(20) NOT NULL, expiration_date DATETIME NOT NULL, max_uses INTEGER NOT NULL, min_value_cents INTEGER NOT NULL, discount_type VARCHAR(10) NOT NULL, discount_amount_cents INTEGER NOT NULL, public BOOLEAN NOT NULL, first_purchase BOOLEAN NOT NULL, uses_count INTEGER NOT NULL, first_use_date DATETIME, last_use_date DATETIME, archived_at DATETIME NOT NULL, UNIQUE (coupon_id, code))')
+        with closing(sqlite3.connect(self.path)) as connection:
+            upgrade_connection(connection)
+            connection.execute("INSERT INTO coupon (code, expiration_date, max_uses, min_value_cents, discount_type, discount_amount_cents, public, first_purchase, max_uses_per_customer, rules) VALUES ('REGRAS', ?, 10, 0, 'fixo', 1000, 1, 0, 2, '{\"stackable\": true}')",
+                               ((now - timedelta(days=90)).isoformat(' '),))
+            connection.executemany("INSERT INTO use (coupon_id, use_date, customer_id) VALUES (1, ?, ?)",
+                                   [((now - timedelta(days=100)).isoformat(' '), 'ana'), ((now - timedelta(days=95)).isoformat(' '), None)])
+            connection.execute("INSERT INTO coupon (code, expiration_date, max_uses, min_value_cents, discount_type, discount_amount_cents, public, first_purchase) VALUES ('ATIVO', ?, 10, 0, 'fixo', 1000, 1, 0)",
+                               ((now + timedelta(days=30)).isoformat(' '),))
+            connection.commit()
+            self.assertEqual(sweep(connection, self.archive, timedelta(days=30), now=now), 1)
+        with closing(sqlite3.connect(self.archive)) as connection:
+            self.assertEqual(connection.execute("SELECT max_uses_per_customer, rules FROM coupon WHERE code = 'REGRAS'").fetchone(), (2, '{"stackable": true}'))
+            self.assertEqual([row[0] for row in connection.execute("SELECT customer_id FROM use ORDER BY use_date")], ['ana', None])
+
+    # Testando a remoção das chaves de idempotência expiradas sem o arquivo morto
+    def test_purge_keys_without_archive(self):
+        now = datetime.now()
+        with closing(sqlite3.connect(self.path)) as connection:
+            upgrade_connection(connection)
+            connection.executemany("INSERT INTO idempotency_key (key, code, response, expires_at) VALUES (?, 'ABC', '{}', ?)",
+                                   [(bytes([index]) * 16, (now + timedelta(hours=hours)).isoformat(' ')) for index, hours in enumerate((-2, -1, 1))])
+            connection.commit()
+
+            self.assertEqual(purge_keys(connection, batch_size=1, now=now), 2)
+            self.assertEqual(connection.execute("SELECT COUNT(*) FROM idempotency_key").fetchone()[0], 1)
+            self.assertEqual(connection.execute("SELECT COUNT(*) FROM coupon").fetchone()[0], 0)
+        self.assertFalse(os.path.exists(self.archive))
+